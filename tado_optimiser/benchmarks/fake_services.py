@@ -0,0 +1,393 @@
+import base64
+import hashlib
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-ins for the Home Assistant supervisor API, Octopus & OpenWeather on one port
+# Paths: /core/api/... (supervisor), /core/websocket (supervisor WebSocket), /v1/... (Octopus), /data/3.0/onecall (OpenWeather),
+# /_bench/... (harness control)
+
+AGILE_TARIFF = "E-1R-AGILE-24-10-01-C"
+GAS_TARIFF = "G-1R-VAR-22-11-01-C"
+PAGE_SIZE = 100
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_PATHS = ("/core/websocket", "/core/api/websocket")
+
+
+def iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def compress_state(entity):
+    # An entity in subscribe_entities' compressed form
+    return {"s": entity["state"], "a": entity.get("attributes", {}), "lc": time.time()}
+
+
+class WebSocketClient:
+    # One client connected to the fake supervisor WebSocket, text frames only
+    def __init__(self, connection, reader, writer):
+        self.connection = connection
+        self.reader = reader
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def receive(self):
+        # Returns the next text message, None once the client closes or the socket drops
+        while True:
+            header = self.reader.read(2)
+            if len(header) < 2:
+                return None
+            opcode, length = header[0] & 0x0F, header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack(">H", self.reader.read(2))[0]
+            elif length == 127:
+                length = struct.unpack(">Q", self.reader.read(8))[0]
+            mask = self.reader.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+            data = bytes(byte ^ mask[index % 4] for index, byte in enumerate(self.reader.read(length)))
+            if opcode == 0x8:
+                return None
+            if opcode == 0x1:
+                return json.loads(data)
+
+    def send(self, message):
+        data = json.dumps(message).encode()
+        if len(data) < 126:
+            header = struct.pack(">BB", 0x81, len(data))
+        elif len(data) < 65536:
+            header = struct.pack(">BBH", 0x81, 126, len(data))
+        else:
+            header = struct.pack(">BBQ", 0x81, 127, len(data))
+        with self.lock:
+            self.writer.write(header + data)
+
+    def drop(self):
+        # Cuts the connection without a close frame, as a supervisor or network restart would
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class FakeServices:
+    def __init__(self, states, latency=None, failure_rate=None, seed=1, page_size=PAGE_SIZE):
+        # latency & failure_rate are keyed by service: home_assistant, octopus, open_weather
+        self.states = states
+        self.page_size = page_size
+        self.latency = latency or {}
+        self.failure_rate = failure_rate or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.requests = []
+        self.websocket_clients = []
+        self.websocket_connections = 0
+        self.reset()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.drop_websockets()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                service: {"requests": 0, "failures": 0, "bytes_in": 0, "bytes_out": 0}
+                for service in ("home_assistant", "octopus", "open_weather")
+            }
+            self.requests = []
+
+    def record(self, service, bytes_in, bytes_out, failed):
+        with self.lock:
+            stats = self.stats[service]
+            stats["requests"] += 1
+            stats["failures"] += int(failed)
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+
+    def should_fail(self, service):
+        with self.lock:
+            return self.random.random() < self.failure_rate.get(service, 0)
+
+    def set_state(self, entity_id, state, attributes=None):
+        # Changes an entity & sends the change to every WebSocket subscribed to it
+        entity = dict(self.states.get(entity_id) or {"entity_id": entity_id, "attributes": {}})
+        entity["state"] = str(state)
+        if attributes is not None:
+            entity["attributes"] = attributes
+        created = entity_id not in self.states
+        self.states[entity_id] = entity
+
+        with self.lock:
+            clients = list(self.websocket_clients)
+        for client in clients:
+            for subscription_id, entity_ids in list(client.subscriptions.items()):
+                if entity_id not in entity_ids:
+                    continue
+                if created:
+                    event = {"a": {entity_id: compress_state(entity=entity)}}
+                else:
+                    event = {"c": {entity_id: {"+": compress_state(entity=entity)}}}
+                try:
+                    client.send(message={"id": subscription_id, "type": "event", "event": event})
+                except OSError:
+                    pass
+        return created
+
+    def drop_websockets(self):
+        with self.lock:
+            clients, self.websocket_clients = self.websocket_clients, []
+        for client in clients:
+            client.drop()
+        return len(clients)
+
+    def serve_websocket(self, client):
+        # The supervisor's WebSocket API: auth, subscribe_entities with a full snapshot then changes, ping
+        with self.lock:
+            self.websocket_connections += 1
+        client.send(message={"type": "auth_required", "ha_version": "bench"})
+        message = client.receive()
+        if message is None or message.get("type") != "auth":
+            return
+        if message.get("access_token") != "bench":
+            client.send(message={"type": "auth_invalid", "message": "Invalid access token"})
+            return
+        client.send(message={"type": "auth_ok", "ha_version": "bench"})
+
+        with self.lock:
+            self.websocket_clients.append(client)
+        try:
+            while True:
+                message = client.receive()
+                if message is None:
+                    return
+                if message["type"] == "subscribe_entities":
+                    entity_ids = set(message.get("entity_ids") or self.states)
+                    client.send(message={"id": message["id"], "type": "result", "success": True, "result": None})
+                    snapshot = {entity_id: compress_state(entity=self.states[entity_id]) for entity_id in entity_ids if entity_id in self.states}
+                    client.subscriptions[message["id"]] = entity_ids
+                    client.send(message={"id": message["id"], "type": "event", "event": {"a": snapshot}})
+                elif message["type"] == "ping":
+                    client.send(message={"id": message["id"], "type": "pong"})
+                else:
+                    client.send(message={"id": message["id"], "type": "result", "success": False, "error": {"code": "unknown_command", "message": "Unknown command."}})
+        except OSError:
+            return
+        finally:
+            with self.lock:
+                if client in self.websocket_clients:
+                    self.websocket_clients.remove(client)
+
+    # ****************************************************************************************************************
+    # Responses
+
+    def agile_rates(self, query, path):
+        now = int(time.time())
+        base = now - now % 1800
+        period_from = query.get("period_from", [iso(base - 86400)])[0]
+        start = datetime.fromisoformat(period_from.replace("Z", "+00:00")).timestamp()
+
+        # Tomorrow's prices are published at 16:00 UK time
+        end = base - base % 86400 + (2 if datetime.now().hour >= 16 else 1) * 86400 + 22 * 3600
+        results = []
+        for slot_start in range(int(start - start % 1800), int(end), 1800):
+            hour = datetime.fromtimestamp(slot_start).hour
+            price = 35.0 if 16 <= hour < 19 else (8.0 if hour < 5 else 20.0) + (slot_start // 1800) % 5
+            results.append({
+                "value_exc_vat": round(price / 1.05, 2),
+                "value_inc_vat": price,
+                "valid_from": iso(slot_start),
+                "valid_to": iso(slot_start + 1800),
+                "payment_method": None,
+            })
+        results.reverse()
+        return self.paginate(results=results, query=query, path=path)
+
+    def gas_rates(self, query, path):
+        results = [
+            {"value_exc_vat": 5.5, "value_inc_vat": 5.78, "valid_from": "2024-01-01T00:00:00Z", "valid_to": None, "payment_method": "DIRECT_DEBIT"},
+            {"value_exc_vat": 5.9, "value_inc_vat": 6.2, "valid_from": "2024-01-01T00:00:00Z", "valid_to": None, "payment_method": "NON_DIRECT_DEBIT"},
+        ]
+        return self.paginate(results=results, query=query, path=path)
+
+    def paginate(self, results, query, path):
+        page = int(query.get("page", ["1"])[0])
+        chunk = results[(page - 1) * self.page_size:page * self.page_size]
+        next_url = None
+        if page * self.page_size < len(results):
+            next_query = "&".join(f"{key}={value[0]}" for key, value in query.items() if key != "page")
+            next_url = f"{self.url}{path}?{next_query}&page={page + 1}"
+        return {"count": len(results), "next": next_url, "previous": None, "results": chunk}
+
+    def account(self):
+        agreements = lambda tariff: [{"tariff_code": tariff, "valid_from": "2024-01-01T00:00:00Z", "valid_to": None}]
+        return {
+            "number": "A-BENCH",
+            "properties": [{
+                "electricity_meter_points": [{"is_export": False, "agreements": agreements(AGILE_TARIFF)}],
+                "gas_meter_points": [{"agreements": agreements(GAS_TARIFF)}],
+            }],
+        }
+
+    def weather(self):
+        now = int(time.time())
+        conditions = [{"id": 500, "main": "Rain", "description": "light rain"}]
+        common = {"pressure": 1010, "humidity": 80, "dew_point": 5, "clouds": 75, "uvi": 0.5, "visibility": 10000, "wind_speed": 4, "wind_gust": 7, "wind_deg": 200, "weather": conditions}
+        return {
+            "lat": 51.5,
+            "lon": -0.1,
+            "current": {"dt": now, "sunrise": now - now % 86400 + 7 * 3600, "sunset": now - now % 86400 + 17 * 3600, "temp": 6.5, "feels_like": 4, **common},
+            "minutely": [{"dt": now + minute * 60, "precipitation": 0} for minute in range(61)],
+            "hourly": [{"dt": now - now % 3600 + hour * 3600, "temp": 6 + (hour % 24) / 4, "feels_like": 4, "pop": 0.2, **common} for hour in range(48)],
+            "daily": [{
+                "dt": now - now % 86400 + day * 86400 + 12 * 3600,
+                "sunrise": now - now % 86400 + day * 86400 + 7 * 3600,
+                "sunset": now - now % 86400 + day * 86400 + 17 * 3600,
+                "moonrise": now, "moonset": now, "moon_phase": 0.5, "summary": "Rain",
+                "temp": {"day": 9, "min": 4, "max": 11, "night": 5, "eve": 7, "morn": 4},
+                "feels_like": {"day": 7, "night": 3, "eve": 5, "morn": 2},
+                "pop": 0.3, "rain": 1.2, **common,
+            } for day in range(8)],
+        }
+
+    def history(self, entity_ids, start):
+        # A reading every 15 minutes from a simple simulated room for each climate & heating entity
+        start = datetime.fromisoformat(start)
+        readings = int((datetime.now(timezone.utc) - start).total_seconds() // 900)
+        history = []
+        for entity_id in entity_ids:
+            states = []
+            temperature = 18.0
+            for reading in range(readings):
+                heating = 1.0 if temperature < 19.5 else 0.0
+                last_updated = (start + timedelta(minutes=15 * reading)).isoformat()
+                if entity_id.startswith("climate."):
+                    states.append({"entity_id": entity_id, "state": "heat", "attributes": {"current_temperature": round(temperature, 1), "hvac_action": "heating" if heating else "idle"}, "last_updated": last_updated})
+                elif entity_id.endswith("_heating"):
+                    states.append({"entity_id": entity_id, "state": str(int(heating * 100)), "attributes": {}, "last_updated": last_updated})
+                else:
+                    states.append({"entity_id": entity_id, "state": "6.5", "attributes": {}, "last_updated": last_updated})
+                temperature += (0.08 * (6.5 - temperature) + 2.0 * heating) / 4
+            history.append(states)
+        return history
+
+    # ****************************************************************************************************************
+
+    def make_handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def get_service(self, path):
+                if path.startswith("/core/api"):
+                    return "home_assistant"
+                if path.startswith("/v1/"):
+                    return "octopus"
+                if path.startswith("/data/"):
+                    return "open_weather"
+                return None
+
+            def upgrade(self):
+                # Completes the WebSocket handshake & hands the connection to the fake supervisor WebSocket
+                accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.close_connection = True
+                services.serve_websocket(client=WebSocketClient(connection=self.connection, reader=self.rfile, writer=self.wfile))
+
+            def reply(self, service, status, body, bytes_in):
+                # Counted before the response goes out so a client reading the stats straight after sees its request
+                encoded = json.dumps(body).encode()
+                if service is not None:
+                    services.record(service=service, bytes_in=bytes_in, bytes_out=len(encoded), failed=status >= 400)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def handle_request(self, method):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length)) if length else None
+                bytes_in = len(self.requestline) + len(str(self.headers)) + length
+
+                if url.path == "/_bench/stats":
+                    return self.reply(None, 200, services.stats, 0)
+                if url.path == "/_bench/reset":
+                    services.reset()
+                    return self.reply(None, 200, {}, 0)
+
+                service = self.get_service(path=url.path)
+                if service is None:
+                    return self.reply(None, 404, {"message": "Not found"}, 0)
+
+                with services.lock:
+                    services.requests.append((service, method, url.path, query))
+                delay = services.latency.get(service, 0)
+                if delay:
+                    time.sleep(delay / 1000)
+                if services.should_fail(service=service):
+                    return self.reply(service, 503, {"message": "Injected failure"}, bytes_in)
+
+                self.reply(service, *self.route(method=method, path=url.path, query=query, body=body), bytes_in)
+
+            def route(self, method, path, query, body):
+                if path == "/core/api/states" and method == "GET":
+                    return 200, list(services.states.values())
+                if path.startswith("/core/api/states/"):
+                    entity_id = path.rsplit("/", 1)[1]
+                    if method == "GET":
+                        entity = services.states.get(entity_id)
+                        return (200, entity) if entity else (404, {"message": "Entity not found."})
+                    created = services.set_state(entity_id=entity_id, state=body["state"], attributes=body.get("attributes", {}))
+                    return (201 if created else 200), services.states[entity_id]
+                if path.startswith("/core/api/services/climate/"):
+                    return 200, []
+                if path.startswith("/core/api/history/period/"):
+                    return 200, services.history(entity_ids=query["filter_entity_id"][0].split(","), start=path.rsplit("/", 1)[1])
+                if path.startswith("/v1/accounts/"):
+                    return 200, services.account()
+                if "/electricity-tariffs/" in path:
+                    return 200, services.agile_rates(query=query, path=path)
+                if "/gas-tariffs/" in path:
+                    return 200, services.gas_rates(query=query, path=path)
+                if path.startswith("/data/3.0/onecall"):
+                    return 200, services.weather()
+                return 404, {"message": "Not found"}
+
+            def do_GET(self):
+                if urlparse(self.path).path in WEBSOCKET_PATHS and self.headers.get("Upgrade", "").lower() == "websocket":
+                    return self.upgrade()
+                self.handle_request(method="GET")
+
+            def do_POST(self):
+                self.handle_request(method="POST")
+
+        return Handler
@@ -0,0 +1,54 @@
+import yaml
+
+# Synthetic houses: every 4th room is a non-Tado thermostat and every 5th has an electric radiator
+
+
+def room_names(rooms):
+    return [f"room_{number:03d}" for number in range(1, rooms + 1)]
+
+
+def build_settings(rooms):
+    settings = {"rooms": {}}
+    for index, name in enumerate(room_names(rooms=rooms)):
+        electric_override = index % 5 == 0
+        settings["rooms"][name] = {
+            "is_tado": index % 4 != 3,
+            "gas_climate_entity": f"climate.{name}",
+            "day": 18 + index % 3,
+            "evening": 20,
+            "night": 16,
+            "electric_override": electric_override,
+            "gas_radiator_power": 2000 if electric_override else None,
+            "electric_radiator_power": 1500 if electric_override else None,
+            "electric_climate_entity": f"climate.{name}_electric" if electric_override else None,
+        }
+    return settings
+
+
+def build_states(rooms):
+    # Home Assistant states for every entity the cycle reads
+    states = {}
+
+    def add(entity_id, state, **attributes):
+        states[entity_id] = {"entity_id": entity_id, "state": state, "attributes": attributes}
+
+    for index, name in enumerate(room_names(rooms=rooms)):
+        add(f"climate.{name}", "heat", current_temperature=16.0 + index % 6, temperature=18, hvac_action="heating" if index % 2 else "idle")
+        if index % 4 != 3:
+            for sensor in ("connectivity", "early_start", "overlay", "power", "window"):
+                add(f"binary_sensor.{name}_{sensor}", "off")
+            add(f"sensor.{name}_heating", str(index % 100))
+            add(f"sensor.{name}_humidity", "55")
+            add(f"sensor.{name}_tado_mode", "HOME")
+        if index % 5 == 0:
+            add(f"climate.{name}_electric", "off", current_temperature=16.0, temperature=7)
+
+    add("sensor.home_solar_percentage", "12")
+    add("sensor.givtcp_fd2327g123_grid_power", "-250")
+    add("predbat.status", "Demand")
+    return states
+
+
+def write_settings(path, rooms):
+    with open(path, "w") as file:
+        yaml.safe_dump(build_settings(rooms=rooms), file, sort_keys=False)
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import yaml
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from simulator import ROOTFS_DIR, recorded_scenario, run_sweep, get_runs, synthetic_scenario  # noqa: E402
+from tado import AWAY_REDUCTIONS  # noqa: E402
+
+# Replays a year of 5 minute cycles through the room decisions for every combination of the swept parameters
+#
+#   python3 benchmarks/run_backtest.py --days 365 --sweep day_offset=-1,0,1 electric_override=true,false
+#   python3 benchmarks/run_backtest.py --recorder /config/recorder.db --settings /config/settings.yaml --sweep away_reductions=0.1/0.2,0.15/0.3
+
+SWEEP_PARAMETERS = (
+    "day_offset", "evening_offset", "night_offset", "electric_override", "away_reductions", "away_long_reduction", "use_model",
+    "room_control", "temperature_deadband", "price_hysteresis", "min_on_minutes", "min_off_minutes",
+)
+
+
+def parse_value(name, setting):
+    # Away reductions are given as shares for each step, 0.1/0.2, keeping the steps' hours
+    if name == "away_reductions":
+        return tuple((hours, float(share)) for (hours, default), share in zip(AWAY_REDUCTIONS, setting.split("/")))
+    return yaml.safe_load(setting)
+
+
+def parse_sweep(values):
+    sweep = {}
+    for value in values or []:
+        name, _, settings = value.partition("=")
+        if name not in SWEEP_PARAMETERS:
+            raise SystemExit(f"Unknown sweep parameter {name}, expected one of {', '.join(SWEEP_PARAMETERS)}")
+        sweep[name] = [parse_value(name=name, setting=setting) for setting in settings.split(",")]
+    return sweep
+
+
+def describe(parameters):
+    return " ".join(f"{name}={'/'.join(str(share) for hours, share in value) if name == 'away_reductions' else value}" for name, value in parameters.items()) or "settings as they are"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the Tado Optimiser room decisions over recorded or synthetic history")
+    parser.add_argument("--settings", default=os.path.join(ROOTFS_DIR, "settings.yaml"), help="Room settings file")
+    parser.add_argument("--recorder", help="Replay this recorder.db instead of a synthetic year")
+    parser.add_argument("--start", help="First day, YYYY-MM-DD, defaults to the recording's start or 1 October last year")
+    parser.add_argument("--days", type=int, default=365, help="Days to replay")
+    parser.add_argument("--latitude", type=float, default=51.5, help="Latitude for sunrise & sunset")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic year")
+    parser.add_argument("--sweep", nargs="*", help=f"Parameter values to try, e.g. day_offset=-1,0,1, from {', '.join(SWEEP_PARAMETERS)}")
+    parser.add_argument("--workers", type=int, help="Processes for the sweep, defaults to one per CPU")
+    parser.add_argument("--output", help="Append one JSON line per run to this file")
+    arguments = parser.parse_args()
+
+    with open(arguments.settings, "r") as file:
+        settings = yaml.safe_load(file)
+    runs = get_runs(sweep=parse_sweep(values=arguments.sweep))
+
+    started = time.perf_counter()
+    start = datetime.strptime(arguments.start, "%Y-%m-%d").timestamp() if arguments.start else None
+    if arguments.recorder:
+        scenario = recorded_scenario(
+            path=arguments.recorder,
+            rooms=settings["rooms"],
+            start=start,
+            end=start + arguments.days * 86400 if start else None,
+            latitude=arguments.latitude,
+        )
+    else:
+        start = start or datetime(datetime.now().year - 1, 10, 1).timestamp()
+        scenario = synthetic_scenario(start=start, days=arguments.days, rooms=settings["rooms"], latitude=arguments.latitude, seed=arguments.seed)
+    print(f"Scenario: {len(scenario.times)} cycles x {len(settings['rooms'])} rooms from {datetime.fromtimestamp(scenario.times[0]):%Y-%m-%d}, built in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    results = run_sweep(scenario=scenario, settings=settings, runs=runs, workers=arguments.workers)
+    print(f"{len(runs)} runs in {time.perf_counter() - started:.1f}s")
+
+    print(f"{'Cost £':>9} {'Gas kWh':>9} {'Elec kWh':>9} {'Deficit °Ch':>12} {'Mean dev':>9} {'Commands':>9} {'Run s':>6}  Parameters")
+    for result in sorted(results, key=lambda result: result["cost_pounds"]):
+        print(f"{result['cost_pounds']:>9.2f} {result['gas_kwh']:>9.1f} {result['electric_kwh']:>9.1f} {result['comfort_deficit_degree_hours']:>12.1f} "
+              f"{result['comfort_mean_deviation']:>9.3f} {result['hvac_commands']:>9} {result['run_seconds']:>6.1f}  {describe(parameters=result['parameters'])}")
+
+        if arguments.output:
+            with open(arguments.output, "a") as file:
+                file.write(json.dumps({"timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"), "source": arguments.recorder or "synthetic", **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOTFS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "rootfs")
+RESULT_MARKER = "BENCHMARK_RESULT "
+
+# Runs the real update cycle against local stand-ins for the supervisor, Octopus & OpenWeather
+# Each house size runs in a fresh process so startup cost & peak RSS are measured per size
+#
+#   python3 benchmarks/run_benchmark.py --rooms 8 50 200 --cycles 10 --output results.jsonl
+#   python3 benchmarks/run_benchmark.py --rooms 100 --latency home_assistant=20 --failure-rate octopus=0.2 --option async_mode=true
+
+
+def parse_pairs(values, convert):
+    pairs = {}
+    for value in values or []:
+        key, _, setting = value.partition("=")
+        pairs[key] = convert(setting)
+    return pairs
+
+
+def parse_option(setting):
+    # Option values are read as YAML scalars so true / 4 / 0.5 come through typed
+    import yaml
+    return yaml.safe_load(setting)
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_request(path):
+    with urllib.request.urlopen(f"{os.environ['BENCH_URL']}{path}") as response:
+        return json.loads(response.read())
+
+
+def run_child():
+    # Imports main (start-up only) and times each cycle
+    sys.path.insert(0, ROOTFS_DIR)
+    import resource
+
+    started = time.perf_counter()
+    import main
+    startup_seconds = time.perf_counter() - started
+
+    cycles = []
+    for _ in range(int(os.environ["BENCH_CYCLES"])):
+        bench_request(path="/_bench/reset")
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        main.main()
+        wall = time.perf_counter() - wall_started
+        cpu = time.process_time() - cpu_started
+        stats = bench_request(path="/_bench/stats")
+        cycles.append({
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(cpu, 4),
+            "requests": sum(service["requests"] for service in stats.values()),
+            "failures": sum(service["failures"] for service in stats.values()),
+            "bytes_in": sum(service["bytes_in"] for service in stats.values()),
+            "bytes_out": sum(service["bytes_out"] for service in stats.values()),
+            "services": stats,
+        })
+
+    result = {
+        "startup_seconds": round(startup_seconds, 4),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "cycles": cycles,
+    }
+    print(RESULT_MARKER + json.dumps(result), flush=True)
+
+
+def summarise(cycles):
+    # First cycle fetches everything & creates entities, the rest show the steady state
+    steady = cycles[1:] or cycles
+    wall = [cycle["wall_seconds"] for cycle in steady]
+    return {
+        "first_cycle_seconds": cycles[0]["wall_seconds"],
+        "first_cycle_requests": cycles[0]["requests"],
+        "wall_mean_seconds": round(statistics.mean(wall), 4),
+        "wall_median_seconds": round(statistics.median(wall), 4),
+        "wall_max_seconds": round(max(wall), 4),
+        "cpu_mean_seconds": round(statistics.mean(cycle["cpu_seconds"] for cycle in steady), 4),
+        "requests_mean": round(statistics.mean(cycle["requests"] for cycle in steady), 2),
+        "bytes_mean": round(statistics.mean(cycle["bytes_in"] + cycle["bytes_out"] for cycle in steady)),
+    }
+
+
+def run_house(rooms, arguments, latency, failure_rate, options):
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from fake_services import FakeServices
+    from houses import build_states, write_settings
+
+    config_dir = tempfile.mkdtemp(prefix=f"tado_bench_{rooms}_")
+    services = FakeServices(states=build_states(rooms=rooms), latency=latency, failure_rate=failure_rate, seed=arguments.seed).start()
+    try:
+        write_settings(path=os.path.join(config_dir, "settings.yaml"), rooms=rooms)
+        options_file = os.path.join(config_dir, "options.json")
+        with open(options_file, "w") as file:
+            json.dump({
+                "log_level": arguments.log_level,
+                "latitude": "51.5",
+                "longitude": "-0.1",
+                "open_weather_api": "bench",
+                "octopus_api": "bench",
+                "octopus_account": "A-BENCH",
+                **options,
+            }, file)
+
+        environment = dict(
+            os.environ,
+            CONFIG_DIR=config_dir,
+            OPTIONS_FILE=options_file,
+            SUPERVISOR_TOKEN="bench",
+            HOME_ASSISTANT_URL=f"{services.url}/core/api",
+            HOME_ASSISTANT_WS_URL=f"{services.url.replace('http', 'ws', 1)}/core/websocket",
+            OCTOPUS_URL=services.url,
+            OPEN_WEATHER_URL=f"{services.url}/data/3.0/onecall?",
+            BENCH_URL=services.url,
+            BENCH_CYCLES=str(arguments.cycles),
+        )
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], env=environment, capture_output=True, text=True)
+        lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        if process.returncode != 0 or not lines:
+            sys.stderr.write(process.stderr[-4000:])
+            raise RuntimeError(f"Benchmark for {rooms} rooms failed with exit code {process.returncode}")
+        return json.loads(lines[-1][len(RESULT_MARKER):])
+    finally:
+        services.stop()
+        if not arguments.keep:
+            shutil.rmtree(config_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Tado Optimiser update cycle against local fake services")
+    parser.add_argument("--rooms", type=int, nargs="+", default=[8, 50, 200], help="House sizes to run")
+    parser.add_argument("--cycles", type=int, default=5, help="Cycles per house, the first includes the initial fetches")
+    parser.add_argument("--latency", nargs="*", help="Added latency in ms per service, e.g. home_assistant=20")
+    parser.add_argument("--failure-rate", nargs="*", help="Share of requests failed with a 503 per service, e.g. octopus=0.2")
+    parser.add_argument("--option", nargs="*", help="Add-on options, e.g. async_mode=true max_concurrency=8")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for failure injection")
+    parser.add_argument("--log-level", default="warning", help="Add-on log level during the run")
+    parser.add_argument("--output", help="Append one JSON line per house size to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep each run's config directory")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        run_child()
+        return
+
+    latency = parse_pairs(values=arguments.latency, convert=float)
+    failure_rate = parse_pairs(values=arguments.failure_rate, convert=float)
+    options = parse_pairs(values=arguments.option, convert=parse_option)
+    commit = get_commit()
+
+    print(f"{'Rooms':>6} {'First s':>8} {'Mean s':>8} {'Max s':>8} {'CPU s':>8} {'Requests':>9} {'KB':>8} {'RSS MB':>7}")
+    for rooms in arguments.rooms:
+        result = run_house(rooms=rooms, arguments=arguments, latency=latency, failure_rate=failure_rate, options=options)
+        summary = summarise(cycles=result["cycles"])
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "rooms": rooms,
+            "cycles": arguments.cycles,
+            "latency_ms": latency,
+            "failure_rate": failure_rate,
+            "options": options,
+            "startup_seconds": result["startup_seconds"],
+            "peak_rss_kb": result["peak_rss_kb"],
+            **summary,
+            "per_cycle": result["cycles"],
+        }
+        print(f"{rooms:>6} {summary['first_cycle_seconds']:>8.3f} {summary['wall_mean_seconds']:>8.3f} {summary['wall_max_seconds']:>8.3f} "
+              f"{summary['cpu_mean_seconds']:>8.3f} {summary['requests_mean']:>9.1f} {summary['bytes_mean'] / 1024:>8.1f} {result['peak_rss_kb'] / 1024:>7.1f}")
+
+        if arguments.output:
+            with open(arguments.output, "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
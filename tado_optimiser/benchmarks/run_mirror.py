@@ -0,0 +1,128 @@
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOTFS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "rootfs")
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, ROOTFS_DIR)
+
+from fake_services import FakeServices  # noqa: E402
+from houses import build_states, room_names  # noqa: E402
+from ha_websocket import StateMirror  # noqa: E402
+from home_assistant_api import HomeAssistantAPI  # noqa: E402
+
+# Kills the WebSocket state mirror's connection to the fake supervisor & checks it reconnects, resyncs the changes it
+# missed while disconnected and has the published entities re-posted in case Home Assistant restarted
+#
+#   python3 benchmarks/run_mirror.py --rooms 50 --drops 5
+
+SENSOR = "sensor.tado_optimiser_bench"
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def get_posts(services):
+    return services.stats["home_assistant"]["requests"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the WebSocket state mirror resyncs after its connection is killed")
+    parser.add_argument("--rooms", type=int, default=50, help="House size")
+    parser.add_argument("--drops", type=int, default=5, help="Connections to kill")
+    parser.add_argument("--reconnect-delay", type=float, default=0.2, help="Mirror's first reconnect delay in seconds")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait for each resync")
+    parser.add_argument("--log-level", default="warning", help="Add-on log level during the run")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, arguments.log_level.upper(), logging.WARNING), format="%(asctime)s %(levelname)s %(message)s")
+
+    states = build_states(rooms=arguments.rooms)
+    services = FakeServices(states=states).start()
+    entity_ids = [entity_id for entity_id in states if entity_id.startswith("climate.")]
+    mirror = StateMirror(
+        entity_ids=entity_ids,
+        url=f"{services.url.replace('http', 'ws', 1)}/core/websocket",
+        token="bench",
+        reconnect_delay=arguments.reconnect_delay,
+    )
+    home_assistant = HomeAssistantAPI(base_url=f"{services.url}/core/api", token="bench")
+    failures = []
+
+    def check(passed, description):
+        print(f"{'ok  ' if passed else 'FAIL'} {description}")
+        if not passed:
+            failures.append(description)
+        return passed
+
+    try:
+        started = time.perf_counter()
+        mirror.start()
+        if not check(passed=mirror.synced.wait(arguments.timeout), description=f"Initial sync of {len(entity_ids)} entities"):
+            raise SystemExit(1)
+        print(f"     in {time.perf_counter() - started:.3f}s")
+        home_assistant.mirror = mirror
+        home_assistant.refresh_states()
+
+        payload = {"state": "on", "attributes": {"rooms": arguments.rooms}}
+        home_assistant.update_entity(sensor=SENSOR, payload=payload)
+        posts = get_posts(services=services)
+        home_assistant.update_entity(sensor=SENSOR, payload=payload)
+        check(passed=get_posts(services=services) == posts, description="Unchanged entity skipped while in sync")
+
+        reconnects = []
+        names = room_names(rooms=arguments.rooms)
+        for drop in range(arguments.drops):
+            entity_id = f"climate.{names[drop % len(names)]}"
+            syncs = mirror.syncs
+
+            # A change while connected arrives as an event
+            services.set_state(entity_id=entity_id, state="heat", attributes={"current_temperature": 20.0 + drop})
+            check(
+                passed=wait_for(condition=lambda: (mirror.get(entity_id=entity_id) or {}).get("attributes", {}).get("current_temperature") == 20.0 + drop, timeout=arguments.timeout),
+                description=f"Drop {drop + 1}: live change to {entity_id} mirrored",
+            )
+
+            # Kill the connection & change the entity while the mirror is away
+            dropped = time.perf_counter()
+            services.drop_websockets()
+            check(passed=wait_for(condition=lambda: not mirror.synced.is_set(), timeout=arguments.timeout), description=f"Drop {drop + 1}: disconnect noticed")
+            services.set_state(entity_id=entity_id, state="off", attributes={"current_temperature": 10.0 + drop})
+
+            resynced = wait_for(condition=lambda: mirror.syncs > syncs and mirror.synced.is_set(), timeout=arguments.timeout)
+            reconnects.append(time.perf_counter() - dropped)
+            check(passed=resynced, description=f"Drop {drop + 1}: resynced in {reconnects[-1]:.3f}s")
+            entity = mirror.get(entity_id=entity_id) or {}
+            check(
+                passed=entity.get("state") == "off" and entity["attributes"].get("current_temperature") == 10.0 + drop,
+                description=f"Drop {drop + 1}: change missed while disconnected picked up",
+            )
+
+            # The next cycle re-posts published entities as Home Assistant may have restarted
+            home_assistant.refresh_states()
+            posts = get_posts(services=services)
+            home_assistant.update_entity(sensor=SENSOR, payload=payload)
+            check(passed=get_posts(services=services) == posts + 1, description=f"Drop {drop + 1}: published entity re-posted")
+
+        print(f"Connections: {services.websocket_connections}, reconnect mean {statistics.mean(reconnects):.3f}s max {max(reconnects):.3f}s")
+    finally:
+        mirror.stop()
+        services.stop()
+
+    if failures:
+        print(f"{len(failures)} checks failed")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOTFS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "rootfs")
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, ROOTFS_DIR)
+
+from fake_services import AGILE_TARIFF, GAS_TARIFF, FakeServices, iso  # noqa: E402
+from home_assistant_api import HomeAssistantAPI  # noqa: E402
+from octopus_api import Octopus  # noqa: E402
+from rate_store import RateStore  # noqa: E402
+from snapshot_store import SnapshotStore  # noqa: E402
+
+# Runs the Octopus rate sync against the fake Octopus, which paginates, and checks each sync only asks for the missing
+# window, follows every page & is scheduled for when prices run out or tomorrow's are published after 16:00
+#
+#   python3 benchmarks/run_octopus.py --page-size 20
+
+
+def get_rate_requests(services, kind):
+    return [query for service, method, path, query in services.requests if service == "octopus" and f"/{kind}-tariffs/" in path]
+
+
+def set_coverage(rate_store, tariff, start, end, last_synced):
+    # Replaces the stored rates with one slot per half hour from start to end, synced at last_synced
+    with rate_store.lock:
+        rate_store.connection.execute("DELETE FROM rates WHERE tariff = ?", (tariff,))
+        rate_store.connection.commit()
+    rate_store.merge(tariff=tariff, results=[
+        {"valid_from": iso(slot_start), "valid_to": iso(slot_start + 1800), "value_inc_vat": 20.0, "payment_method": None}
+        for slot_start in range(int(start), int(end), 1800)
+    ])
+    set_last_synced(rate_store=rate_store, tariff=tariff, last_synced=last_synced)
+
+
+def set_last_synced(rate_store, tariff, last_synced):
+    with rate_store.lock:
+        rate_store.connection.execute("UPDATE syncs SET last_synced = ? WHERE tariff = ?", (last_synced, tariff))
+        rate_store.connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the incremental Octopus rate sync against the fake Octopus")
+    parser.add_argument("--page-size", type=int, default=20, help="Results per page from the fake Octopus")
+    parser.add_argument("--log-level", default="warning", help="Add-on log level during the run")
+    parser.add_argument("--keep", action="store_true", help="Keep the rate store & snapshots")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, arguments.log_level.upper(), logging.WARNING), format="%(asctime)s %(levelname)s %(message)s")
+
+    config_dir = tempfile.mkdtemp(prefix="tado_octopus_")
+    services = FakeServices(states={}, page_size=arguments.page_size).start()
+    os.environ["OCTOPUS_URL"] = services.url
+    rate_store = RateStore(path=os.path.join(config_dir, "rates.db"))
+    octopus = Octopus(
+        octopus_api="bench",
+        octopus_account="A-BENCH",
+        home_assistant=HomeAssistantAPI(base_url=f"{services.url}/core/api", token="bench"),
+        snapshot_store=SnapshotStore(directory=os.path.join(config_dir, "snapshots"), legacy_directory=config_dir),
+        rate_store=rate_store,
+    )
+    failures = []
+
+    def check(passed, description):
+        print(f"{'ok  ' if passed else 'FAIL'} {description}")
+        if not passed:
+            failures.append(description)
+        return passed
+
+    try:
+        # ************************************************************************************************************
+        # First sync: the last day onwards, every page
+
+        services.reset()
+        started = time.time()
+        octopus.update_octopus_data()
+        requests = get_rate_requests(services=services, kind="electricity")
+        first_from = datetime.fromisoformat(requests[0]["period_from"][0].replace("Z", "+00:00")).timestamp() if requests else 0
+        slots = len(rate_store.get_slots(tariff=AGILE_TARIFF, since=0))
+        check(passed=abs(first_from - (started - 86400)) < 60, description=f"First Agile sync from a day ago: {requests[0]['period_from'][0] if requests else None}")
+        check(
+            passed=len(requests) == math.ceil(slots / arguments.page_size) and len(requests) > 1,
+            description=f"First Agile sync followed every page: {len(requests)} requests for {slots} slots",
+        )
+        check(passed=[int(query.get("page", ["1"])[0]) for query in requests] == list(range(1, len(requests) + 1)), description="Pages requested in order")
+        check(passed=len(get_rate_requests(services=services, kind="gas")) == 1, description="Gas synced")
+        coverage_end = rate_store.coverage_end(tariff=AGILE_TARIFF)
+
+        # Straight after, nothing is due
+        services.reset()
+        octopus.update_octopus_data()
+        check(passed=services.stats["octopus"]["requests"] == 0, description="Second cycle makes no Octopus requests")
+
+        # ************************************************************************************************************
+        # Prices about to run out: only the missing window is asked for
+
+        with rate_store.lock:
+            rate_store.connection.execute("DELETE FROM rates WHERE tariff = ? AND valid_from >= ?", (AGILE_TARIFF, time.time() + 1800))
+            rate_store.connection.commit()
+        set_last_synced(rate_store=rate_store, tariff=AGILE_TARIFF, last_synced=time.time() - 3600)
+        latest_start = rate_store.latest_start(tariff=AGILE_TARIFF)
+        kept = len(rate_store.get_slots(tariff=AGILE_TARIFF, since=0))
+
+        services.reset()
+        octopus.update_octopus_data()
+        requests = get_rate_requests(services=services, kind="electricity")
+        check(
+            passed=bool(requests) and requests[0]["period_from"][0] == iso(latest_start),
+            description=f"Incremental sync from the last stored slot: {requests[0]['period_from'][0] if requests else None}",
+        )
+        count = services.agile_rates(query={"period_from": [iso(latest_start)]}, path="")["count"]
+        check(passed=len(requests) == math.ceil(count / arguments.page_size), description=f"Incremental sync followed every page: {len(requests)} requests for {count} slots")
+        check(passed=rate_store.coverage_end(tariff=AGILE_TARIFF) == coverage_end, description="Coverage restored")
+        check(passed=len(rate_store.get_slots(tariff=AGILE_TARIFF, since=0)) == kept + count - 1, description="Stored slots merged without duplicates")
+        check(passed=not get_rate_requests(services=services, kind="gas"), description="Gas not synced again within the day")
+
+        set_last_synced(rate_store=rate_store, tariff=GAS_TARIFF, last_synced=time.time() - 86400)
+        services.reset()
+        octopus.update_octopus_data()
+        check(passed=len(get_rate_requests(services=services, kind="gas")) == 1, description="Gas synced again after a day")
+
+        # ************************************************************************************************************
+        # Schedule: (hour, hours of prices left, minutes since the last sync, sync expected)
+
+        today = datetime.now().astimezone().replace(minute=0, second=0, microsecond=0)
+        schedule = (
+            (10, 0.5, 1, True, "prices run out within the hour, synced a minute ago"),
+            (10, 4, 40, True, "under 5 hours of prices left"),
+            (10, 4, 10, False, "under 5 hours left but synced 10 minutes ago"),
+            (10, 36, 40, False, "morning with prices to tomorrow 22:00"),
+            (15, 8, 120, False, "15:00 with prices to 23:00, tomorrow's not due"),
+            (16, 7, 40, True, "16:00 with prices to 23:00, tomorrow's due"),
+            (17, 6, 10, False, "17:00 still waiting for tomorrow's, synced 10 minutes ago"),
+            (17, 6, 31, True, "17:00 still waiting for tomorrow's, synced 31 minutes ago"),
+            (17, 29, 40, False, "17:00 with tomorrow's prices to 22:00"),
+        )
+        for hour, hours_left, minutes_since, expected, description in schedule:
+            now = today.replace(hour=hour) + timedelta(minutes=1)
+            set_coverage(
+                rate_store=rate_store,
+                tariff=AGILE_TARIFF,
+                start=now.timestamp() - 86400,
+                end=now.timestamp() // 1800 * 1800 + hours_left * 3600,
+                last_synced=now.timestamp() - minutes_since * 60,
+            )
+            check(passed=octopus.agile_needs_sync(now=now) == expected, description=f"{'Sync' if expected else 'No sync'} at {hour:02d}:01, {description}")
+    finally:
+        services.stop()
+        if not arguments.keep:
+            shutil.rmtree(config_dir, ignore_errors=True)
+
+    if failures:
+        print(f"{len(failures)} checks failed")
+        raise SystemExit(1)
+    print(f"All checks passed at {datetime.now(timezone.utc):%H:%M} UTC")
+
+
+if __name__ == "__main__":
+    main()
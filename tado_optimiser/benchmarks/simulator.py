@@ -0,0 +1,453 @@
+import logging
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time as clock_time, timedelta
+from itertools import product
+
+ROOTFS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rootfs")
+sys.path.insert(0, ROOTFS_DIR)
+
+from home import get_grid_status  # noqa: E402
+from hvac_reconciler import HvacReconciler  # noqa: E402
+from planner import DEFAULT_HEAT_RATE, DEFAULT_LOSS_RATE, time_sector_at  # noqa: E402
+from recorder import unscale  # noqa: E402
+from room_control import DEFAULT_LIMITS, RoomControl  # noqa: E402
+from settings_manager import build_room_spec  # noqa: E402
+from tado import Tado  # noqa: E402
+from thermal_model import MIN_UPDATES, RoomModel  # noqa: E402
+
+# Replays weather, prices, grid power & room temperatures through the add-on's room decisions (Tado.away_adjust,
+# Tado.set_hvac_mode, the room control limits & the HVAC reconciler) on a simulated clock, with each room's temperature following its thermal model
+
+STEP_SECONDS = 300
+SECTORS = ("day", "evening", "night")
+
+# The rule based path looks 2 hours ahead, the forecast is taken to be what actually happened
+FORECAST_STEPS = 7200 // STEP_SECONDS
+MINUTES_BEFORE_SUNSET = 60
+
+# Rooms without an electric override don't set a gas radiator power, this one is assumed for their costs
+GAS_RADIATOR_POWER = 1500
+
+# Everything a run needs, one value per cycle in each array
+Scenario = namedtuple("Scenario", [
+    "times",
+    "outside",
+    "outside_max",
+    "outside_mean",
+    "electric_price",
+    "gas_price",
+    "using_grid",
+    "sectors",
+    "away",
+    "start_temperatures",
+    "models",
+])
+
+
+class Clock:
+    # Simulated time handed to the rooms in place of datetime.now
+    def __init__(self, moment=0.0):
+        self.moment = moment
+
+    def now(self):
+        return datetime.fromtimestamp(self.moment)
+
+
+class FakeHomeAssistant:
+    # Climate entities held in memory, service calls change them the way Home Assistant & Tado would
+    def __init__(self):
+        self.states = {}
+        self.calls = 0
+
+    def add_climate(self, entity_id):
+        self.states[entity_id] = {"entity_id": entity_id, "state": "off", "attributes": {"temperature": None}}
+
+    def get_entity(self, sensor):
+        return self.states.get(sensor)
+
+    def set_hvac_mode(self, entity_id, hvac_mode):
+        self.calls += 1
+        for sensor in entity_id:
+            self.states[sensor]["state"] = hvac_mode
+
+    def set_temperature(self, entity_id, temperature, hvac_mode=None):
+        # Tado switches to heat when a temperature is set
+        self.calls += 1
+        for sensor in entity_id:
+            self.states[sensor]["state"] = hvac_mode or "heat"
+            self.states[sensor]["attributes"]["temperature"] = temperature
+
+    def update_entity(self, sensor, payload):
+        pass
+
+
+def get_sun_times(date, latitude):
+    # Approximate local sunrise & sunset, the recorder doesn't keep them and synthetic years need them
+    day_of_year = date.timetuple().tm_yday
+    declination = math.radians(23.44) * math.sin(2 * math.pi * (284 + day_of_year) / 365)
+    cos_hour_angle = -math.tan(math.radians(latitude)) * math.tan(declination)
+    half_day = math.degrees(math.acos(min(max(cos_hour_angle, -1.0), 1.0))) / 15
+    noon = datetime.combine(date, clock_time(12))
+    if time.localtime(noon.timestamp()).tm_isdst > 0:
+        noon += timedelta(hours=1)
+    return (noon - timedelta(hours=half_day)).time(), (noon + timedelta(hours=half_day)).time()
+
+
+def get_window_max(values, steps):
+    # Highest value from each cycle to steps ahead, one pass from the end with a monotonic queue
+    result = array("d", values)
+    window = deque()
+    for index in range(len(values) - 1, -1, -1):
+        while window and values[window[-1]] <= values[index]:
+            window.pop()
+        window.append(index)
+        if window[0] > index + steps:
+            window.popleft()
+        result[index] = values[window[0]]
+    return result
+
+
+def get_window_mean(values, steps):
+    # Mean from each cycle to steps ahead from running totals
+    totals = array("d", [0.0])
+    for value in values:
+        totals.append(totals[-1] + value)
+    count = len(values)
+    return array("d", ((totals[min(index + steps + 1, count)] - totals[index]) / (min(index + steps + 1, count) - index) for index in range(count)))
+
+
+def build_scenario(times, outside, electric_price, gas_price, grid_power, away, start_temperatures, models, latitude):
+    # Works out everything that doesn't depend on the rooms' decisions once, so each run only steps the rooms
+    sectors = array("b")
+    sun_times = {}
+    for moment in times:
+        moment = datetime.fromtimestamp(moment)
+        if moment.date() not in sun_times:
+            sun_times[moment.date()] = get_sun_times(date=moment.date(), latitude=latitude)
+        sunrise, sunset = sun_times[moment.date()]
+        sectors.append(SECTORS.index(time_sector_at(moment=moment, sunrise=sunrise, sunset=sunset, minutes_before_sunset=MINUTES_BEFORE_SUNSET)))
+
+    return Scenario(
+        times=times,
+        outside=outside,
+        outside_max=get_window_max(values=outside, steps=FORECAST_STEPS),
+        outside_mean=get_window_mean(values=outside, steps=FORECAST_STEPS),
+        electric_price=electric_price,
+        gas_price=gas_price,
+        using_grid=array("b", (get_grid_status(grid_power=power)[2] for power in grid_power)),
+        sectors=sectors,
+        away=away,
+        start_temperatures=start_temperatures,
+        models=models,
+    )
+
+
+def synthetic_scenario(start, days, rooms, latitude=51.5, seed=1):
+    # A made-up year: seasonal & daily outside temperatures with weather noise, Agile-like prices peaking 16:00 to 19:00,
+    # solar export on sunny days and two weeks away
+    rng = random.Random(seed)
+    times = array("d", (start + index * STEP_SECONDS for index in range(days * 86400 // STEP_SECONDS)))
+    outside = array("d")
+    electric_price = array("d")
+    gas_price = array("d")
+    grid_power = array("d")
+    away = array("b")
+    away_days = [(int(days * 0.12), 7), (int(days * 0.6), 10)]
+
+    weather = 0.0
+    slot_price = slot_power = None
+    sun_times = {}
+    for index, moment in enumerate(times):
+        moment = datetime.fromtimestamp(moment)
+        day_of_year = moment.timetuple().tm_yday
+        hour = moment.hour + moment.minute / 60
+        if moment.date() not in sun_times:
+            sun_times[moment.date()] = get_sun_times(date=moment.date(), latitude=latitude)
+        sunrise, sunset = sun_times[moment.date()]
+
+        weather = 0.998 * weather + rng.gauss(0, 0.1)
+        outside.append(9 - 7 * math.cos(2 * math.pi * (day_of_year - 25) / 365) + 3 * math.cos(2 * math.pi * (hour - 15) / 24) + weather)
+
+        # Prices & grid flow change every half hour
+        if slot_price is None or moment.minute % 30 == 0:
+            slot_price = 18 + 4 * math.cos(2 * math.pi * (day_of_year - 15) / 365) + rng.gauss(0, 3)
+            if 16 <= hour < 19:
+                slot_price += 12
+            elif 1 <= hour < 6:
+                slot_price -= 8
+            summer = (1 - math.cos(2 * math.pi * (day_of_year - 10) / 365)) / 2
+            if sunrise <= moment.time() < sunset and rng.random() < 0.2 + 0.5 * summer:
+                slot_power = rng.uniform(100, 2500)
+            elif rng.random() < 0.2:
+                slot_power = 0.0
+            else:
+                slot_power = -rng.uniform(100, 1500)
+        electric_price.append(slot_price)
+        gas_price.append(6.5)
+        grid_power.append(slot_power)
+
+        day = index * STEP_SECONDS // 86400
+        away.append(any(first <= day < first + length for first, length in away_days))
+
+    return build_scenario(
+        times=times,
+        outside=outside,
+        electric_price=electric_price,
+        gas_price=gas_price,
+        grid_power=grid_power,
+        away=away,
+        start_temperatures={name: 18.0 for name in rooms},
+        models={},
+        latitude=latitude,
+    )
+
+
+def recorded_scenario(path, rooms, start=None, end=None, latitude=51.5):
+    # Replays the recorder's history on a 5 minute grid, hourly rows fill in before the raw rows start
+    # Rooms' thermal models are fitted from their recorded temperatures & heating
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        raw = connection.execute("SELECT ts, electric_price, gas_price, grid_power, outside FROM cycles ORDER BY ts").fetchall()
+        first_raw = raw[0][0] if raw else None
+        hourly = connection.execute(
+            "SELECT ts, electric_price, gas_price, grid_power, outside FROM cycles_hourly WHERE ? IS NULL OR ts < ? ORDER BY ts",
+            (first_raw, first_raw),
+        ).fetchall()
+        rows = [row for row in hourly + raw if None not in row]
+        if not rows:
+            raise ValueError(f"No recorded cycles in {path}")
+
+        room_ids = dict(connection.execute("SELECT name, id FROM room_names"))
+        histories = {}
+        for name in rooms:
+            if name in room_ids:
+                histories[name] = connection.execute(
+                    "SELECT ts, temperature, heating FROM rooms_hourly WHERE room = ? AND ts < ? "
+                    "UNION ALL SELECT ts, temperature, heating FROM rooms WHERE room = ? ORDER BY ts",
+                    (room_ids[name], first_raw or 0, room_ids[name]),
+                ).fetchall()
+    finally:
+        connection.close()
+
+    stamps = [row[0] for row in rows]
+    first = max(stamps[0], start or stamps[0])
+    last = min(stamps[-1], end or stamps[-1])
+    times = array("d", range(int(first), int(last) + 1, STEP_SECONDS))
+
+    def outside_at(moment):
+        index = bisect_right(stamps, moment) - 1
+        if index < 0:
+            return unscale(rows[0][4])
+        if index + 1 >= len(rows):
+            return unscale(rows[index][4])
+        (before, *_, outside_before), (after, *_, outside_after) = rows[index], rows[index + 1]
+        return unscale(outside_before + (outside_after - outside_before) * (moment - before) / (after - before))
+
+    outside = array("d")
+    electric_price = array("d")
+    gas_price = array("d")
+    grid_power = array("d")
+    for moment in times:
+        row = rows[max(bisect_right(stamps, moment) - 1, 0)]
+        electric_price.append(unscale(row[1]))
+        gas_price.append(unscale(row[2]))
+        grid_power.append(unscale(row[3]))
+        outside.append(outside_at(moment=moment))
+
+    start_temperatures = {}
+    models = {}
+    for name in rooms:
+        readings = [(timestamp, unscale(temperature), unscale(heating)) for timestamp, temperature, heating in histories.get(name, []) if temperature is not None]
+        start_temperatures[name] = next((temperature for timestamp, temperature, heating in readings if timestamp >= first), readings[-1][1] if readings else 18.0)
+        model = RoomModel(loss_rate=DEFAULT_LOSS_RATE, heat_rate=DEFAULT_HEAT_RATE)
+        for timestamp, temperature, heating in readings:
+            model.observe(timestamp=timestamp, inside=temperature, outside=outside_at(moment=timestamp), heating=heating or 0.0)
+        if model.trained:
+            models[name] = (model.loss_rate, model.heat_rate)
+
+    return build_scenario(
+        times=times,
+        outside=outside,
+        electric_price=electric_price,
+        gas_price=gas_price,
+        grid_power=grid_power,
+        away=array("b", bytes(len(times))),
+        start_temperatures=start_temperatures,
+        models=models,
+        latitude=latitude,
+    )
+
+
+def get_room_specs(settings, parameters):
+    # Room specs with a run's parameters applied, validated the same way as settings.yaml
+    specs = []
+    for name, room in settings["rooms"].items():
+        room = dict(room)
+        for sector in SECTORS:
+            if isinstance(room.get(sector), (int, float)):
+                room[sector] += parameters.get(f"{sector}_offset", 0)
+        if not parameters.get("electric_override", True):
+            room["electric_override"] = False
+        specs.append(build_room_spec(name=str(name), room=room))
+    return specs
+
+
+def simulate(scenario, settings, parameters):
+    # Runs every cycle of the scenario for one set of parameters, returning cost, comfort & HVAC commands
+    started = time.perf_counter()
+    logging.getLogger("tado_optimiser").setLevel(logging.WARNING)
+
+    home_assistant = FakeHomeAssistant()
+    reconciler = HvacReconciler(home_assistant=home_assistant)
+    clock = Clock()
+    use_model = parameters.get("use_model", True)
+    limits = DEFAULT_LIMITS._replace(**{name: parameters[name] for name in DEFAULT_LIMITS._fields if name in parameters})
+
+    rooms = []
+    for spec in get_room_specs(settings=settings, parameters=parameters):
+        room = Tado(name=spec.name, reconciler=reconciler, home_assistant=home_assistant, clock=clock.now)
+        room.apply_settings(spec=spec)
+        room.away_reductions = parameters.get("away_reductions", room.away_reductions)
+        room.away_long_reduction = parameters.get("away_long_reduction", room.away_long_reduction)
+        if parameters.get("room_control", True):
+            room.control = RoomControl(limits=limits)
+        home_assistant.add_climate(entity_id=spec.gas_climate_entity)
+        if spec.electric_override:
+            home_assistant.add_climate(entity_id=spec.electric_climate_entity)
+
+        # RoomModel.predict is written out below with the model's rates & decays worked out once per room
+        loss_rate, heat_rate = scenario.models.get(spec.name, (DEFAULT_LOSS_RATE, DEFAULT_HEAT_RATE))
+        model = RoomModel(loss_rate=loss_rate, heat_rate=heat_rate, updates=MIN_UPDATES)
+        gas_power = spec.gas_radiator_power or GAS_RADIATOR_POWER
+        rooms.append({
+            "room": room,
+            "loss_rate": model.loss_rate,
+            "heat_rate": model.heat_rate,
+            "step_decay": math.exp(-model.loss_rate * STEP_SECONDS / 3600),
+            "forecast_decay": math.exp(-model.loss_rate * 2),
+            "temperature": scenario.start_temperatures.get(spec.name, 18.0),
+            "gas": home_assistant.states[spec.gas_climate_entity],
+            "electric": home_assistant.states[spec.electric_climate_entity] if spec.electric_override else None,
+            "gas_kw": gas_power / 1000,
+            "electric_kw": (spec.electric_radiator_power or 0) / 1000,
+            "electric_level": (spec.electric_radiator_power or 0) / gas_power,
+            "gas_kwh": 0.0,
+            "electric_kwh": 0.0,
+            "cost": 0.0,
+            "deficit": 0.0,
+            "deviation": 0.0,
+            "home_hours": 0.0,
+        })
+
+    times = scenario.times
+    hours = STEP_SECONDS / 3600
+    for index in range(len(times)):
+        clock.moment = times[index]
+        sector = SECTORS[scenario.sectors[index]]
+        away = scenario.away[index]
+        outside = scenario.outside[index]
+        electric_price = scenario.electric_price[index]
+        gas_price = scenario.gas_price[index]
+
+        # Decisions, exactly as a cycle makes them
+        for state in rooms:
+            room = state["room"]
+            room.current_temperature = state["temperature"]
+            room.tado_mode = "AWAY" if away else "HOME"
+            target_temperature = getattr(room, sector)
+            target_temperature -= room.away_adjust(target_temperature=target_temperature)
+            predicted_temperature = None
+            if use_model:
+                outside_mean = scenario.outside_mean[index]
+                predicted_temperature = outside_mean + (room.current_temperature - outside_mean) * state["forecast_decay"]
+            room.set_hvac_mode(
+                target_temperature=target_temperature,
+                outside_max=scenario.outside_max[index],
+                electric_price=electric_price,
+                gas_price=gas_price,
+                using_grid=bool(scenario.using_grid[index]),
+                predicted_temperature=predicted_temperature,
+            )
+        reconciler.apply()
+
+        # Each room's thermostat heats until its setpoint for the rest of the cycle
+        for state in rooms:
+            temperature = state["temperature"]
+            gas, electric = state["gas"], state["electric"]
+            level = 0.0
+            if gas["state"] == "heat" and temperature < gas["attributes"]["temperature"]:
+                level = 1.0
+                state["gas_kwh"] += state["gas_kw"] * hours
+                state["cost"] += state["gas_kw"] * hours * gas_price
+            if electric is not None and electric["state"] == "heat" and temperature < electric["attributes"]["temperature"]:
+                level += state["electric_level"]
+                state["electric_kwh"] += state["electric_kw"] * hours
+                state["cost"] += state["electric_kw"] * hours * electric_price
+            equilibrium = outside + state["heat_rate"] * level / state["loss_rate"]
+            state["temperature"] = equilibrium + (temperature - equilibrium) * state["step_decay"]
+
+            # Comfort is measured against the schedule while someone is home
+            if not away:
+                error = getattr(state["room"], sector) - temperature
+                state["deficit"] += max(error, 0.0) * hours
+                state["deviation"] += abs(error) * hours
+                state["home_hours"] += hours
+
+    home_hours = sum(state["home_hours"] for state in rooms) or 1.0
+    return {
+        "parameters": parameters,
+        "days": round(len(times) * STEP_SECONDS / 86400, 1),
+        "cost_pounds": round(sum(state["cost"] for state in rooms) / 100, 2),
+        "gas_kwh": round(sum(state["gas_kwh"] for state in rooms), 1),
+        "electric_kwh": round(sum(state["electric_kwh"] for state in rooms), 1),
+        "comfort_deficit_degree_hours": round(sum(state["deficit"] for state in rooms), 1),
+        "comfort_mean_deviation": round(sum(state["deviation"] for state in rooms) / home_hours, 3),
+        "hvac_commands": home_assistant.calls,
+        "switches": sum(state["room"].control.switches for state in rooms if state["room"].control is not None),
+        "rooms": {
+            state["room"].name: {
+                "cost_pounds": round(state["cost"] / 100, 2),
+                "comfort_deficit_degree_hours": round(state["deficit"], 1),
+            }
+            for state in rooms
+        },
+        "run_seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def get_runs(sweep):
+    # Every combination of the swept parameters, {name: [values]} to a list of {name: value}
+    names = list(sweep)
+    return [dict(zip(names, values)) for values in product(*(sweep[name] for name in names))] or [{}]
+
+
+worker_scenario = None
+worker_settings = None
+
+
+def start_worker(scenario, settings):
+    # Each worker process receives the scenario once rather than with every run
+    global worker_scenario, worker_settings
+    worker_scenario = scenario
+    worker_settings = settings
+
+
+def run_worker(parameters):
+    return simulate(scenario=worker_scenario, settings=worker_settings, parameters=parameters)
+
+
+def run_sweep(scenario, settings, runs, workers=None):
+    # Runs are independent so they spread over a process pool, one run goes straight through
+    if len(runs) == 1 or workers == 1:
+        return [simulate(scenario=scenario, settings=settings, parameters=parameters) for parameters in runs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(scenario, settings)) as executor:
+        return list(executor.map(run_worker, runs))
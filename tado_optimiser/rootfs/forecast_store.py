@@ -0,0 +1,179 @@
+import logging
+import math
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+
+logger = logging.getLogger("tado_optimiser")
+
+NAN = float("nan")
+
+
+def flatten(row):
+    # One forecast row as flat columns: {"temp": {"day": 5}} becomes temp_day, rain {"1h": 0.2} rain_1h & weather[0] weather_id / _main / _description
+    flat = {}
+    for key, value in row.items():
+        if key == "weather":
+            condition = value[0] if value else {}
+            flat["weather_id"] = condition.get("id")
+            flat["weather_main"] = condition.get("main")
+            flat["weather_description"] = condition.get("description")
+        elif isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                flat[f"{key}_{sub_key}"] = sub_value
+        else:
+            flat[key] = value
+    return flat
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Series:
+    # One forecast block held column by column, numbers in float arrays with NaN for missing values, rows in time order
+    def __init__(self, columns, text, integers=()):
+        self.columns = columns
+        self.text = text
+        self.times = columns.get("dt", array("d"))
+
+        # Columns whose values were all whole numbers (ids, humidity, timestamps), given back as ints
+        self.integers = frozenset(integers)
+
+    @classmethod
+    def from_rows(cls, rows):
+        flat = [flatten(row=row) for row in rows]
+        columns = {}
+        text = {}
+        integers = []
+        for name in sorted({name for row in flat for name in row}):
+            values = [row.get(name) for row in flat]
+            if all(value is None or is_number(value) for value in values):
+                columns[name] = array("d", (NAN if value is None else value for value in values))
+                if all(value is None or isinstance(value, int) for value in values):
+                    integers.append(name)
+            else:
+                text[name] = tuple(values)
+        return cls(columns=columns, text=text, integers=integers)
+
+    @classmethod
+    def from_snapshot(cls, data):
+        columns = {name: array("d", (NAN if value is None else value for value in values)) for name, values in data["columns"].items()}
+        return cls(columns=columns, text={name: tuple(values) for name, values in data["text"].items()}, integers=data.get("integers", ()))
+
+    def to_snapshot(self):
+        return {
+            "columns": {name: [None if math.isnan(value) else value for value in values] for name, values in self.columns.items()},
+            "text": {name: list(values) for name, values in self.text.items()},
+            "integers": sorted(self.integers),
+        }
+
+    def __len__(self):
+        return len(self.times)
+
+    def get(self, name, index, default=None):
+        # Value of a column in one row, default if the column, row or value is missing
+        if name in self.columns:
+            values = self.columns[name]
+            if 0 <= index < len(values) and not math.isnan(values[index]):
+                return int(values[index]) if name in self.integers else values[index]
+            return default
+        values = self.text.get(name, ())
+        if 0 <= index < len(values) and values[index] is not None:
+            return values[index]
+        return default
+
+    def interpolate(self, name, moment):
+        # Linear between the rows either side of moment, held at the first & last row outside the forecast
+        values = self.columns.get(name)
+        if values is None or not len(self.times):
+            return None
+        index = bisect_right(self.times, moment)
+        if index == 0:
+            value = values[0]
+        elif index == len(self.times):
+            value = values[-1]
+        else:
+            before, after = index - 1, index
+            start, end = self.times[before], self.times[after]
+            if math.isnan(values[before]) or math.isnan(values[after]):
+                value = values[after] if math.isnan(values[before]) else values[before]
+            else:
+                value = values[before] + (values[after] - values[before]) * (moment - start) / (end - start)
+        return None if math.isnan(value) else value
+
+    def window(self, name, start, end):
+        # (time, value) pairs from start to end: the interpolated ends plus every row in between
+        points = [(start, self.interpolate(name=name, moment=start))]
+        values = self.columns.get(name)
+        if values is not None:
+            for index in range(bisect_right(self.times, start), bisect_right(self.times, end)):
+                if self.times[index] < end and not math.isnan(values[index]):
+                    points.append((self.times[index], values[index]))
+        points.append((end, self.interpolate(name=name, moment=end)))
+        return [(moment, value) for moment, value in points if value is not None]
+
+    def minimum(self, name, start, end):
+        return min((value for moment, value in self.window(name=name, start=start, end=end)), default=None)
+
+    def maximum(self, name, start, end):
+        return max((value for moment, value in self.window(name=name, start=start, end=end)), default=None)
+
+    def mean(self, name, start, end):
+        # Time-weighted mean of the interpolated curve over the window
+        points = self.window(name=name, start=start, end=end)
+        if not points:
+            return None
+        span = points[-1][0] - points[0][0]
+        if span <= 0:
+            return points[0][1]
+        return sum((later_moment - moment) * (value + later_value) / 2 for (moment, value), (later_moment, later_value) in zip(points, points[1:])) / span
+
+
+class ForecastStore:
+    # The One Call forecast converted once per fetch: the current conditions plus hourly & daily blocks as columns
+    def __init__(self, current, hourly, daily):
+        self.current = current
+        self.hourly = hourly
+        self.daily = daily
+
+    @classmethod
+    def from_response(cls, data):
+        return cls(current=flatten(row=data["current"]), hourly=Series.from_rows(rows=data.get("hourly", [])), daily=Series.from_rows(rows=data.get("daily", [])))
+
+    @classmethod
+    def from_snapshot(cls, data):
+        return cls(current=data["current"], hourly=Series.from_snapshot(data=data["hourly"]), daily=Series.from_snapshot(data=data["daily"]))
+
+    def to_snapshot(self):
+        return {"current": self.current, "hourly": self.hourly.to_snapshot(), "daily": self.daily.to_snapshot()}
+
+    def get_current(self, name, default=None):
+        value = self.current.get(name)
+        return default if value is None else value
+
+    def temperature_at(self, moment):
+        # Outside temperature at any time, the current reading if the hourly forecast is missing
+        temperature = self.hourly.interpolate(name="temp", moment=moment)
+        return self.current["temp"] if temperature is None else temperature
+
+    def get_sun_times(self, date=None):
+        # (sunrise, sunset) times for a date from the daily forecast, today's from the current conditions if it isn't covered
+        if date is not None:
+            for index in range(len(self.daily)):
+                if datetime.fromtimestamp(self.daily.get(name="dt", index=index)).date() == date:
+                    return datetime.fromtimestamp(self.daily.get(name="sunrise", index=index)).time(), datetime.fromtimestamp(self.daily.get(name="sunset", index=index)).time()
+        return datetime.fromtimestamp(self.current["sunrise"]).time(), datetime.fromtimestamp(self.current["sunset"]).time()
+
+
+def load_forecast(data):
+    # A snapshot in either form, the raw One Call response saved by earlier versions or a converted store
+    if not data:
+        return None
+    try:
+        if isinstance(data.get("hourly"), list):
+            return ForecastStore.from_response(data=data)
+        return ForecastStore.from_snapshot(data=data)
+    except (KeyError, TypeError, ValueError) as error:
+        logger.error(msg=f"Weather data unusable, ignoring it: {error}")
+        return None
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import threading
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+logger = logging.getLogger("tado_optimiser")
+
+
+class StateMirror:
+    # Keeps an in-memory copy of the watched entities up to date from the Home Assistant WebSocket API
+    def __init__(self, entity_ids, url=None, token=None, reconnect_delay=5, max_reconnect_delay=300):
+        self.url = url or os.getenv("HOME_ASSISTANT_WS_URL", "ws://supervisor/core/websocket")
+        self.token = token or os.getenv("SUPERVISOR_TOKEN")
+        self.entity_ids = set(entity_ids)
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.states = {}
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.stop_event = threading.Event()
+        self.connection = None
+        self.thread = None
+        self.message_id = 0
+
+        # Counts full syncs so readers can tell the mirror has been rebuilt since they last looked
+        self.syncs = 0
+
+    def start(self):
+        if websocket is None:
+            logger.warning(msg="websocket-client not installed, WebSocket state mirror disabled")
+            return False
+
+        self.thread = threading.Thread(target=self.run, name="state_mirror", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        self.close()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def close(self):
+        # Aborts the socket so the listening thread wakes up straight away
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.abort()
+            except Exception as error:
+                logger.debug(msg=f"Error closing WebSocket: {error}")
+
+    def get(self, entity_id):
+        with self.lock:
+            return self.states.get(entity_id)
+
+    def watch(self, entity_ids):
+        # Changes the watched entities, reconnecting so the subscription and mirror are rebuilt
+        entity_ids = set(entity_ids)
+        if entity_ids == self.entity_ids:
+            return
+        logger.info(msg=f"State mirror watching {len(entity_ids)} entities, resubscribing")
+        self.entity_ids = entity_ids
+        self.close()
+
+    def run(self):
+        # Connects, listens and reconnects with exponential backoff until stopped
+        delay = self.reconnect_delay
+        while not self.stop_event.is_set():
+            try:
+                self.listen()
+            except Exception as error:
+                logger.warning(msg=f"State mirror disconnected: {error}")
+            finally:
+                # Start the backoff again if the connection got as far as a full sync
+                if self.synced.is_set():
+                    delay = self.reconnect_delay
+                self.synced.clear()
+                self.connection = None
+
+            if self.stop_event.is_set():
+                break
+            logger.info(msg=f"State mirror reconnecting in {delay} seconds")
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def send(self, message):
+        self.message_id += 1
+        message["id"] = self.message_id
+        self.connection.send(json.dumps(message))
+        return self.message_id
+
+    def listen(self):
+        self.connection = websocket.create_connection(self.url, timeout=60)
+
+        # Authentication
+        message = json.loads(self.connection.recv())
+        if message["type"] == "auth_required":
+            self.connection.send(json.dumps({"type": "auth", "access_token": self.token}))
+            message = json.loads(self.connection.recv())
+        if message["type"] != "auth_ok":
+            raise ConnectionError(f"WebSocket authentication failed: {message.get('message', message['type'])}")
+
+        # The first event on the subscription holds the full state of every watched entity
+        self.message_id = 0
+        subscription_id = self.send({"type": "subscribe_entities", "entity_ids": sorted(self.entity_ids)})
+        logger.info(msg=f"State mirror connected, subscribed to {len(self.entity_ids)} entities")
+
+        while not self.stop_event.is_set():
+            try:
+                raw = self.connection.recv()
+            except websocket.WebSocketTimeoutException:
+                # Nothing has changed for a while, make sure the connection is still alive
+                self.send({"type": "ping"})
+                continue
+
+            if not raw:
+                raise ConnectionError("WebSocket closed by server")
+
+            message = json.loads(raw)
+            if message["type"] == "result" and message["id"] == subscription_id and not message["success"]:
+                raise ConnectionError(f"Subscription failed: {message.get('error')}")
+            elif message["type"] == "event" and message["id"] == subscription_id:
+                self.apply_event(event=message["event"])
+
+    def apply_event(self, event):
+        # Applies a compressed subscribe_entities event: "a" added, "c" changed, "r" removed
+        with self.lock:
+            if not self.synced.is_set():
+                # Full resync after (re)connecting
+                self.states = {}
+
+            for entity_id, data in event.get("a", {}).items():
+                self.states[entity_id] = {
+                    "entity_id": entity_id,
+                    "state": data["s"],
+                    "attributes": data.get("a", {}),
+                    "last_changed": data.get("lc"),
+                    "last_updated": data.get("lu", data.get("lc")),
+                }
+
+            for entity_id, change in event.get("c", {}).items():
+                entity = self.states.get(entity_id)
+                if entity is None:
+                    continue
+                entity = dict(entity, attributes=dict(entity["attributes"]))
+                added = change.get("+", {})
+                if "s" in added:
+                    entity["state"] = added["s"]
+                if "lc" in added:
+                    entity["last_changed"] = added["lc"]
+                    entity["last_updated"] = added["lc"]
+                if "lu" in added:
+                    entity["last_updated"] = added["lu"]
+                entity["attributes"].update(added.get("a", {}))
+                for attribute in change.get("-", {}).get("a", []):
+                    entity["attributes"].pop(attribute, None)
+                self.states[entity_id] = entity
+
+            for entity_id in event.get("r", []):
+                self.states.pop(entity_id, None)
+
+        if not self.synced.is_set():
+            self.syncs += 1
+            self.synced.set()
+            logger.info(msg=f"State mirror in sync: {len(self.states)} entities")
@@ -0,0 +1,657 @@
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import log_group
+import tracing
+from hvac_reconciler import HvacReconciler
+from planner import DEFAULT_HEAT_RATE, DEFAULT_LOSS_RATE, build_horizon, time_sector_at
+from recorder import Recorder
+from resilience import check_staleness
+from room_control import DEFAULT_LIMITS, ControlLimits, RoomControls
+from settings_manager import SettingsManager
+from snapshot_store import SnapshotStore
+from tado import Tado
+from thermal_model import ThermalModels
+
+logger = logging.getLogger("tado_optimiser")
+
+# Snapshots kept by each home, anything else in its snapshot directory is removed by compaction
+SNAPSHOTS = ("weather", "account", "thermal_models", "room_control")
+
+
+def get_grid_status(grid_power):
+    # (grid power, status, using grid) from the inverter's grid power in watts, small flows count as no activity
+    if grid_power <= -35:
+        return grid_power, "Importing", True
+    elif grid_power >= 35:
+        return grid_power, "Exporting", False
+    return 0, "No Grid Activity", False
+
+
+def log_line_break():
+    logger.info(msg="***************************************************************************************", extra={"banner": True})
+
+
+class Home:
+    # One house: its Home Assistant, rooms, history & learnt models, controlled once per cycle
+    def __init__(self, name, data_dir, home_assistant, weather, octopus, planner, options, snapshot_store=None, label=""):
+        self.name = name
+        self.data_dir = data_dir
+        self.label = label
+        self.home_assistant = home_assistant
+        self.weather = weather
+        self.octopus = octopus
+        self.planner = planner
+        self.snapshot_store = snapshot_store or SnapshotStore(directory=f"{data_dir}/snapshots", legacy_directory=data_dir)
+
+        self.async_mode = options.get("async_mode", False)
+        self.max_concurrency = options.get("max_concurrency", 4)
+        self.horizon_planner = options.get("horizon_planner", False)
+        self.planner_horizon_hours = options.get("planner_horizon_hours", 36)
+        self.shadow_plans = options.get("shadow_plans", False)
+        self.minutes_before_sunset = options.get("minutes_before_sunset", 60)
+
+        # Check & load settings
+        self.copy_settings_file()
+        self.settings_manager = SettingsManager(path=f"{data_dir}/settings.yaml")
+
+        # Initialise HVAC reconciler, history, thermal models & all thermostats
+        self.hvac_reconciler = HvacReconciler(home_assistant=home_assistant)
+        self.recorder = Recorder(path=f"{data_dir}/recorder.db", cycle_minutes=options.get("cycle_minutes", 5))
+        self.thermal_models = ThermalModels(snapshot_store=self.snapshot_store, default_loss_rate=DEFAULT_LOSS_RATE, default_heat_rate=DEFAULT_HEAT_RATE)
+        self.room_controls = RoomControls(snapshot_store=self.snapshot_store, limits=ControlLimits(
+            temperature_deadband=options.get("temperature_deadband", DEFAULT_LIMITS.temperature_deadband),
+            price_hysteresis=options.get("price_hysteresis", DEFAULT_LIMITS.price_hysteresis),
+            min_on_minutes=options.get("min_on_minutes", DEFAULT_LIMITS.min_on_minutes),
+            min_off_minutes=options.get("min_off_minutes", DEFAULT_LIMITS.min_off_minutes),
+        ))
+        self.thermostats = []
+
+        # Last cycle's context & outcome, for the status API
+        self.context = None
+        self.last_started = None
+        self.last_duration = None
+        self.last_error = None
+
+    def copy_settings_file(self):
+        if not os.path.exists(f"{self.data_dir}/settings.yaml"):
+            shutil.copy(src="/settings.yaml", dst=f"{self.data_dir}/settings.yaml")
+            logger.info(msg=f"Copied settings file to {self.data_dir}")
+        else:
+            logger.info(msg=f"Settings file already exists in {self.data_dir}")
+
+    def start(self, websocket_mirror=False, websocket_url=None, bootstrap=True):
+        # Starts the optional WebSocket state mirror & loads the rooms, a warm start fits the thermal models later
+        self.snapshot_store.compact(keep=SNAPSHOTS)
+        if websocket_mirror:
+            # Imported here as websocket-client is only needed with the mirror on
+            from ha_websocket import StateMirror
+            state_mirror = StateMirror(entity_ids=self.get_watched_entities(rooms=self.settings_manager.get_rooms()), url=websocket_url, token=self.home_assistant.token)
+            if state_mirror.start():
+                self.home_assistant.mirror = state_mirror
+        self.sync_thermostats()
+        if bootstrap:
+            self.bootstrap()
+
+    def bootstrap(self):
+        # Fits thermal models for rooms without one from Home Assistant's history
+        self.thermal_models.bootstrap(home_assistant=self.home_assistant, rooms=self.settings_manager.rooms, outside_sensor="sensor.tado_optimiser_current")
+
+    def stop(self):
+        if self.home_assistant.mirror is not None:
+            self.home_assistant.mirror.stop()
+
+    def compact(self):
+        # Clears out old snapshots & history, run once a day
+        self.snapshot_store.compact(keep=SNAPSHOTS)
+        self.recorder.compact()
+
+    def get_time_sector(self, sunrise, sunset):
+        return time_sector_at(moment=datetime.now(), sunrise=sunrise, sunset=sunset, minutes_before_sunset=self.minutes_before_sunset)
+
+    def get_radiator_flow_temp(self, outside_temp):
+        if outside_temp <= 0:
+            flow_temperature = 75
+        elif outside_temp >= 10:
+            flow_temperature = 50
+        else:
+            flow_temperature = 75 - (outside_temp * 2.5)
+
+        logger.info(msg=f"Suggested Flow Temperature: {flow_temperature:.2f}")
+
+        # Create / update flow temperature entity
+        sensor = "sensor.radiator_flow_temperature"
+        payload = {
+            "state": round(flow_temperature, 2),
+            "attributes": {
+                "unit_of_measurement": "°C",
+                "friendly_name": "Radiator Flow Temperature",
+                "icon": "mdi:thermometer",
+            }
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
+
+    def get_watched_entities(self, rooms):
+        # Every entity the control cycle reads from Home Assistant
+        entity_ids = {"sensor.home_solar_percentage", "sensor.givtcp_fd2327g123_grid_power", "predbat.status"}
+        for spec in rooms.values():
+            entity_ids.add(spec.gas_climate_entity)
+            entity_ids.update(entity_id for attribute, entity_id in spec.tado_entities)
+            if spec.electric_override:
+                entity_ids.add(spec.electric_climate_entity)
+        return entity_ids
+
+    def sync_thermostats(self):
+        # Reloads settings if the file changed and adds / removes rooms to match
+        if not self.settings_manager.reload_if_changed():
+            return
+
+        rooms = self.settings_manager.rooms
+        existing = {room.name: room for room in self.thermostats}
+        self.thermostats.clear()
+        for name, spec in rooms.items():
+            room = existing.get(name) or Tado(name=name, reconciler=self.hvac_reconciler, home_assistant=self.home_assistant)
+            room.apply_settings(spec=spec)
+            room.control = self.room_controls.get(name=name)
+            self.thermostats.append(room)
+
+        self.planner.forget(names=rooms)
+
+        if self.home_assistant.mirror is not None:
+            self.home_assistant.mirror.watch(entity_ids=self.get_watched_entities(rooms=rooms))
+
+    def run_phase(self, name, function, **kwargs):
+        # Runs one phase of the cycle, timing it for the cycle trace
+        with tracing.phase(name=f"{self.label}{name}"):
+            return function(**kwargs)
+
+    def update_sources(self, cached=False):
+        # Reads all Home Assistant states once for this cycle
+        self.run_phase(name="states", function=self.home_assistant.refresh_states)
+
+        # A warm start uses the saved weather & prices as they are, fetching them is left to the next cycle
+        if cached:
+            self.run_phase(name="weather", function=self.weather.load_cached)
+            self.run_phase(name="octopus", function=self.octopus.load_cached)
+            return
+
+        # Updates weather data and entities
+        self.run_phase(name="weather", function=self.weather.update_weather_data)
+
+        # Updates Octopus data and entities
+        self.run_phase(name="octopus", function=self.octopus.update_octopus_data)
+
+    def get_data_ages(self):
+        return {"weather": self.weather.get_data_age(), **self.octopus.get_data_ages()}
+
+    def publish_data_age(self):
+        # Records how old each data source is so it's visible when the cycle is running on cached data
+        ages = self.get_data_ages()
+        stale = check_staleness(ages=ages)
+
+        # Create / update data age entity
+        sensor = "sensor.tado_optimiser_data_age"
+        attributes = {
+            "friendly_name": "Tado Optimiser Data Age",
+            "icon": "mdi:clock-alert-outline",
+            "OpenWeather circuit": self.weather.breaker.describe(),
+            "Octopus circuit": self.octopus.breaker.describe(),
+        }
+        for source, age in ages.items():
+            attributes[f"{source.capitalize()} age (minutes)"] = None if age is None else round(age / 60)
+        if self.weather.budget is not None:
+            attributes["OpenWeather calls left today"] = self.weather.budget.get_remaining()
+        attributes["Weather refresh (minutes)"] = round(self.weather.get_refresh_interval() / 60)
+        payload = {
+            "state": "Stale" if stale else "OK",
+            "attributes": attributes,
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
+
+    def get_cycle_context(self):
+        forecast = self.weather.forecast
+
+        # Without weather data the rooms can't be controlled this cycle
+        if forecast is None:
+            logger.error(msg="No weather data available, skipping room control this cycle")
+            return None
+
+        # Get Sunrise & current weather conditions
+        sunrise, sunset = forecast.get_sun_times()
+        current_weather_id = forecast.get_current(name="weather_id")
+        current_weather_condition = forecast.get_current(name="weather_description", default="").capitalize()
+        solar_percentage = self.home_assistant.get_entity_state(sensor="sensor.home_solar_percentage")
+
+        # Gets Electricity and gas prices, without both the electric override can't be costed
+        electric_slot = self.octopus.get_current_electricity_price(offset=0)
+        gas_price = self.octopus.get_current_gas_price()
+        prices_available = electric_slot is not None and gas_price is not None
+        if prices_available:
+            electric_price, time_from, time_to = electric_slot
+            electric_price = float(electric_price)
+            gas_price = float(gas_price)
+            logger.info(msg=f"Electricity Price: {electric_price} - {time_from[11:16]} ~ {time_to[11:16]} | Gas Price: {gas_price}")
+        else:
+            electric_price = 0.0
+            gas_price = 0.0
+            logger.error(msg="Electricity or gas price not available, Electric Override disabled this cycle")
+
+        # Check if system is using the Grid & Predbat Status
+        grid_power = self.home_assistant.get_entity_state(sensor="sensor.givtcp_fd2327g123_grid_power")
+        predbat_status = self.home_assistant.get_entity_state(sensor="predbat.status")
+
+        if grid_power == "Entity not found":
+            logger.error(msg="Grid Power entity not found")
+            using_grid = False
+            grid_status = "No Grid Data"
+        else:
+            grid_power, grid_status, using_grid = get_grid_status(grid_power=float(grid_power))
+
+        logger.info(msg=f"Grid Power: {grid_power} watts | Grid Status: {grid_status} | Predbat Status: {predbat_status}")
+        using_grid = using_grid and prices_available
+
+        # Calculates time sector, the forecast is refreshed sooner when it's close to a room's target
+        time_sector = self.get_time_sector(sunrise=sunrise, sunset=sunset)
+        self.weather.thresholds = tuple(getattr(room, time_sector) for room in self.thermostats)
+
+        # Calculate radiator flow temperature
+        self.get_radiator_flow_temp(outside_temp=forecast.get_current(name="temp"))
+
+        # Outside temperatures now & over the next 2 hours, interpolated so they don't depend on when in the hour the forecast was fetched
+        now = time.time()
+        temp_hour_0 = forecast.temperature_at(moment=now)
+        temp_hour_1 = forecast.temperature_at(moment=now + 3600)
+        temp_hour_2 = forecast.temperature_at(moment=now + 7200)
+        outside_max = forecast.hourly.maximum(name="temp", start=now, end=now + 7200)
+        outside_mean = forecast.hourly.mean(name="temp", start=now, end=now + 7200)
+
+        # Prices & forecast for every half-hour of the planning horizon, shared by all rooms
+        horizon = ()
+        if prices_available:
+            horizon = tuple(build_horizon(
+                prices=self.octopus.get_price_horizon(hours=self.planner_horizon_hours),
+                forecast=forecast,
+                minutes_before_sunset=self.minutes_before_sunset,
+            ))
+
+        return {
+            "sunrise": sunrise,
+            "sunset": sunset,
+            "current_weather_id": current_weather_id,
+            "current_weather_condition": current_weather_condition,
+            "solar_percentage": solar_percentage,
+            "electric_price": electric_price,
+            "gas_price": gas_price,
+            "using_grid": using_grid,
+            "grid_power": grid_power if isinstance(grid_power, (int, float)) else None,
+            "time_sector": time_sector,
+            "temp_hour_0": temp_hour_0,
+            "temp_hour_1": temp_hour_1,
+            "temp_hour_2": temp_hour_2,
+            "outside_max": temp_hour_0 if outside_max is None else outside_max,
+            "outside_mean": temp_hour_0 if outside_mean is None else outside_mean,
+            "horizon": horizon,
+        }
+
+    def record_cycle(self, context):
+        # Keeps this cycle's prices, grid state & every room's reading and decision
+        rooms = []
+        for room in self.thermostats:
+            if room.current_temperature is None or room.decision is None:
+                continue
+            rooms.append((room.name, room.current_temperature, room.target_temperature, room.decision, room.get_heating_level()))
+        try:
+            self.recorder.record_cycle(
+                electric_price=context["electric_price"],
+                gas_price=context["gas_price"],
+                grid_power=context["grid_power"],
+                using_grid=context["using_grid"],
+                outside=self.weather.forecast.get_current(name="temp"),
+                rooms=rooms,
+            )
+        except sqlite3.Error as error:
+            logger.error(msg=f"Error recording cycle: {error}")
+
+    def get_early_start_target(self, room, model, context, target_temperature, target_offset, outside_temperature):
+        # Heats towards the next period's target early if the room would otherwise not be warm in time
+        for slot in context["horizon"][1:]:
+            next_target = getattr(room, slot.time_sector) - target_offset
+            if next_target == target_temperature:
+                continue
+            if next_target < target_temperature:
+                break
+
+            minutes_until = (slot.start - time.time()) / 60
+            minutes_needed = model.minutes_to_target(inside=room.current_temperature, target=next_target, outside=outside_temperature)
+            if minutes_needed is not None and minutes_needed >= minutes_until:
+                logger.info(msg=f"Early start: {minutes_needed:.0f} minutes needed to reach {next_target:.2f} by {datetime.fromtimestamp(slot.start).strftime('%H:%M')}")
+                return next_target
+            break
+        return target_temperature
+
+    def publish_plan(self, room, plan):
+        # Create / update heating plan entity, the next 24 hours are listed as "HH:MM action temperature"
+        sensor = f"sensor.{room.name}_heating_plan"
+        first = plan.slots[0]
+        payload = {
+            "state": first.action.capitalize(),
+            "attributes": {
+                "friendly_name": f"{room.name.replace('_', ' ').title()} Heating Plan",
+                "icon": "mdi:calendar-clock",
+                "Setpoint": plan.setpoint,
+                "Predicted temperature": first.temperature,
+                "Plan cost (p)": plan.cost,
+                "Following plan": self.horizon_planner,
+                "Slots": [f"{datetime.fromtimestamp(slot.start).strftime('%H:%M')} {slot.action} {slot.temperature:.1f}" for slot in plan.slots[:48]],
+            }
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
+
+    def control_room(self, room, context):
+        logger.info(msg=room.spec.display_name)
+
+        # Refresh data, the decision is cleared so a failed room isn't recorded with an old one
+        room.decision = None
+        room.update_tado_data()
+
+        # Get target room temperature
+        target_temperature = getattr(room, context["time_sector"])
+
+        # Log initial entries
+        logger.info(msg=f"Temperature: {room.current_temperature:.2f} | Climate: {room.climate_gas.upper()} | Mode: {room.tado_mode.upper()} | Electric Override: {str(room.electric_override).upper()}")
+        logger.info(msg=f"Outside Temperatures now, in 1 & 2 hours: {context['temp_hour_0']:.2f} | {context['temp_hour_1']:.2f} | {context['temp_hour_2']:.2f}")
+        logger.info(msg=f"Sunrise: {context['sunrise']} | Sunset: {context['sunset']} | Solar Percentage: {context['solar_percentage']} %")
+        logger.info(msg=f"Current weather - ID: {context['current_weather_id']} | Condition: {context['current_weather_condition']}")
+        logger.info(msg=f"Time Sector: {context['time_sector'].upper()} | Target Temperature: {target_temperature:.2f}")
+
+        # Adjust target temperature
+        target_temperature -= room.away_adjust(target_temperature=target_temperature)
+        target_offset = getattr(room, context["time_sector"]) - target_temperature
+
+        # Learn from this reading & check whether the room needs an early start for a warmer period coming up
+        outside_temperature = self.weather.forecast.get_current(name="temp")
+        self.thermal_models.observe(name=room.name, inside=room.current_temperature, outside=outside_temperature, heating=room.get_heating_level())
+        model = self.thermal_models.get(name=room.name)
+        predicted_temperature = None
+        if model.trained:
+            predicted_temperature = model.predict(inside=room.current_temperature, outside=context["outside_mean"], minutes=120)
+            logger.info(msg=f"Thermal model - Heat-up: {model.heat_rate:.2f} °C/h | Loss: {model.loss_rate:.3f} /h | Predicted in 2 hours without heating: {predicted_temperature:.2f}")
+            target_temperature = self.get_early_start_target(room=room, model=model, context=context, target_temperature=target_temperature, target_offset=target_offset, outside_temperature=outside_temperature)
+
+        # Create / update target temperature entity
+        sensor = room.spec.target_sensor
+        payload = {
+            "state": target_temperature,
+            "attributes": {
+                "unit_of_measurement": "°C",
+                "friendly_name": f"{room.name.replace('_', ' ').title()} Target",
+                "icon": "mdi:thermometer",
+            }
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
+
+        # Plan the room's heating over the horizon, targets follow the schedule less any Away reduction
+        # Only planned when followed, or published alongside the usual rules with shadow plans on
+        plan = None
+        if self.horizon_planner or self.shadow_plans:
+            heat_rate, loss_rate = self.thermal_models.get_rates(name=room.name)
+            plan = self.planner.plan_room(
+                spec=room.spec,
+                horizon=context["horizon"],
+                current_temperature=room.current_temperature,
+                target_offset=target_offset,
+                electric_allowed_now=context["using_grid"],
+                heat_rate=heat_rate,
+                loss_rate=loss_rate,
+            )
+        room.plan = plan
+        if plan is not None:
+            self.publish_plan(room=room, plan=plan)
+
+        # Control rooms
+        if self.horizon_planner and plan is not None:
+            room.follow_plan(plan=plan)
+        else:
+            room.set_hvac_mode(
+                target_temperature=target_temperature,
+                outside_max=context["outside_max"],
+                electric_price=context["electric_price"],
+                gas_price=context["gas_price"],
+                using_grid=context["using_grid"],
+                predicted_temperature=predicted_temperature,
+            )
+
+        self.log_room_summary(room=room, predicted_temperature=predicted_temperature)
+        log_line_break()
+
+    def log_room_summary(self, room, predicted_temperature):
+        # One line per room per cycle with its reading & decision, all that compact logging shows of a room
+        fields = {
+            "room": room.name,
+            "temperature": room.current_temperature,
+            "target": room.target_temperature,
+            "decision": room.decision,
+            "tado_mode": room.tado_mode,
+            "predicted": None if predicted_temperature is None else round(predicted_temperature, 2),
+            "plan_cost": None if room.plan is None else room.plan.cost,
+        }
+        if self.label:
+            fields["home"] = self.name
+        predicted = "" if predicted_temperature is None else f" | Predicted {predicted_temperature:.2f}"
+        logger.info(
+            msg=f"{self.label}{room.spec.display_name}: {room.current_temperature:.2f} | Target {room.target_temperature:.2f} | {room.decision.upper()} | Mode {room.tado_mode.upper()}{predicted}",
+            extra={"summary": True, "fields": fields},
+        )
+
+    def control_room_safely(self, room, context):
+        # A failing room, e.g. an unavailable climate entity, is logged & the other rooms still get their HVAC commands
+        try:
+            self.control_room(room=room, context=context)
+        except Exception as error:
+            logger.exception(msg=f"{room.name.upper().replace('_', ' ')} failed: {error}")
+            log_line_break()
+
+    def control_room_grouped(self, room, context):
+        # Runs a room on a worker thread keeping its log lines together
+        with log_group.grouped(logger=logger), log_group.room(), tracing.room(name=f"{self.label}{room.name}"):
+            self.control_room_safely(room=room, context=context)
+
+    def run_cycle(self, cached=False):
+        # Runs one cycle, concurrently in async mode, recording how long it took & whether it failed
+        self.last_started = time.time()
+        self.last_error = None
+        try:
+            if self.async_mode and not cached:
+                # Imported here so a warm start doesn't wait for asyncio
+                import asyncio
+                asyncio.run(self.run_cycle_async())
+            else:
+                self.run_cycle_sync(cached=cached)
+        except Exception as error:
+            self.last_error = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            self.last_duration = time.time() - self.last_started
+
+    def run_cycle_sync(self, cached=False):
+        log_line_break()
+        logger.info(msg=f"Starting {'warm start' if cached else 'update'} cycle{self.get_suffix()}")
+        log_line_break()
+
+        # A warm start sends its HVAC commands before any entity updates
+        if cached:
+            self.home_assistant.hold_updates()
+        try:
+            self.run_phase(name="settings", function=self.sync_thermostats)
+            self.update_sources(cached=cached)
+            self.run_phase(name="data_age", function=self.publish_data_age)
+            context = self.run_phase(name="context", function=self.get_cycle_context)
+            self.context = context
+            if context is None:
+                return
+
+            log_line_break()
+
+            # Iterate through rooms and apply settings
+            with tracing.phase(name=f"{self.label}rooms"):
+                for room in self.thermostats:
+                    with log_group.room(), tracing.room(name=f"{self.label}{room.name}"):
+                        self.control_room_safely(room=room, context=context)
+
+            # Sends the HVAC commands needed to reach every room's desired state
+            self.run_phase(name="hvac_commands", function=self.hvac_reconciler.apply)
+            tracing.record_startup(stage="first_decision")
+            self.run_phase(name="room_control", function=self.publish_switches)
+        finally:
+            if cached:
+                self.run_phase(name="entities", function=self.home_assistant.release_updates)
+
+        self.run_phase(name="thermal_models", function=self.thermal_models.save)
+        self.run_phase(name="recorder", function=self.record_cycle, context=context)
+
+        logger.info(msg=f"Update cycle finished{self.get_suffix()}")
+        log_line_break()
+
+    async def run_cycle_async(self):
+        # Same cycle as run_cycle_sync() but the upstream fetches and the rooms run concurrently
+        import asyncio
+
+        log_line_break()
+        logger.info(msg=f"Starting update cycle (async){self.get_suffix()}")
+        log_line_break()
+
+        self.run_phase(name="settings", function=self.sync_thermostats)
+
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_concurrency))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_limited(target, **kwargs):
+            async with semaphore:
+                return await asyncio.to_thread(target, **kwargs)
+
+        # Home Assistant states, weather & Octopus don't depend on each other
+        await asyncio.gather(
+            run_limited(self.run_phase, name="states", function=self.home_assistant.refresh_states),
+            run_limited(self.run_phase, name="weather", function=self.weather.update_weather_data),
+            run_limited(self.run_phase, name="octopus", function=self.octopus.update_octopus_data),
+        )
+        self.run_phase(name="data_age", function=self.publish_data_age)
+        context = self.run_phase(name="context", function=self.get_cycle_context)
+        self.context = context
+        if context is None:
+            return
+
+        log_line_break()
+
+        # Refresh & control every room at the same time
+        with tracing.phase(name=f"{self.label}rooms"):
+            await asyncio.gather(*[run_limited(self.control_room_grouped, room=room, context=context) for room in self.thermostats])
+
+        # Sends the HVAC commands needed to reach every room's desired state
+        await asyncio.to_thread(self.run_phase, name="hvac_commands", function=self.hvac_reconciler.apply)
+        tracing.record_startup(stage="first_decision")
+        self.run_phase(name="room_control", function=self.publish_switches)
+        self.run_phase(name="thermal_models", function=self.thermal_models.save)
+        self.run_phase(name="recorder", function=self.record_cycle, context=context)
+
+        logger.info(msg=f"Update cycle finished{self.get_suffix()}")
+        log_line_break()
+
+    def publish_switches(self):
+        # Saves the rooms' control state & publishes how often each room switched mode, and was held, today
+        self.room_controls.save()
+        rooms = [(room.name, room.control) for room in self.thermostats]
+
+        # Create / update heating switches entity
+        sensor = "sensor.tado_optimiser_heating_switches"
+        payload = {
+            "state": sum(control.switches_today for name, control in rooms),
+            "attributes": {
+                "friendly_name": "Tado Optimiser Heating Switches Today",
+                "icon": "mdi:swap-horizontal",
+                "Switches held back (total)": sum(control.held for name, control in rooms),
+                **{name.replace("_", " ").title(): f"{control.mode} | {control.switches_today} today | {control.held} held back" for name, control in rooms},
+            }
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
+
+    def get_suffix(self):
+        return f" for {self.name}" if self.label else ""
+
+    # ****************************************************************************************************************
+    # Status API
+
+    def publish_status(self, status_server, prefix="/api"):
+        # Precomputes the status API's documents once per cycle so polling it never reaches Home Assistant
+        context = self.context
+        if context is None:
+            return
+        now = time.time()
+        ages = self.get_data_ages()
+
+        status_server.publish_json(path=f"{prefix}/status", data={
+            "updated": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+            "time_sector": context["time_sector"],
+            "sunrise": context["sunrise"],
+            "sunset": context["sunset"],
+            "outside_temperature": self.weather.forecast.get_current(name="temp"),
+            "weather": context["current_weather_condition"],
+            "solar_percentage": context["solar_percentage"],
+            "electric_price": context["electric_price"],
+            "gas_price": context["gas_price"],
+            "grid_power": context["grid_power"],
+            "using_grid": context["using_grid"],
+            "horizon_planner": self.horizon_planner,
+            "data_ages": {source: None if age is None else round(age) for source, age in ages.items()},
+            "stale": check_staleness(ages=ages),
+            "circuits": {"open_weather": self.weather.breaker.describe(), "octopus": self.octopus.breaker.describe()},
+            "open_weather_calls_left": None if self.weather.budget is None else self.weather.budget.get_remaining(),
+            "weather_refresh_seconds": round(self.weather.get_refresh_interval()),
+        })
+
+        status_server.publish_json(path=f"{prefix}/prices", data=[
+            {"start": slot.start, "end": slot.end, "electric_price": slot.electric_price, "gas_price": slot.gas_price, "outside_temperature": slot.outside_temperature, "time_sector": slot.time_sector}
+            for slot in context["horizon"]
+        ])
+
+        rooms = []
+        for room in self.thermostats:
+            plan = room.plan
+            rooms.append({
+                "name": room.name,
+                "display_name": room.spec.display_name,
+                "temperature": room.current_temperature,
+                "target": room.target_temperature,
+                "decision": room.decision,
+                "heating": room.get_heating_level() if room.current_temperature is not None else None,
+                "climate_gas": room.climate_gas,
+                "climate_electric": room.climate_electric,
+                "tado_mode": room.tado_mode,
+                "electric_override": room.electric_override,
+                "mode_since": datetime.fromtimestamp(room.control.since).isoformat(timespec="seconds") if room.control.since else None,
+                "switches_today": room.control.switches_today,
+                "switches": room.control.switches,
+                "switches_held": room.control.held,
+                "plan": None if plan is None else {
+                    "setpoint": plan.setpoint,
+                    "cost": plan.cost,
+                    "slots": [{"start": slot.start, "action": slot.action, "target": slot.target, "temperature": slot.temperature} for slot in plan.slots],
+                },
+            })
+        status_server.publish_json(path=f"{prefix}/rooms", data=rooms)
+
+        # The last day of cycles with a summary per room
+        start = int(now - 3600 * 24)
+        status_server.publish_json(path=f"{prefix}/history", data={
+            "cycles": [
+                {"ts": ts, "electric_price": electric_price, "gas_price": gas_price, "grid_power": grid_power, "using_grid": using_grid, "outside": outside}
+                for ts, electric_price, gas_price, grid_power, using_grid, outside in self.recorder.get_cycle_history(start=start, end=now)
+            ],
+            "rooms": {room.name: self.recorder.get_room_summary(name=room.name, start=start, end=now) for room in self.thermostats},
+        })
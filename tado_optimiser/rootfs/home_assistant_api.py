@@ -1,70 +1,186 @@
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
 
-import requests
+import http_client
 
 logger = logging.getLogger("tado_optimiser")
 
 
 # noinspection DuplicatedCode
 class HomeAssistantAPI:
-    def __init__(self,):
-        self.token = os.getenv("SUPERVISOR_TOKEN")
-        self.base_url = "http://supervisor/core/api"
+    # One Home Assistant instance, the supervisor's unless a URL & token are given
+    def __init__(self, base_url=None, token=None, entity_max_age=3600):
+        self.token = token or os.getenv("SUPERVISOR_TOKEN")
+        self.base_url = base_url or os.getenv("HOME_ASSISTANT_URL", "http://supervisor/core/api")
         self.headers = {"Authorization": f"Bearer {self.token}", "Content-Type": "application/json"}
 
+        # Cycle snapshot of every entity keyed by entity_id
+        self.states = {}
+
+        # Optional WebSocket state mirror, read in preference to the snapshot while it is in sync
+        self.mirror = None
+        self.mirror_syncs = 0
+
+        # Last published payload hash & time keyed by sensor, re-posted anyway once older than entity_max_age seconds
+        self.published = {}
+        self.published_lock = threading.Lock()
+        self.entity_max_age = entity_max_age
+
+        # Entity updates held back while the warm start sends its HVAC commands, keyed by sensor so only the last is sent
+        self.held = None
+
+    def mirror_synced(self):
+        return self.mirror is not None and self.mirror.synced.is_set()
+
+    def refresh_states(self):
+        # The WebSocket mirror is already up to date so there is nothing to fetch
+        if self.mirror_synced():
+            self.states = {}
+            if self.mirror.syncs != self.mirror_syncs:
+                # The mirror has (re)connected, Home Assistant may have restarted & lost the published entities
+                self.mirror_syncs = self.mirror.syncs
+                with self.published_lock:
+                    self.published = {}
+                logger.info(msg="State mirror resynced, republishing entities this cycle")
+            logger.debug(msg="State mirror in sync, skipping state snapshot")
+            return
+
+        # Reads every entity in one request and indexes them by entity_id for the rest of the cycle
+        full_url = f"{self.base_url}/states"
+        response = http_client.request("home_assistant", "GET", full_url, headers=self.headers)
+
+        if response is not None and response.status_code == 200:
+            self.states = {entity["entity_id"]: entity for entity in response.json()}
+            logger.debug(msg=f"State snapshot refreshed: {len(self.states)} entities")
+        else:
+            self.states = {}
+            logger.error(msg="Error getting state snapshot")
+
+    def get_entity(self, sensor):
+        if self.mirror_synced():
+            entity = self.mirror.get(entity_id=sensor)
+            if entity is not None:
+                return entity
+
+        # Returns the full entity from the cycle snapshot, only falls back to a single request if there is no snapshot
+        if self.states:
+            return self.states.get(sensor)
+
+        full_url = f"{self.base_url}/states/{sensor}"
+        response = http_client.request("home_assistant", "GET", full_url, headers=self.headers)
+
+        if response is not None and response.status_code == 200:
+            return response.json()
+        else:
+            return None
+
+    def entity_unchanged(self, sensor, digest):
+        # True if the same payload was published recently and Home Assistant still has the entity
+        with self.published_lock:
+            last = self.published.get(sensor)
+
+        if last is None or last[0] != digest:
+            return False
+        if time.monotonic() - last[1] > self.entity_max_age:
+            return False
+        if self.states and sensor not in self.states:
+            # Home Assistant has restarted and lost the entity, with the mirror on a resync clears published instead
+            return False
+        return True
+
+    def hold_updates(self):
+        self.held = {}
+
+    def release_updates(self):
+        # Sends the entity updates held since hold_updates()
+        held, self.held = self.held or {}, None
+        for sensor, payload in held.items():
+            self.update_entity(sensor=sensor, payload=payload)
+
     def update_entity(self, sensor, payload):
+        if self.held is not None:
+            self.held[sensor] = payload
+            return
+
+        digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+        if self.entity_unchanged(sensor=sensor, digest=digest):
+            logger.debug("Entity unchanged, skipping update: %s", sensor)
+            return
+
         full_url = f"{self.base_url}/states/{sensor}"
-        response = requests.post(full_url, headers=self.headers, json=payload)
+        response = http_client.request("home_assistant", "POST", full_url, headers=self.headers, json=payload)
 
-        if response.status_code == 201:
-            logger.debug(msg=f"New entity successfully created: {sensor}")
-        elif response.status_code == 200:
-            logger.debug(msg=f"Entity successfully updated: {sensor}")
+        if response is not None and response.status_code in (200, 201):
+            with self.published_lock:
+                self.published[sensor] = (digest, time.monotonic())
+
+        if response is not None and response.status_code == 201:
+            logger.debug("New entity successfully created: %s", sensor)
+        elif response is not None and response.status_code == 200:
+            logger.debug("Entity successfully updated: %s", sensor)
         else:
             logger.error(msg=f"Error updating entity: {sensor}")
 
     def get_entity_state(self, sensor):
-        full_url = f"{self.base_url}/states/{sensor}"
-        response = requests.get(full_url, headers=self.headers)
+        entity = self.get_entity(sensor=sensor)
 
-        if response.status_code == 200:
-            logger.debug(msg=f"Entity found: {sensor}")
-            state = response.json()["state"]
+        if entity is not None:
+            logger.debug("Entity found: %s", sensor)
+            state = entity["state"]
             return state
         else:
             logger.error(msg=f"Error getting entity: {sensor}")
             return "Entity not found"
         
     def get_climate_current_temperature(self, sensor):
-        full_url = f"{self.base_url}/states/{sensor}"
-        response = requests.get(full_url, headers=self.headers)
+        entity = self.get_entity(sensor=sensor)
 
-        if response.status_code == 200:
-            logger.debug(msg=f"Entity found: {sensor}")
-            current_temperature = response.json()["attributes"]["current_temperature"]
+        if entity is not None:
+            logger.debug("Entity found: %s", sensor)
+            current_temperature = entity["attributes"]["current_temperature"]
             return current_temperature
         else:
             logger.error(msg=f"Error getting entity: {sensor}")
             return "Entity not found"
 
+    def get_history(self, entity_ids, start, end=None):
+        # Returns {entity_id: [state, ...]} recorded between start & end (aware datetimes), oldest first
+        full_url = f"{self.base_url}/history/period/{start.isoformat()}"
+        params = {"filter_entity_id": ",".join(entity_ids)}
+        if end is not None:
+            params["end_time"] = end.isoformat()
+        response = http_client.request("home_assistant", "GET", full_url, headers=self.headers, params=params, timeout=60)
+
+        if response is not None and response.status_code == 200:
+            history = {states[0]["entity_id"]: states for states in response.json() if states}
+            logger.debug(msg=f"History retrieved for {len(history)} entities")
+            return history
+        else:
+            logger.error(msg="Error getting history")
+            return {}
+
     def set_hvac_mode(self, entity_id, hvac_mode):
         full_url = f"{self.base_url}/services/climate/set_hvac_mode"
         payload = {"entity_id": entity_id, "hvac_mode": hvac_mode}
-        response = requests.post(full_url, headers=self.headers, json=payload)
-        logger.debug(msg=f"Status code: {response.status_code}")
+        response = http_client.request("home_assistant", "POST", full_url, headers=self.headers, json=payload)
 
-        if response.status_code == 200:
-            logger.debug(msg=f"HVAC mode set to '{hvac_mode}' for entity: {entity_id}")
+        if response is not None and response.status_code == 200:
+            logger.debug("HVAC mode set to '%s' for entity: %s", hvac_mode, entity_id)
         else:
-            logger.debug(msg=f"Failed to set HVAC mode to '{hvac_mode}' for entity: {entity_id}")
+            logger.debug("Failed to set HVAC mode to '%s' for entity: %s", hvac_mode, entity_id)
 
-    def set_temperature(self, entity_id, temperature):
+    def set_temperature(self, entity_id, temperature, hvac_mode=None):
         full_url = f"{self.base_url}/services/climate/set_temperature"
         payload = {"entity_id": entity_id, "temperature": temperature}
-        response = requests.post(full_url, headers=self.headers, json=payload)
+        if hvac_mode is not None:
+            payload["hvac_mode"] = hvac_mode
+        response = http_client.request("home_assistant", "POST", full_url, headers=self.headers, json=payload)
 
-        if response.status_code == 200:
-            logger.debug(msg=f"Temperature set to '{temperature}' for entity: {entity_id}")
+        if response is not None and response.status_code == 200:
+            logger.debug("Temperature set to '%s' for entity: %s", temperature, entity_id)
         else:
-            logger.debug(msg=f"Failed to set temperature to '{temperature}' for entity: {entity_id}")
+            logger.debug("Failed to set temperature to '%s' for entity: %s", temperature, entity_id)
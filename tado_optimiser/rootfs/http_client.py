@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import tracing
+
+logger = logging.getLogger("tado_optimiser")
+
+# Defaults used until configure() is called from the add-on options
+TIMEOUT = 10
+RETRIES = 3
+BACKOFF = 0.5
+POOL_SIZE = 10
+
+# One pooled session per upstream service, shared across the whole process
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    # Session that applies a default timeout to every request unless one is passed
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def configure(timeout=None, retries=None, backoff=None, pool_size=None):
+    # Sets timeout & retry policy, existing sessions are closed so the new policy applies to all of them
+    global TIMEOUT, RETRIES, BACKOFF, POOL_SIZE
+    TIMEOUT = TIMEOUT if timeout is None else timeout
+    RETRIES = RETRIES if retries is None else retries
+    BACKOFF = BACKOFF if backoff is None else backoff
+    POOL_SIZE = POOL_SIZE if pool_size is None else pool_size
+    close_sessions()
+    logger.debug(msg=f"HTTP client configured. Timeout: {TIMEOUT} | Retries: {RETRIES} | Backoff: {BACKOFF} | Pool size: {POOL_SIZE}")
+
+
+def get_session(name):
+    # Returns the pooled session for the named service creating it on first use, rooms & homes on worker threads share it
+    with sessions_lock:
+        if name not in sessions:
+            retry = Retry(
+                total=RETRIES,
+                connect=RETRIES,
+                read=RETRIES,
+                status=RETRIES,
+                backoff_factor=BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session = TimeoutSession(timeout=TIMEOUT)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[name] = session
+            logger.debug(msg=f"HTTP session created: {name}")
+        return sessions[name]
+
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def request(name, method, url, **kwargs):
+    # Sends a request through the named pooled session, returns None if it could not be completed
+    started = time.perf_counter()
+    try:
+        response = get_session(name).request(method, url, **kwargs)
+    except requests.RequestException as error:
+        logger.error(msg=f"HTTP {method} failed for {name}: {error}")
+        response = None
+
+    tracing.record_http(service=name, method=method, url=url, response=response, seconds=time.perf_counter() - started)
+    return response
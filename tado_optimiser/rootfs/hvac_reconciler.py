@@ -0,0 +1,91 @@
+import logging
+import threading
+
+logger = logging.getLogger("tado_optimiser")
+
+
+class HvacReconciler:
+    def __init__(self, home_assistant):
+        self.home_assistant = home_assistant
+        self.lock = threading.Lock()
+
+        # Desired (hvac_mode, temperature) per climate entity for this cycle, hvac_mode None leaves the mode alone
+        self.desired = {}
+
+        # Counts from the last apply
+        self.calls_sent = 0
+        self.calls_suppressed = 0
+
+    def set_desired(self, entity_id, hvac_mode, temperature=None):
+        # Records what the entity should be doing, a later request for the same entity replaces an earlier one
+        with self.lock:
+            if entity_id in self.desired:
+                logger.debug("Desired state for %s replaced: %s -> %s", entity_id, self.desired[entity_id], (hvac_mode, temperature))
+            self.desired[entity_id] = (hvac_mode, temperature)
+
+    def get_required_change(self, entity_id, hvac_mode, temperature):
+        # Compares the desired state with Home Assistant and returns the (hvac_mode, temperature) still to send
+        entity = self.home_assistant.get_entity(sensor=entity_id)
+        if entity is None:
+            return hvac_mode, temperature
+
+        current_mode = entity["state"]
+        current_temperature = entity["attributes"].get("temperature")
+
+        if hvac_mode == "off":
+            return (None, None) if current_mode == "off" else ("off", None)
+
+        mode_change = None if hvac_mode is None or current_mode == hvac_mode else hvac_mode
+
+        # Tado turns heating back on when a temperature is set, so send it even if the target is unchanged
+        if hvac_mode is None and current_mode == "off":
+            return None, temperature
+
+        temperature_change = None
+        if temperature is not None and (current_temperature is None or float(current_temperature) != float(temperature)):
+            temperature_change = temperature
+
+        return mode_change, temperature_change
+
+    def apply(self):
+        # Sends the minimum set of service calls, entities sharing a target go in the same call
+        with self.lock:
+            desired = self.desired
+            self.desired = {}
+
+        mode_calls = {}
+        temperature_calls = {}
+        suppressed = 0
+
+        for entity_id, (hvac_mode, temperature) in desired.items():
+            mode_change, temperature_change = self.get_required_change(entity_id=entity_id, hvac_mode=hvac_mode, temperature=temperature)
+
+            if mode_change is None and temperature_change is None:
+                suppressed += 1
+            elif temperature_change is None:
+                mode_calls.setdefault(mode_change, []).append(entity_id)
+            else:
+                temperature_calls.setdefault((mode_change, temperature_change), []).append(entity_id)
+
+        for hvac_mode, entity_ids in mode_calls.items():
+            self.home_assistant.set_hvac_mode(entity_id=entity_ids, hvac_mode=hvac_mode)
+
+        for (hvac_mode, temperature), entity_ids in temperature_calls.items():
+            self.home_assistant.set_temperature(entity_id=entity_ids, temperature=temperature, hvac_mode=hvac_mode)
+
+        self.calls_sent = len(mode_calls) + len(temperature_calls)
+        self.calls_suppressed = suppressed
+        logger.info(msg=f"HVAC commands: {len(desired)} entities | {self.calls_sent} service calls sent | {self.calls_suppressed} already in the desired state")
+
+        # Create / update HVAC command entity
+        sensor = "sensor.tado_optimiser_hvac_commands"
+        payload = {
+            "state": self.calls_sent,
+            "attributes": {
+                "friendly_name": "Tado Optimiser HVAC Commands",
+                "icon": "mdi:radiator",
+                "Entities": len(desired),
+                "Suppressed": self.calls_suppressed,
+            }
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
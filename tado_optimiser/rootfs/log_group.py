@@ -0,0 +1,45 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+# Records captured for the room being processed on the current thread
+local = threading.local()
+flush_lock = threading.Lock()
+
+
+class GroupFilter(logging.Filter):
+    # Holds back records while the current thread is inside grouped()
+    def filter(self, record):
+        buffer = getattr(local, "buffer", None)
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+
+@contextmanager
+def room():
+    # Marks the lines logged on this thread as a room's detail, compact logging leaves them out
+    local.room = True
+    try:
+        yield
+    finally:
+        local.room = False
+
+
+def in_room():
+    return getattr(local, "room", False)
+
+
+@contextmanager
+def grouped(logger):
+    # Emits everything logged inside the block as one uninterrupted group
+    local.buffer = []
+    try:
+        yield
+    finally:
+        records = local.buffer
+        local.buffer = None
+        with flush_lock:
+            for record in records:
+                logger.handle(record)
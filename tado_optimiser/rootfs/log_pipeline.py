@@ -0,0 +1,118 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import log_group
+
+FORMAT = "%(asctime)s %(levelname)s %(filename)s line %(lineno)03d: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Background writer, stopped at exit once everything queued has been written
+listener = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    # Queues records as they are so formatting happens on the writer's thread, the queue never leaves the process
+    def prepare(self, record):
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    # The add-on's usual log line, noting how many repeats of a rate-limited message were held back
+    def format(self, record):
+        line = super().format(record)
+        repeated = getattr(record, "repeated", 0)
+        if repeated:
+            line += f" (repeated {repeated} times since last shown)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, a record's fields (extra={"fields": {...}}) come through as keys of their own
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "source": f"{record.filename}:{record.lineno}",
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if getattr(record, "repeated", 0):
+            data["repeated"] = record.repeated
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class DetailFilter(logging.Filter):
+    # Compact mode drops the banners & lines logged while a room is controlled, keeping the room's summary,
+    # otherwise the summaries are left out as they repeat the room's lines
+    def __init__(self, compact):
+        super().__init__()
+        self.compact = compact
+
+    def filter(self, record):
+        if getattr(record, "summary", False):
+            return self.compact
+        if not self.compact or record.levelno >= logging.WARNING:
+            return True
+        return not getattr(record, "banner", False) and not log_group.in_room()
+
+
+class RepeatFilter(logging.Filter):
+    # Shows a rate-limited message (extra={"rate_limit": True}) once per interval from each place it's logged
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.shown = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        # A record passed once already (released by log_group) isn't counted again
+        if not getattr(record, "rate_limit", False) or hasattr(record, "repeated"):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            shown, held = self.shown.get(key, (None, 0))
+            if shown is not None and now - shown < self.interval:
+                self.shown[key] = (shown, held + 1)
+                return False
+            self.shown[key] = (now, 0)
+        record.repeated = held
+        return True
+
+
+def configure(logger, level, path, log_format="text", compact=False, repeat_minutes=60):
+    # Sends records through a queue to a background thread that formats & writes them to the log file & console
+    global listener
+    formatter = JsonFormatter() if log_format == "json" else TextFormatter(fmt=FORMAT, datefmt=DATE_FORMAT)
+    file_handler = RotatingFileHandler(filename=path, maxBytes=1024*1024, backupCount=5)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    logger.setLevel(level)
+    logger.addFilter(DetailFilter(compact=compact))
+    if repeat_minutes:
+        logger.addFilter(RepeatFilter(interval=repeat_minutes * 60))
+    logger.addHandler(DeferredQueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    # Writes out whatever is still queued
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
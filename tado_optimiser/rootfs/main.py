@@ -1,16 +1,23 @@
+import hashlib
 import logging
 import os
-import shutil
-import time
-from datetime import datetime, timedelta
-from logging.handlers import RotatingFileHandler
+import threading
 
-import schedule
 import yaml
 
+import http_client
+import log_group
+import log_pipeline
+import tracing
+from home import Home
 from home_assistant_api import HomeAssistantAPI
+from multi_home import HOME_KEYS, HomePool, SharedCache, get_websocket_url, load_homes
 from octopus_api import Octopus
-from tado import Tado
+from planner import HeatingPlanner
+from rate_store import RateStore
+from resilience import get_call_budget
+from scheduler import CycleScheduler
+from snapshot_store import SnapshotStore
 from weather_api import WeatherAPI
 
 
@@ -19,221 +26,244 @@ def load_config(url):
     with open(system_file, "r") as file:
         return yaml.safe_load(file)
 
-def copy_settings_file():
-    if not os.path.exists("/config/settings.yaml"):
-        shutil.copy(src="/settings.yaml", dst="/config/settings.yaml")
-        logger.info(msg="Copied settings file to /config")
-    else:
-        logger.info(msg="Settings file already exists in /config")
-
-def get_time_sector(sunrise, sunset):
-    # Change sunset to 30 minutes before sunset
-    sunset = (datetime.combine(datetime.today(), sunset) - timedelta(minutes=MINUTES_BEFORE_SUNSET)).time()
-
-    if sunrise <= datetime.now().time() < sunset:
-        time_sector = "day"
-    elif sunset <= datetime.now().time() < datetime.strptime('23:59', '%H:%M').time():
-        time_sector = "evening"
-    else:
-        time_sector = "night"
-    return time_sector
-
-def get_radiator_flow_temp(outside_temp):
-    if outside_temp <= 0:
-        flow_temperature = 75
-    elif outside_temp >= 10:
-        flow_temperature = 50
-    else:
-        flow_temperature = 75 - (outside_temp * 2.5)
-
-    logger.info(msg=f"Suggested Flow Temperature: {flow_temperature:.2f}")
-    
-    # Create / update flow temperature entity
-    sensor = "sensor.radiator_flow_temperature"
-    payload = {
-        "state": round(flow_temperature, 2),
-        "attributes": {
-            "unit_of_measurement": "°C",
-            "friendly_name": "Radiator Flow Temperature",
-            "icon": "mdi:thermometer",
-        }
-    }
-    home_assistant.update_entity(sensor=sensor, payload=payload)
-
-def log_line_break():
-    logger.info(msg="***************************************************************************************")
+def get_weather_budget(api_key):
+    # Homes using the same OpenWeather key share its daily quota, the file is named by a hash so the key isn't written out
+    key_id = hashlib.sha1(str(api_key).encode("utf-8")).hexdigest()[:8]
+    return get_call_budget(path=f"{CONFIG_DIR}/open_weather_budget_{key_id}.json", daily_limit=OPEN_WEATHER_DAILY_CALLS)
+
+def build_home(name, settings, data_dir, label, weather_cache=None):
+    # One home's Home Assistant, weather & Octopus clients & heating planner, sharing the rate store & weather cache with the others
+    os.makedirs(data_dir, exist_ok=True)
+    home_assistant = HomeAssistantAPI(base_url=settings.get("home_assistant_url"), token=settings.get("home_assistant_token"), entity_max_age=ENTITY_MAX_AGE)
+    snapshot_store = SnapshotStore(directory=f"{data_dir}/snapshots", legacy_directory=data_dir)
+    weather = WeatherAPI(open_weather_api_key=settings["open_weather_api"], latitude=settings["latitude"], longitude=settings["longitude"], home_assistant=home_assistant, snapshot_store=snapshot_store, fetch_cache=weather_cache, budget=get_weather_budget(api_key=settings["open_weather_api"]))
+    octopus = Octopus(octopus_api=settings["octopus_api"], octopus_account=settings["octopus_account"], home_assistant=home_assistant, snapshot_store=snapshot_store, rate_store=rate_store)
+    home = Home(name=name, data_dir=data_dir, home_assistant=home_assistant, weather=weather, octopus=octopus, planner=HeatingPlanner(), options=configurations, snapshot_store=snapshot_store, label=label)
+    home.start(websocket_mirror=WEBSOCKET_MIRROR, websocket_url=get_websocket_url(settings=settings), bootstrap=not WARM_START)
+    return home
 
 # Set Global from System
 TOKEN = os.getenv("SUPERVISOR_TOKEN")
 
+# Set file locations, overridable so the add-on can be run outside its container
+CONFIG_DIR = os.getenv("CONFIG_DIR", "/config")
+OPTIONS_FILE = os.getenv("OPTIONS_FILE", "/data/options.json")
+STATUS_PORT = int(os.getenv("STATUS_PORT", 5052))
+
 # Load the configuration file
-configurations = load_config(url="/data/options.json")
+configurations = load_config(url=OPTIONS_FILE)
 
 # Set Global variables from Configuration
 LOG_LEVEL = configurations.get("log_level", "INFO").upper()
 LATITUDE = configurations.get("latitude")
 LONGITUDE = configurations.get("longitude")
 OPEN_WEATHER_API = configurations.get("open_weather_api")
-OCTOPUS_API = configurations.get("octopus_api")
-OCTOPUS_ACCOUNT = configurations.get("octopus_account")
-
-# Set other global variables
-MINUTES_BEFORE_SUNSET = 60
-
-# Set up the logger
+HTTP_TIMEOUT = configurations.get("http_timeout", 10)
+HTTP_RETRIES = configurations.get("http_retries", 3)
+HTTP_BACKOFF = configurations.get("http_backoff", 0.5)
+MAX_CONCURRENCY = configurations.get("max_concurrency", 4)
+ENTITY_MAX_AGE = configurations.get("entity_max_age", 3600)
+WEBSOCKET_MIRROR = configurations.get("websocket_mirror", False)
+PROFILE_CYCLES = configurations.get("profile_cycles", 0)
+STATUS_API = configurations.get("status_api", True)
+CYCLE_MINUTES = configurations.get("cycle_minutes", 5)
+OVERRUN_POLICY = configurations.get("overrun_policy", "skip")
+MULTI_HOME = configurations.get("multi_home", False)
+OPEN_WEATHER_DAILY_CALLS = configurations.get("open_weather_daily_calls", 1000)
+WARM_START = configurations.get("warm_start", True)
+LOG_FORMAT = configurations.get("log_format", "text")
+LOG_COMPACT = configurations.get("log_compact", False)
+LOG_REPEAT_MINUTES = configurations.get("log_repeat_minutes", 60)
+
+# Set up the logger, records are formatted & written on a background thread so a slow SD card doesn't hold up a cycle
 logger = logging.getLogger("tado_optimiser")
-logger.setLevel(getattr(logging, LOG_LEVEL))
-handler = RotatingFileHandler(filename="/config/logfile.log", maxBytes=1024*1024, backupCount=5)
-handler.setLevel(getattr(logging, LOG_LEVEL))
-formatter = logging.Formatter(fmt="%(asctime)s %(levelname)s %(filename)s line %(lineno)03d: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-# Additional block to use system logs in addition
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(getattr(logging, LOG_LEVEL))
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
-# End of additional code
+log_pipeline.configure(
+    logger=logger,
+    level=getattr(logging, LOG_LEVEL, logging.INFO),
+    path=f"{CONFIG_DIR}/logfile.log",
+    log_format=LOG_FORMAT,
+    compact=LOG_COMPACT,
+    repeat_minutes=LOG_REPEAT_MINUTES,
+)
+
+# Keeps each room's log lines together when rooms run concurrently
+logger.addFilter(log_group.GroupFilter())
 
 logger.info(msg="Tado Optimizer starting")
 
-# Check & load settings
-copy_settings_file()
-settings = load_config(url="/config/settings.yaml")
-
 # Initial variables logging
 logger.info(msg=f"Latitude: {LATITUDE}")
 logger.info(msg=f"Longitude: {LONGITUDE}")
 logger.debug(msg=f"Open Weather API Key: {OPEN_WEATHER_API}")
 logger.debug(msg=f"Home Assistant Token: {TOKEN}")
 
-# Initialise Home Assistant, Weather & Octopus Classes
-home_assistant = HomeAssistantAPI()
-weather = WeatherAPI(open_weather_api_key=OPEN_WEATHER_API, latitude=LATITUDE, longitude=LONGITUDE)
-octopus = Octopus(octopus_api=OCTOPUS_API, octopus_account=OCTOPUS_ACCOUNT)
-
-# Initialise Tado Class & all thermostats
-THERMOSTATS = []
-for room_name in settings["rooms"]:
-    new_room = Tado(name=room_name)
-    THERMOSTATS.append(new_room)
-
-def main():
-    log_line_break()
-    logger.info(msg="Starting update cycle")
-    log_line_break()
-
-    # Updates weather data and entities
-    weather.update_weather_data()
-
-    # Updates Octopus data and entities
-    octopus.update_octopus_data()
-
-    # Get Sunrise & current weather conditions
-    sunrise = datetime.fromtimestamp(weather.weather_data["current"]["sunrise"]).time()
-    sunset = datetime.fromtimestamp(weather.weather_data["current"]["sunset"]).time()
-    current_weather_id = weather.weather_data["current"]["weather"][0]["id"]
-    current_weather_condition = weather.weather_data["current"]["weather"][0]["description"].capitalize()
-    solar_percentage = home_assistant.get_entity_state(sensor="sensor.home_solar_percentage")
-
-    # Gets Electricity and gas prices
-    electric_price, time_from, time_to = octopus.get_current_electricity_price(offset=0)
-    electric_price = float(electric_price)
-    gas_price = float(octopus.get_current_gas_price())
-    logger.info(msg=f"Electricity Price: {electric_price} - {time_from[11:16]} ~ {time_to[11:16]} | Gas Price: {gas_price}")
-
-    # Check if system is using the Grid & Predbat Status
-    grid_power = home_assistant.get_entity_state(sensor="sensor.givtcp_fd2327g123_grid_power")
-    predbat_status = home_assistant.get_entity_state(sensor="predbat.status")
-
-    if grid_power == "Entity not found":
-        logger.error(msg="Grid Power entity not found")
-        using_grid = False
-        grid_status = "No Grid Data"
+# The add-on's own home, or every home in homes.yaml in multi-home mode
+if MULTI_HOME:
+    HOME_SETTINGS = load_homes(path=f"{CONFIG_DIR}/homes.yaml", options=configurations)
+    logger.info(msg=f"Multi-home mode: {', '.join(HOME_SETTINGS)}")
+else:
+    HOME_SETTINGS = {"home": {key: configurations.get(key) for key in HOME_KEYS}}
+
+# Set up the shared HTTP sessions, each home can have max_concurrency requests in flight
+http_client.configure(timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, pool_size=max(10, MAX_CONCURRENCY * len(HOME_SETTINGS)))
+
+# Shared by every home: Agile & gas rates & weather responses for homes in the same place
+rate_store = RateStore(path=f"{CONFIG_DIR}/rates.db")
+weather_cache = SharedCache(max_age=60 * 5)
+scheduler = CycleScheduler(interval_minutes=CYCLE_MINUTES, overrun_policy=OVERRUN_POLICY)
+profiler = tracing.CycleProfiler(directory=f"{CONFIG_DIR}/profiles", cycles=PROFILE_CYCLES)
+
+# Start the read-only status API on the ingress port, http.server is only imported when it's on
+status_server = None
+if STATUS_API:
+    from status_server import StatusServer
+    status_server = StatusServer(port=STATUS_PORT)
+    status_server.start()
+
+# Initialise every home, a single home keeps its data in the config directory as before
+HOMES = []
+for name, settings in HOME_SETTINGS.items():
+    if MULTI_HOME:
+        HOMES.append(build_home(name=name, settings=settings, data_dir=f"{CONFIG_DIR}/homes/{name}", label=f"{name}/", weather_cache=weather_cache))
     else:
-        grid_power = float(grid_power)
-
-        if grid_power <= -35:
-            grid_status = "Importing"
-            using_grid = True
-        elif grid_power >= 35:
-            grid_status = "Exporting"
-            using_grid = False
-        else:
-            grid_status = "No Grid Activity"
-            using_grid = False
-            grid_power = 0
-
-    logger.info(msg=f"Grid Power: {grid_power} watts | Grid Status: {grid_status} | Predbat Status: {predbat_status}")
-
-    # Calculates time sector
-    time_sector = get_time_sector(sunrise=sunrise, sunset=sunset)
-
-    # Calculate radiator flow temperature
-    get_radiator_flow_temp(outside_temp=weather.weather_data["current"]["temp"])
-
-    # Finds temperatures next 3 hours
-    temp_hour_0 = weather.weather_data["hourly"][0]["temp"]
-    temp_hour_1 = weather.weather_data["hourly"][1]["temp"]
-    temp_hour_2 = weather.weather_data["hourly"][2]["temp"]
-    
-    log_line_break()
-
-    # Iterate through rooms and apply settings
-    for room in THERMOSTATS:
-        logger.info(msg=room.name.upper().replace('_', ' '))
-
-        # Refresh data
-        room.update_tado_data()
-
-        # Get target room temperature
-        target_temperature = getattr(room, time_sector)
-
-        # Log initial entries
-        logger.info(msg=f"Temperature: {room.current_temperature:.2f} | Climate: {room.climate_gas.upper()} | Mode: {room.tado_mode.upper()} | Electric Override: {str(room.electric_override).upper()}")
-        logger.info(msg=f"Outside Temperatures in the next 3 hours: {temp_hour_0:.2f} | {temp_hour_1:.2f} | {temp_hour_2:.2f}")
-        logger.info(msg=f"Sunrise: {sunrise} | Sunset: {sunset} | Solar Percentage: {solar_percentage} %")
-        logger.info(msg=f"Current weather - ID: {current_weather_id} | Condition: {current_weather_condition}")
-        logger.info(msg=f"Time Sector: {time_sector.upper()} | Target Temperature: {target_temperature:.2f}")
-
-        # Adjust target temperature
-        target_temperature -= room.away_adjust(target_temperature=target_temperature)
-
-        # Create / update target temperature entity
-        sensor = f"sensor.{room.name}_target_temperature"
+        HOMES.append(build_home(name=name, settings=settings, data_dir=CONFIG_DIR, label=""))
+# A cycle waits at most half the interval for the homes, a straggler finishes on its worker & is skipped until it has
+home_pool = HomePool(homes=HOMES, timeout=CYCLE_MINUTES * 60 / 2) if MULTI_HOME else None
+
+# A cycle started while another one is running, e.g. the warm start's background refresh, waits for it
+cycle_lock = threading.Lock()
+tracing.record_startup(stage="ready")
+
+def status_api_running():
+    return status_server is not None and status_server.running
+
+def publish_trace():
+    # Logs where the cycle's time went and publishes it as an entity & a Prometheus textfile
+    trace = tracing.finish_cycle()
+    if trace is None:
+        return
+    summary = trace.get_summary()
+    slowest_rooms = sorted(summary["rooms"].items(), key=lambda item: item[1], reverse=True)[:5]
+
+    phases = " | ".join(f"{name}: {seconds:.2f}s" for name, seconds in summary["phases"].items())
+    logger.info(msg=f"Cycle took {summary['duration']:.2f}s | HTTP: {summary['http_requests']} requests, {summary['http_errors']} failed, {summary['http_milliseconds']:.0f} ms | {phases}")
+    if summary["slowest_call"] is not None:
+        logger.info(msg=f"Slowest HTTP call: {summary['slowest_call']}")
+
+    # Create / update cycle timing entity, a multi-home trace covers every home so it only goes to the status API
+    if not MULTI_HOME:
+        sensor = "sensor.tado_optimiser_cycle"
         payload = {
-            "state": target_temperature,
+            "state": summary["duration"],
             "attributes": {
-                "unit_of_measurement": "°C",
-                "friendly_name": f"{room.name.replace('_', ' ').title()} Target",
-                "icon": "mdi:thermometer",
+                "unit_of_measurement": "s",
+                "friendly_name": "Tado Optimiser Cycle",
+                "icon": "mdi:timer-outline",
+                "Started": summary["started"],
+                "Phases (s)": summary["phases"],
+                "Slowest rooms (s)": dict(slowest_rooms),
+                "HTTP requests": summary["http_requests"],
+                "HTTP errors": summary["http_errors"],
+                "HTTP time (ms)": summary["http_milliseconds"],
+                "Bytes sent": summary["http_bytes_sent"],
+                "Bytes received": summary["http_bytes_received"],
+                "Slowest call": summary["slowest_call"],
+                "Overruns": scheduler.overruns,
+                "Skipped cycles": scheduler.skipped,
+                "Time to first decision (s)": tracing.startup.get("first_decision"),
+                "Endpoints": [f"{e['count']}x {e['method']} {e['service']}{e['endpoint']} {e['milliseconds']:.0f} ms" for e in summary["endpoints"][:10]],
             }
         }
-        home_assistant.update_entity(sensor=sensor, payload=payload)
-
-        # Control rooms
-        room.set_hvac_mode(
-            target_temperature=target_temperature,
-            temp_hour_0=temp_hour_0,
-            temp_hour_1=temp_hour_1,
-            electric_price=electric_price,
-            gas_price=gas_price,
-            using_grid=using_grid,
-        )
-
-        log_line_break()
-
-    logger.info(msg="Update cycle finished")
-    log_line_break()
+        HOMES[0].home_assistant.update_entity(sensor=sensor, payload=payload)
+
+    metrics = tracing.prometheus_text(trace=trace)
+    try:
+        tracing.write_prometheus(path=f"{CONFIG_DIR}/tado_optimiser.prom", text=metrics)
+    except OSError as error:
+        logger.error(msg=f"Error writing Prometheus metrics: {error}")
+
+    if status_api_running():
+        status_server.publish_json(path="/api/cycle", data={**summary, "startup": tracing.startup})
+        status_server.publish(path="/metrics", body=metrics, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def publish_status(homes):
+    # A single home is served at /api, in multi-home mode each home is under /api/homes/<name>
+    if not status_api_running():
+        return
+    if not MULTI_HOME:
+        HOMES[0].publish_status(status_server=status_server)
+        return
+
+    for home in homes:
+        home.publish_status(status_server=status_server, prefix=f"/api/homes/{home.name}")
+    status_server.publish_json(path="/api/homes", data=[
+        {"name": home.name, "started": home.last_started, "duration": home.last_duration, "error": home.last_error}
+        for home in HOMES
+    ])
+
+def main(cached=False):
+    # Every cycle is traced, and profiled for the first profile_cycles cycles
+    with cycle_lock:
+        tracing.start_cycle()
+        profiler.start()
+        try:
+            if MULTI_HOME:
+                homes = home_pool.run_cycle(cached=cached)
+            else:
+                HOMES[0].run_cycle(cached=cached)
+                homes = HOMES
+            with tracing.phase(name="status"):
+                publish_status(homes=homes)
+        finally:
+            profiler.stop()
+            publish_trace()
+
+def warm_start():
+    # Controls the rooms straight away from saved weather, prices & thermal models, then brings everything up to date in the background
+    scheduler.run_safely(name="Warm start cycle", function=main, cached=True)
+    threading.Thread(target=refresh_in_background, name="warm_start", daemon=True).start()
+
+def bootstrap(home):
+    # Holds the cycle lock so fitting the models doesn't race a scheduled cycle's observe() & save()
+    with cycle_lock:
+        home.bootstrap()
+
+def refresh_in_background():
+    # Fits missing thermal models & runs a full cycle with fresh data, the scheduled cycles wait for it if it's slow
+    for home in HOMES:
+        scheduler.run_safely(name=f"Thermal model bootstrap for {home.name}", function=bootstrap, home=home)
+    scheduler.run_safely(name="Update cycle", function=main)
+    tracing.record_startup(stage="background_refresh")
+
+def shutdown():
+    # Called once the scheduler has stopped, the last cycle's HVAC commands have already been sent, a background cycle gets a minute to finish
+    if cycle_lock.acquire(timeout=60):
+        cycle_lock.release()
+    if status_server is not None:
+        status_server.stop()
+    if home_pool is not None:
+        home_pool.stop()
+    for home in HOMES:
+        home.stop()
+    http_client.close_sessions()
+    logger.info(msg="Tado Optimiser stopped")
+
+def run_forever():
+    # Stops cleanly on SIGTERM from s6, letting a running cycle finish first
+    scheduler.install_signal_handlers()
+    if WARM_START:
+        warm_start()
+    else:
+        scheduler.run_safely(name="Update cycle", function=main)
 
-main()
+    # Clears out old snapshots & history once a day
+    for home in HOMES:
+        scheduler.add_daily(at="03:30", function=home.compact)
 
-#  Schedule to run every 5 minutes
-for minute in ["00:00", "05:00", "10:00", "15:00", "20:00", "25:00", "30:00", "35:00", "40:00", "45:00", "50:00", "55:00"]:
-    schedule.every().hour.at(minute).do(main)
+    # Runs every cycle_minutes until stopped
+    scheduler.run(cycle=main)
+    shutdown()
 
-# Keeps schedule running
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+# Importing main sets everything up without running the cycle, used by the benchmarks
+if __name__ == "__main__":
+    run_forever()
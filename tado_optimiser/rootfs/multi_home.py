@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import yaml
+
+import tracing
+
+logger = logging.getLogger("tado_optimiser")
+
+# Keys a home in homes.yaml may set, anything missing falls back to the add-on's options
+HOME_KEYS = ("home_assistant_url", "home_assistant_ws_url", "home_assistant_token", "open_weather_api", "octopus_api", "octopus_account", "latitude", "longitude")
+
+
+class SharedCache:
+    # Upstream responses shared between homes, one fetch per key while it is fresh however many homes ask for it
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.values = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get_lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def get_or_fetch(self, key, fetch):
+        # Homes asking for the same key wait for the first one's fetch, a failed fetch (None) isn't kept
+        with self.get_lock(key=key):
+            cached = self.values.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.max_age:
+                tracing.count(name="shared_fetch_hits")
+                logger.debug(msg=f"Shared {key[0]} data reused")
+                return cached[1]
+
+            value = fetch()
+            if value is not None:
+                self.values[key] = (time.monotonic(), value)
+            return value
+
+
+def load_homes(path, options):
+    # Reads homes.yaml, {name: settings}, each home falling back to the add-on options for anything it doesn't set
+    if not os.path.exists(path):
+        logger.error(msg=f"Multi-home mode needs {path}, running the add-on's home only")
+        return {"home": {key: options.get(key) for key in HOME_KEYS}}
+
+    with open(path, "r") as file:
+        homes = (yaml.safe_load(file) or {}).get("homes") or {}
+
+    loaded = {}
+    for name, settings in homes.items():
+        settings = settings or {}
+        unknown = set(settings) - set(HOME_KEYS)
+        if unknown:
+            logger.warning(msg=f"Home {name}: unknown settings ignored: {', '.join(sorted(unknown))}")
+        loaded[str(name)] = {key: settings.get(key, options.get(key)) for key in HOME_KEYS}
+
+    if not loaded:
+        logger.error(msg=f"No homes found in {path}, running the add-on's home only")
+        return {"home": {key: options.get(key) for key in HOME_KEYS}}
+    return loaded
+
+
+def get_websocket_url(settings):
+    # An explicit WebSocket URL, else the REST URL with a ws scheme, else the supervisor's
+    if settings.get("home_assistant_ws_url"):
+        return settings["home_assistant_ws_url"]
+    if not settings.get("home_assistant_url"):
+        return None
+    url = urlparse(settings["home_assistant_url"])
+    scheme = "wss" if url.scheme == "https" else "ws"
+    path = url.path.rstrip("/")
+    if path.endswith("/api"):
+        path = path[:-len("/api")]
+    return url._replace(scheme=scheme, path=f"{path}/api/websocket").geturl()
+
+
+class HomePool:
+    # Runs every home's cycle on its own worker, a slow or failing home doesn't hold up the others
+    def __init__(self, homes, timeout):
+        self.homes = homes
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(homes)), thread_name_prefix="home")
+        self.running = {}
+
+    def run_cycle(self, cached=False):
+        # Returns the homes whose cycle finished this time round
+        futures = {}
+        for home in self.homes:
+            future = self.running.get(home.name)
+            if future is not None and not future.done():
+                logger.warning(msg=f"Home {home.name} still running its last cycle, skipped this cycle")
+                tracing.count(name="home_cycles_skipped")
+                continue
+            futures[home.name] = self.executor.submit(self.run_home, home=home, cached=cached)
+        self.running.update(futures)
+
+        done, pending = wait(futures.values(), timeout=self.timeout)
+        finished = []
+        for home in self.homes:
+            future = futures.get(home.name)
+            if future is None:
+                continue
+            if future in pending:
+                logger.warning(msg=f"Home {home.name} still running after {self.timeout:.0f}s, carrying on without it")
+            elif future.result():
+                finished.append(home)
+        return finished
+
+    def run_home(self, home, cached=False):
+        try:
+            home.run_cycle(cached=cached)
+            return True
+        except Exception as error:
+            logger.exception(msg=f"Home {home.name} cycle failed: {error}")
+            return False
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
+
@@ -1,238 +1,292 @@
-import json
 import logging
 import os
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
 
-import requests
 from requests.auth import HTTPBasicAuth
 
-from home_assistant_api import HomeAssistantAPI
+import http_client
+from rate_store import RateStore
+from rate_timeline import RateTimeline, format_time
+from resilience import age_seconds, get_breaker
+from snapshot_store import SnapshotStore
 
 logger = logging.getLogger("tado_optimiser")
 
-home_assistant = HomeAssistantAPI()
 
 class Octopus:
-    def __init__(self, octopus_api, octopus_account):
-        self.baseUrl = "https://api.octopus.energy"
+    def __init__(self, octopus_api, octopus_account, home_assistant, snapshot_store=None, rate_store=None):
+        self.baseUrl = os.getenv("OCTOPUS_URL", "https://api.octopus.energy")
+        self.home_assistant = home_assistant
         self.account = octopus_account
         self.user_name = octopus_api
         self.pass_word = ""
         self.account_data = {}
         self.account_data_last_updated = ""
-        self.agile_rates = {}
+        self.agile_tariff = None
         self.agile_rates_last_updated = ""
-        self.gas_rates = {}
+        self.gas_tariff = None
         self.gas_rates_last_updated = ""
+        self.agile_timeline = RateTimeline(results=[])
+        self.gas_timeline = RateTimeline(results=[])
+        self.rate_store = rate_store or RateStore()
+        self.snapshot_store = snapshot_store or SnapshotStore()
+        # One breaker per account so one home's bad credentials don't stop the others
+        self.breaker = get_breaker(name=f"Octopus {octopus_account}")
+
+    def get_data_ages(self):
+        # Seconds since each Octopus data set was last refreshed
+        return {
+            "account": age_seconds(last_updated=self.account_data_last_updated),
+            "agile": age_seconds(last_updated=self.rate_store.last_synced(tariff=self.agile_tariff)) if self.agile_tariff else None,
+            "gas": age_seconds(last_updated=self.rate_store.last_synced(tariff=self.gas_tariff)) if self.gas_tariff else None,
+        }
 
     def update_octopus_data(self):
         # Updates all Octopus data if required
-        now = datetime.now()
-
         # ****************************************************************************************************************
         # Deal with Account data
 
-        # Checks to see if account data files are present and if not runs plan to make new ones
-        if not os.path.exists("/config/account_data.json") or not os.path.exists("/config/account_data_last_updated.txt"):
-            logger.info(msg="Octopus account data backup files not present running plan to make new ones")
+        # If no data in system load the snapshot, or get new data if there isn't one
+        if not self.load_account_snapshot():
+            logger.info(msg="Octopus account data snapshot not present getting new data")
             self.update_account_data()
 
-        # If data files are present but no data in system load them
-        elif self.account_data_last_updated == "" or self.account_data == {}:
-            with open("/config/account_data.json", "r") as f:
-                self.account_data = json.load(f)
-            with open("/config/account_data_last_updated.txt", "r") as f:
-                self.account_data_last_updated = f.read()
-
-            logger.info(msg="Octopus account data loaded from backup files")
-
         # Checks last updated time and updates account data if needed
-        if (now - datetime.strptime(self.account_data_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > (3600 * 24) - 60:
+        account_age = age_seconds(last_updated=self.account_data_last_updated)
+        if account_age is None:
+            logger.error(msg="No Octopus account data available")
+        elif account_age > (3600 * 24) - 60:
             self.update_account_data()
-        else:
-            if (now - datetime.strptime(self.account_data_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 30:
-                logger.info(msg=f"Octopus account data not updated. Last updated: {self.account_data_last_updated}")
-
-        # ****************************************************************************************************************
-        # Deal with Agile rates
-
-        # Checks time and updates Agile rates are present and if not runs plan to make new ones
-        if not os.path.exists("/config/agile_rates.json") or not os.path.exists("/config/agile_rates_last_updated.txt"):
-            logger.info(msg="Agile rates backup files not present running plan to make new ones")
-            self.get_agile_rates()
-
-        # If data files are present but no data in system load them
-        elif self.agile_rates_last_updated == "" or self.agile_rates == {}: 
-            with open("/config/agile_rates.json", "r") as f:
-                self.agile_rates = json.load(f)
-            with open("/config/agile_rates_last_updated.txt", "r") as f:
-                self.agile_rates_last_updated = f.read()
-
-            logger.info(msg="Agile rates loaded from backup files")
-
-        # Checks last updated time and updates Agile rates if needed
-        if (now - datetime.strptime(self.agile_rates_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 3600 - 60:
-            self.get_agile_rates() 
-        else:
-            if (now - datetime.strptime(self.agile_rates_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 30:
-                logger.info(msg=f"Agile rates not updated. Last updated: {self.agile_rates_last_updated}")
+        elif account_age > 30:
+            logger.info(msg=f"Octopus account data not updated. Last updated: {self.account_data_last_updated}", extra={"rate_limit": True})
 
         # ****************************************************************************************************************
-        # Deal with Gas rates
+        # Deal with Agile & Gas rates, only the missing window is downloaded and merged into the rate store
+        # Homes sharing a rate store & tariff sync it once, the others find it fresh when they get the lock
 
-        # Checks time and updates gas rates  are present and if not runs plan to make new ones
-        if not os.path.exists("/config/gas_rates.json") or not os.path.exists("/config/gas_rates_last_updated.txt"):
-            logger.info(msg="Gas rates backup files not present running plan to make new ones")
-            self.get_gas_rates()
+        if self.agile_tariff is not None:
+            with self.rate_store.sync_lock(tariff=self.agile_tariff):
+                if self.agile_needs_sync():
+                    self.sync_rates(tariff_code=self.agile_tariff, kind="electricity")
+                elif self.agile_rates_last_updated != "":
+                    logger.info(msg=f"Agile rates not updated. Last updated: {self.agile_rates_last_updated}", extra={"rate_limit": True})
 
-        # If data files are present but no data in system load them
-        elif self.gas_rates_last_updated == "" or self.gas_rates == {}: 
-            with open("/config/gas_rates.json", "r") as f:
-                self.gas_rates = json.load(f)
-            with open("/config/gas_rates_last_updated.txt", "r") as f:
-                self.gas_rates_last_updated = f.read()
+        if self.gas_tariff is not None:
+            with self.rate_store.sync_lock(tariff=self.gas_tariff):
+                if self.gas_needs_sync():
+                    self.sync_rates(tariff_code=self.gas_tariff, kind="gas")
+                elif self.gas_rates_last_updated != "":
+                    logger.info(msg=f"Gas rates not updated. Last updated: {self.gas_rates_last_updated}", extra={"rate_limit": True})
 
-            logger.info(msg="Gas rates loaded from backup files")
-
-        # Checks last updated time and updates gas rates if needed
-        if (now - datetime.strptime(self.gas_rates_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 3600 - 60:
-            self.get_gas_rates()
-        else:
-            if (now - datetime.strptime(self.gas_rates_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 30:
-                logger.info(msg=f"Gas rates not updated. Last updated: {self.agile_rates_last_updated}")
+        self.build_timelines()
 
         # ****************************************************************************************************************
 
         # Creates / updates entities
         self.update_agile_entities()
 
+    def load_account_snapshot(self):
+        # Loads the account snapshot if nothing is in memory yet, False if there is no account data at all
+        if self.account_data_last_updated != "" and self.account_data != {}:
+            return True
+        account_data, last_updated = self.snapshot_store.load(name="account")
+        if account_data is None:
+            return False
+        self.account_data = account_data
+        self.account_data_last_updated = last_updated
+        self.resolve_tariffs()
+        logger.info(msg="Octopus account data loaded from snapshot")
+        return True
+
+    def load_cached(self):
+        # Warm start: the account snapshot & the rates already in the rate store, without any requests
+        if not self.load_account_snapshot():
+            logger.warning(msg="No Octopus account snapshot, prices unavailable until Octopus is reached")
+            return
+        self.build_timelines()
+
     def action_get(self, full_url):
-        # Main Action-Get function if it fails will stay in loop
-        response = requests.get(full_url, auth=HTTPBasicAuth(username=self.user_name, password=self.pass_word))
+        # Main Action-Get function, returns None if it fails or Octopus is in backoff
+        if not self.breaker.allow():
+            logger.info(msg=f"Octopus data not requested, circuit {self.breaker.describe().lower()}", extra={"rate_limit": True})
+            return None
 
-        status = response.status_code
+        response = http_client.request("octopus", "GET", full_url, auth=HTTPBasicAuth(username=self.user_name, password=self.pass_word))
+
+        status = response.status_code if response is not None else None
         if status == 200:
+            self.breaker.record_success()
             logger.debug(msg="Octopus data successfully retrieved")
             return response.json()
         else:
-            logger.error(msg=f"Error: {response.status_code, response.text}")
-            logger.error(msg=f"Error getting Octopus data. Status code: {status} Will try again in 1 minute")
-            time.sleep(60)
-            self.action_get(full_url=full_url)
+            if response is not None:
+                logger.error(msg=f"Error: {response.status_code, response.text}")
+            logger.error(msg=f"Error getting Octopus data. Status code: {status}")
+            self.breaker.record_failure()
+            return None
 
     def update_account_data(self):
         # Gets basic account details
         end_point = f"/v1/accounts/{self.account}"
         full_url = self.baseUrl + end_point
-        self.account_data = self.action_get(full_url=full_url)
+        account_data = self.action_get(full_url=full_url)
+        if account_data is None:
+            logger.error(msg=f"Account data not updated, using data from: {self.account_data_last_updated or 'None'}", extra={"rate_limit": True})
+            return
+
+        self.account_data = account_data
         self.account_data_last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Write formatted json to file & records timestamp
-        with open("/config/account_data.json", "w") as f:
-            json.dump(self.account_data, f, indent=4)
-        with open("/config/account_data_last_updated.txt", "w") as f:
-            f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        # Saves data & timestamp together
+        self.snapshot_store.save(name="account", data=self.account_data, last_updated=self.account_data_last_updated)
 
         logger.info(msg=f"Account data updated: {self.account_data_last_updated}")
+        self.resolve_tariffs()
 
-    def get_agile_rates(self):
-        # Gets Agile rates from account details
-        for meter in self.account_data["properties"][0]["electricity_meter_points"]:
-            if not meter["is_export"]:
-                for agreement in meter["agreements"]:
-                    valid_from = datetime.strptime(agreement["valid_from"][:10], "%Y-%m-%d").date()
-                    valid_to = agreement["valid_to"]
-
-                    # if the date is None, set it to a date in the future + 500 days
-                    if valid_to is None:
-                        valid_to = (datetime.now() + timedelta(days=500)).date()
-                    else:
-                        valid_to = datetime.strptime(agreement["valid_to"][:10], "%Y-%m-%d").date()
-
-                    if valid_from < datetime.now().date() < valid_to:
-                        tariff_code = agreement["tariff_code"]
-                        product_code = tariff_code[5:-2]
-                        end_point = f"/v1/products/{product_code}/electricity-tariffs/{tariff_code}/standard-unit-rates/"
-                        full_url = self.baseUrl + end_point
-                        self.agile_rates = self.action_get(full_url=full_url)
-                        self.agile_rates_last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                        # Write formatted json to file & records timestamp
-                        with open("/config/agile_rates.json", "w") as f:
-                            json.dump(self.agile_rates, f, indent=4)
-
-                        with open("/config/agile_rates_last_updated.txt", "w") as f:
-                            f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-
-                        logger.info(msg=f"Agile rates updated: {self.agile_rates_last_updated}")
-
-    def get_gas_rates(self):
-        # Gets gas rates from account details
-        now = datetime.now()
-        for agreement in self.account_data["properties"][0]["gas_meter_points"][0]["agreements"]:
+    def get_active_tariff(self, agreements):
+        # Returns the tariff code of the agreement valid today
+        today = datetime.now().date()
+        for agreement in agreements:
             valid_from = datetime.strptime(agreement["valid_from"][:10], "%Y-%m-%d").date()
             valid_to = agreement["valid_to"]
 
             # if the date is None, set it to a date in the future + 500 days
             if valid_to is None:
-                valid_to = now + timedelta(days=500)
+                valid_to = today + timedelta(days=500)
             else:
-                valid_to = datetime.strptime(agreement["valid_to"][:10], "%Y-%m-%d").date()
+                valid_to = datetime.strptime(valid_to[:10], "%Y-%m-%d").date()
 
-            logger.debug(msg=f"Valid from: {valid_from} - Valid to: {valid_to}")
+            logger.debug(msg=f"Tariff: {agreement['tariff_code']} Valid from: {valid_from} - Valid to: {valid_to}")
+            if valid_from <= today < valid_to:
+                return agreement["tariff_code"]
+        return None
 
-            if valid_from < datetime.now().date() < valid_to:
-                tariff_code = agreement["tariff_code"]
-                product_code = tariff_code[5:-2]
-                end_point = f"/v1/products/{product_code}/gas-tariffs/{tariff_code}/standard-unit-rates/"
-                full_url = self.baseUrl + end_point
-                self.gas_rates = self.action_get(full_url=full_url)
-                self.gas_rates_last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def resolve_tariffs(self):
+        # Works out the import electricity & gas tariffs from the account, only when account data changes
+        if not self.account_data:
+            return
 
-                # Write formatted json to file & records timestamp
-                with open("/config/gas_rates.json", "w") as f:
-                    json.dump(self.gas_rates, f, indent=4)
-                with open("/config/gas_rates_last_updated.txt", "w") as f:
-                    f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-
-                logger.info(msg=f"Gas rates updated: {self.agile_rates_last_updated}")
+        agile_tariff = None
+        for meter in self.account_data["properties"][0]["electricity_meter_points"]:
+            if not meter["is_export"]:
+                agile_tariff = self.get_active_tariff(agreements=meter["agreements"]) or agile_tariff
+
+        gas_tariff = None
+        gas_meter_points = self.account_data["properties"][0].get("gas_meter_points", [])
+        if gas_meter_points:
+            gas_tariff = self.get_active_tariff(agreements=gas_meter_points[0]["agreements"])
+
+        if (agile_tariff, gas_tariff) != (self.agile_tariff, self.gas_tariff):
+            logger.info(msg=f"Octopus tariffs: Electricity: {agile_tariff} | Gas: {gas_tariff}")
+        self.agile_tariff = agile_tariff
+        self.gas_tariff = gas_tariff
+
+    def agile_needs_sync(self, now=None):
+        # Syncs when prices are running out, or once tomorrow's prices are due after 16:00 until they arrive
+        now = now or datetime.now().astimezone()
+        coverage_end = self.rate_store.coverage_end(tariff=self.agile_tariff)
+        since_sync = now.timestamp() - self.rate_store.last_synced(tariff=self.agile_tariff)
+
+        if coverage_end < now.timestamp() + 3600:
+            return True
+        if since_sync < 60 * 30:
+            return False
+
+        tomorrow_end = (now + timedelta(days=1)).replace(hour=22, minute=0, second=0, microsecond=0).timestamp()
+        return coverage_end < now.timestamp() + 3600 * 5 or (now.hour >= 16 and coverage_end < tomorrow_end)
+
+    def gas_needs_sync(self):
+        # Gas prices rarely change, checked once a day
+        return time.time() - self.rate_store.last_synced(tariff=self.gas_tariff) > 3600 * 24 - 60
+
+    def sync_rates(self, tariff_code, kind):
+        # Downloads rates from the start of the last known slot onwards, following pagination
+        product_code = tariff_code[5:-2]
+        end_point = f"/v1/products/{product_code}/{kind}-tariffs/{tariff_code}/standard-unit-rates/"
+
+        latest_start = self.rate_store.latest_start(tariff=tariff_code)
+        period_from = time.time() - 3600 * 24 if latest_start is None else max(latest_start, time.time() - 3600 * 24 * 2)
+        params = {"period_from": datetime.fromtimestamp(period_from, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}
+        full_url = f"{self.baseUrl}{end_point}?{urlencode(params)}"
+
+        results = []
+        pages = 0
+        while full_url:
+            data = self.action_get(full_url=full_url)
+            if data is None:
+                logger.error(msg=f"Error syncing {kind} rates for {tariff_code}, keeping stored rates")
+                return
+            results.extend(data["results"])
+            full_url = data.get("next")
+            pages += 1
+
+        self.rate_store.merge(tariff=tariff_code, results=results)
+        self.rate_store.prune(before=time.time() - 3600 * 24 * 90)
+        last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if kind == "electricity":
+            self.agile_rates_last_updated = last_updated
+            logger.info(msg=f"Agile rates updated: {last_updated} | {len(results)} slots from {pages} pages")
+        else:
+            self.gas_rates_last_updated = last_updated
+            logger.info(msg=f"Gas rates updated: {last_updated} | {len(results)} slots from {pages} pages")
+
+    def build_timelines(self):
+        # Rebuilds the lookup timelines from the rate store, from a day ago onwards
+        since = time.time() - 3600 * 24
+        if self.agile_tariff is not None:
+            self.agile_timeline = RateTimeline.from_slots(slots=self.rate_store.get_slots(tariff=self.agile_tariff, since=since))
+            logger.debug(msg=f"Agile timeline built: {len(self.agile_timeline)} slots")
+        if self.gas_tariff is not None:
+            # Only direct debit prices are used
+            self.gas_timeline = RateTimeline.from_slots(slots=self.rate_store.get_slots(tariff=self.gas_tariff, since=since, payment_methods=("DIRECT_DEBIT", None)))
+            logger.debug(msg=f"Gas timeline built: {len(self.gas_timeline)} slots")
 
     def get_current_electricity_price(self, offset):
-        # Gets the Agile price based on the offset passed
-        now = datetime.now()
-        for rate in self.agile_rates["results"]:
-            valid_from = datetime.strptime(rate["valid_from"], "%Y-%m-%dT%H:%M:%SZ")
-            valid_to = datetime.strptime(rate["valid_to"], "%Y-%m-%dT%H:%M:%SZ")
-
-            if valid_from <= (now + timedelta(minutes=offset)) < valid_to:
-                logger.debug(msg=f"Price: {rate['value_inc_vat']} - From: {rate['valid_from'][:-1].replace('T', ' ')} To: {rate['valid_to'][:-1].replace('T', ' ')}")
-                return rate["value_inc_vat"], rate["valid_from"], rate["valid_to"]
+        # Gets the Agile price based on the offset passed, times are returned in local time
+        slot = self.agile_timeline.price_at(epoch=time.time() + offset * 60)
+        if slot is None:
+            logger.error(msg=f"No Agile price found for offset: {offset} minutes")
+            return None
+
+        price, valid_from, valid_to = slot
+        time_from = format_time(epoch=valid_from)
+        time_to = format_time(epoch=valid_to)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg=f"Price: {price} - From: {time_from.replace('T', ' ')} To: {time_to.replace('T', ' ')}")
+        return price, time_from, time_to
+
+    def get_agile_slots(self, hours):
+        # Gets every Agile slot from now for the next number of hours
+        now = time.time()
+        return self.agile_timeline.slots_between(start=now, end=now + hours * 3600)
+
+    def get_price_horizon(self, hours):
+        # Returns (start, end, electric price, gas price) for each half-hour from the current one, None where not yet known
+        start = time.time() // 1800 * 1800
+        horizon = []
+        for slot_start in range(int(start), int(start + hours * 3600), 1800):
+            electric = self.agile_timeline.price_at(epoch=slot_start)
+            gas = self.gas_timeline.price_at(epoch=slot_start)
+            horizon.append((slot_start, slot_start + 1800, electric and electric[0], gas and gas[0]))
+        return horizon
 
     def get_current_gas_price(self):
         # Gets the current gas price
-        now = datetime.now()
-        for rate in self.gas_rates["results"]:
-            payment_method = rate["payment_method"]
-            valid_from = datetime.strptime(rate["valid_from"], "%Y-%m-%dT%H:%M:%SZ")
-            valid_to = rate["valid_to"]
-
-            # if the date is None, set it to a date in the future + 500 days
-            if valid_to is None:
-                valid_to = now + timedelta(days=500)
-            else:
-                valid_to = datetime.strptime(rate["valid_to"], "%Y-%m-%dT%H:%M:%SZ")
-
-            logger.debug(msg=f"Valid from: {valid_from} - Valid to: {valid_to} - Payment method: {payment_method}")
-            
-            if valid_from <= now < valid_to:
-                if payment_method == "DIRECT_DEBIT" or payment_method is None:
-                    return rate["value_inc_vat"]
+        slot = self.gas_timeline.price_at(epoch=time.time())
+        if slot is None:
+            logger.error(msg="No gas price found")
+            return None
+        return slot[0]
 
     def update_agile_entities(self):
         # Creates / updates entities
         for offset in range(0, 271, 30):
-            price, time_from, time_to = self.get_current_electricity_price(offset=offset)
+            slot = self.get_current_electricity_price(offset=offset)
+            if slot is None:
+                break
+            price, time_from, time_to = slot
             sensor = f"sensor.agile_electricity_price_{offset}"
             payload = {
                 "state": price,
@@ -242,6 +296,6 @@ class Octopus:
                     "icon": "mdi:currency-gbp",
                 }
             }
-            home_assistant.update_entity(sensor=sensor, payload=payload)
+            self.home_assistant.update_entity(sensor=sensor, payload=payload)
 
         logger.info(msg="Agile entities created / updated")
@@ -0,0 +1,163 @@
+import logging
+import math
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("tado_optimiser")
+
+SLOT_SECONDS = 1800
+
+# Room response used until a room has a learned thermal model
+DEFAULT_HEAT_RATE = 3.0  # °C per hour the gas radiator adds, before losses
+DEFAULT_LOSS_RATE = 0.1  # Share of the indoor / outdoor difference lost per hour
+
+# Pence per °C per half-hour for being below the target, and below the coasting floor
+DISCOMFORT_COST = 5.0
+FLOOR_PENALTY = 100.0
+
+TEMPERATURE_STEP = 0.25
+
+# One half-hour of the planning horizon, shared by every room
+HorizonSlot = namedtuple("HorizonSlot", ["start", "end", "electric_price", "gas_price", "outside_temperature", "time_sector"])
+
+# One half-hour of a room's plan, temperature is the predicted room temperature at the end of the slot
+PlanSlot = namedtuple("PlanSlot", ["start", "end", "action", "target", "temperature", "cost"])
+
+RoomPlan = namedtuple("RoomPlan", ["slots", "setpoint", "cost"])
+
+
+def time_sector_at(moment, sunrise, sunset, minutes_before_sunset):
+    # Day runs from sunrise until a while before sunset, then evening until midnight, then night
+    sunset = (datetime.combine(moment.date(), sunset) - timedelta(minutes=minutes_before_sunset)).time()
+    now = moment.time()
+    if sunrise <= now < sunset:
+        return "day"
+    elif sunset <= now < datetime.strptime("23:59", "%H:%M").time():
+        return "evening"
+    return "night"
+
+
+def build_horizon(prices, forecast, minutes_before_sunset):
+    # Combines prices, the forecast interpolated to the middle of each slot & daily sun times into HorizonSlots
+    sun_times = {}
+    horizon = []
+    for start, end, electric_price, gas_price in prices:
+        moment = datetime.fromtimestamp(start)
+        if moment.date() not in sun_times:
+            sun_times[moment.date()] = forecast.get_sun_times(date=moment.date())
+        sunrise, sunset = sun_times[moment.date()]
+        horizon.append(HorizonSlot(
+            start=start,
+            end=end,
+            electric_price=electric_price,
+            gas_price=gas_price,
+            outside_temperature=round(forecast.temperature_at(moment=(start + end) / 2), 2),
+            time_sector=time_sector_at(moment=moment, sunrise=sunrise, sunset=sunset, minutes_before_sunset=minutes_before_sunset),
+        ))
+    return horizon
+
+
+class HeatingPlanner:
+    # Plans each room's heating over the price horizon, pre-heating before expensive slots & coasting through them
+    def __init__(self, preheat_margin=1.0, coast_margin=0.5):
+        self.preheat_margin = preheat_margin
+        self.coast_margin = coast_margin
+        self.plans = {}
+
+    def plan_room(self, spec, horizon, current_temperature, target_offset=0.0, electric_allowed_now=True, heat_rate=DEFAULT_HEAT_RATE, loss_rate=DEFAULT_LOSS_RATE):
+        # Returns the room's RoomPlan, reusing the last one when none of its inputs have changed
+        if not horizon:
+            return None
+
+        key = (spec, horizon, round(current_temperature, 1), target_offset, electric_allowed_now, heat_rate, loss_rate)
+        cached = self.plans.get(spec.name)
+        if cached is not None and cached[0] == key:
+            logger.debug("%s plan unchanged", spec.display_name)
+            return cached[1]
+
+        started = time.perf_counter()
+        plan = self.solve(spec, horizon, current_temperature, target_offset, electric_allowed_now, heat_rate, loss_rate)
+        self.plans[spec.name] = (key, plan)
+        logger.debug("%s plan computed in %.1f ms", spec.display_name, (time.perf_counter() - started) * 1000)
+        return plan
+
+    def forget(self, names):
+        # Drops cached plans for rooms no longer in the settings
+        for name in list(self.plans):
+            if name not in names:
+                del self.plans[name]
+
+    def get_actions(self, spec, slot, index, electric_allowed_now, heat_rate):
+        # Returns (action, heat rate °C/h, cost in pence) for everything the room can do in the slot
+        hours = (slot.end - slot.start) / 3600
+        gas_price = slot.gas_price if slot.gas_price is not None else 0.0
+        gas_power = (spec.gas_radiator_power or 0) / 1000
+        actions = [("off", 0.0, 0.0), ("gas", heat_rate, gas_power * hours * gas_price)]
+
+        if spec.electric_override and slot.electric_price is not None and (index > 0 or electric_allowed_now):
+            electric_power = spec.electric_radiator_power / 1000
+            actions.append(("electric", heat_rate * electric_power / gas_power, electric_power * hours * slot.electric_price))
+        return actions
+
+    def solve(self, spec, horizon, current_temperature, target_offset, electric_allowed_now, heat_rate, loss_rate):
+        # Backward dynamic programme over a grid of room temperatures, then follows the policy from the current temperature
+        targets = [getattr(spec, slot.time_sector) - target_offset for slot in horizon]
+        low = min(min(targets) - self.coast_margin - 1.5, current_temperature)
+        high = max(max(targets) + self.preheat_margin, current_temperature)
+        count = int((high - low) / TEMPERATURE_STEP) + 2
+        grid = [low + i * TEMPERATURE_STEP for i in range(count)]
+
+        # Without a radiator power the gas cost can't be worked out, so heating is costed by run time
+        if not spec.gas_radiator_power:
+            spec = spec._replace(gas_radiator_power=1000)
+
+        transitions = []
+        for index, slot in enumerate(horizon):
+            hours = (slot.end - slot.start) / 3600
+            decay = math.exp(-loss_rate * hours)
+            options = []
+            for action, rate, cost in self.get_actions(spec, slot, index, electric_allowed_now, heat_rate):
+                # Room temperature heads exponentially towards the temperature the radiator could hold it at
+                equilibrium = slot.outside_temperature + rate / loss_rate
+                options.append((action, cost, equilibrium, decay))
+            transitions.append(options)
+
+        values = [0.0] * count
+        policy = [None] * len(horizon)
+        last = count - 1
+        for index in range(len(horizon) - 1, -1, -1):
+            target = targets[index]
+            floor = target - self.coast_margin
+            new_values = [math.inf] * count
+            choices = [0] * count
+            for choice, (action, cost, equilibrium, decay) in enumerate(transitions[index]):
+                for state, temperature in enumerate(grid):
+                    next_temperature = equilibrium + (temperature - equilibrium) * decay
+                    total = cost
+                    if next_temperature < target:
+                        total += (target - next_temperature) * DISCOMFORT_COST
+                        if next_temperature < floor:
+                            total += (floor - next_temperature) * FLOOR_PENALTY
+                    next_state = min(max(int((next_temperature - low) / TEMPERATURE_STEP + 0.5), 0), last)
+                    total += values[next_state]
+                    if total < new_values[state]:
+                        new_values[state] = total
+                        choices[state] = choice
+            values = new_values
+            policy[index] = choices
+
+        slots = []
+        temperature = current_temperature
+        total_cost = 0.0
+        for index, slot in enumerate(horizon):
+            state = min(max(int((temperature - low) / TEMPERATURE_STEP + 0.5), 0), last)
+            action, cost, equilibrium, decay = transitions[index][policy[index][state]]
+            temperature = equilibrium + (temperature - equilibrium) * decay
+            total_cost += cost
+            slots.append(PlanSlot(start=slot.start, end=slot.end, action=action, target=targets[index], temperature=round(temperature, 2), cost=round(cost, 2)))
+
+        # Heating thermostats are set to the target, or higher when the plan is pre-heating
+        first = slots[0]
+        setpoint = round(min(max(first.target, first.temperature), first.target + self.preheat_margin), 1)
+        return RoomPlan(slots=tuple(slots), setpoint=setpoint, cost=round(total_cost, 2))
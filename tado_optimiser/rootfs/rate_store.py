@@ -0,0 +1,98 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from rate_timeline import parse_time
+
+logger = logging.getLogger("tado_optimiser")
+
+
+class RateStore:
+    # Persistent store of Octopus unit rates keyed by tariff and slot
+    def __init__(self, path="/config/rates.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sync_locks = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rates ("
+            "tariff TEXT NOT NULL, "
+            "valid_from REAL NOT NULL, "
+            "valid_to REAL, "
+            "payment_method TEXT NOT NULL DEFAULT '', "
+            "value_exc_vat REAL, "
+            "value_inc_vat REAL NOT NULL, "
+            "PRIMARY KEY (tariff, valid_from, payment_method)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS syncs (tariff TEXT PRIMARY KEY, last_synced REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def sync_lock(self, tariff):
+        # One lock per tariff so only one Octopus client downloads a tariff's rates at a time
+        with self.lock:
+            return self.sync_locks.setdefault(tariff, threading.Lock())
+
+    def merge(self, tariff, results):
+        # Inserts new slots and overwrites existing ones, Octopus may republish a slot with a new end or price
+        rows = [
+            (
+                tariff,
+                parse_time(rate["valid_from"]),
+                None if rate["valid_to"] is None else parse_time(rate["valid_to"]),
+                rate.get("payment_method") or "",
+                rate.get("value_exc_vat"),
+                rate["value_inc_vat"],
+            )
+            for rate in results
+        ]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?)", (tariff, time.time()))
+            self.connection.commit()
+        logger.debug(msg=f"Rate store merged {len(rows)} slots for {tariff}")
+
+    def get_slots(self, tariff, since, payment_methods=None):
+        # Returns sorted (valid_from, valid_to, value_inc_vat) slots ending after since, open-ended slots end at infinity
+        query = "SELECT valid_from, valid_to, value_inc_vat, payment_method FROM rates WHERE tariff = ? AND (valid_to IS NULL OR valid_to > ?) ORDER BY valid_from"
+        with self.lock:
+            rows = self.connection.execute(query, (tariff, since)).fetchall()
+
+        slots = []
+        for valid_from, valid_to, value, payment_method in rows:
+            if payment_methods is not None and (payment_method or None) not in payment_methods:
+                continue
+            slots.append((valid_from, float("inf") if valid_to is None else valid_to, value))
+        return slots
+
+    def latest_start(self, tariff):
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(valid_from) FROM rates WHERE tariff = ?", (tariff,)).fetchone()
+        return row[0]
+
+    def coverage_end(self, tariff):
+        # The end of the last known slot, infinity if the latest rate is open-ended
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT valid_to FROM rates WHERE tariff = ? ORDER BY valid_from DESC LIMIT 1", (tariff,)
+            ).fetchone()
+        if row is None:
+            return 0
+        return float("inf") if row[0] is None else row[0]
+
+    def last_synced(self, tariff):
+        with self.lock:
+            row = self.connection.execute("SELECT last_synced FROM syncs WHERE tariff = ?", (tariff,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def prune(self, before):
+        # Removes slots that ended before the given time
+        with self.lock:
+            deleted = self.connection.execute("DELETE FROM rates WHERE valid_to IS NOT NULL AND valid_to < ?", (before,)).rowcount
+            self.connection.commit()
+        if deleted:
+            logger.debug(msg=f"Rate store pruned {deleted} old slots")
@@ -0,0 +1,65 @@
+import bisect
+from array import array
+from datetime import datetime
+
+
+def parse_time(value):
+    # Octopus times are UTC with a Z suffix, a missing end means the rate is open-ended
+    if value is None:
+        return float("inf")
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def format_time(epoch):
+    # Local time in the same layout Octopus uses so callers can keep slicing [11:16]
+    if epoch == float("inf"):
+        return "9999-12-31T23:59:59"
+    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class RateTimeline:
+    # Rates parsed once into sorted epoch-second arrays for bisect lookups
+    def __init__(self, results, payment_methods=None):
+        rates = []
+        for rate in results:
+            if payment_methods is not None and rate.get("payment_method") not in payment_methods:
+                continue
+            rates.append((parse_time(rate["valid_from"]), parse_time(rate["valid_to"]), rate["value_inc_vat"]))
+        self.set_slots(slots=sorted(rates))
+
+    @classmethod
+    def from_slots(cls, slots):
+        # Builds a timeline from already parsed, sorted (valid_from, valid_to, price) slots
+        timeline = cls(results=[])
+        timeline.set_slots(slots=slots)
+        return timeline
+
+    def set_slots(self, slots):
+        self.starts = array("d", [slot[0] for slot in slots])
+        self.ends = array("d", [slot[1] for slot in slots])
+        self.values = array("d", [slot[2] for slot in slots])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def index_at(self, epoch):
+        index = bisect.bisect_right(self.starts, epoch) - 1
+        if index >= 0 and epoch < self.ends[index]:
+            return index
+        return None
+
+    def price_at(self, epoch):
+        # Returns (price, valid_from, valid_to) for the slot covering the time or None
+        index = self.index_at(epoch=epoch)
+        if index is None:
+            return None
+        return self.values[index], self.starts[index], self.ends[index]
+
+    def slots_between(self, start, end):
+        # Returns every (price, valid_from, valid_to) slot overlapping start <= t < end
+        first = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        last = bisect.bisect_left(self.starts, end)
+        return [(self.values[i], self.starts[i], self.ends[i]) for i in range(first, last) if self.ends[i] > start]
+
+    def last_end(self):
+        return self.ends[-1] if len(self.ends) else 0
@@ -0,0 +1,179 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("tado_optimiser")
+
+# Decisions are stored as small integers
+DECISIONS = ("off", "gas", "electric")
+
+# Values are stored as integers scaled by 100 so every column is a small fixed-width integer
+SCALE = 100
+
+
+def scale(value):
+    return None if value is None else int(round(value * SCALE))
+
+
+def unscale(value):
+    return None if value is None else value / SCALE
+
+
+class Recorder:
+    # Per-cycle history of prices, grid state and every room's temperature, target & decision
+    def __init__(self, path="/config/recorder.db", raw_days=30, hourly_days=730, cycle_minutes=5):
+        self.path = path
+        self.cycle_minutes = cycle_minutes
+        self.raw_days = raw_days
+        self.hourly_days = hourly_days
+        self.lock = threading.Lock()
+        self.room_ids = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Must be set before the tables exist so space freed by compaction can be handed back
+        self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS room_names (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);"
+            "CREATE TABLE IF NOT EXISTS cycles ("
+            "ts INTEGER PRIMARY KEY, electric_price INTEGER, gas_price INTEGER, grid_power INTEGER, "
+            "using_grid INTEGER, outside INTEGER) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS rooms ("
+            "room INTEGER NOT NULL, ts INTEGER NOT NULL, temperature INTEGER, target INTEGER, "
+            "decision INTEGER, heating INTEGER, PRIMARY KEY (room, ts)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS cycles_hourly ("
+            "ts INTEGER PRIMARY KEY, electric_price INTEGER, gas_price INTEGER, grid_power INTEGER, "
+            "using_grid INTEGER, outside INTEGER, samples INTEGER) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS rooms_hourly ("
+            "room INTEGER NOT NULL, ts INTEGER NOT NULL, temperature INTEGER, temperature_min INTEGER, "
+            "temperature_max INTEGER, target INTEGER, gas INTEGER, electric INTEGER, heating INTEGER, "
+            "samples INTEGER, PRIMARY KEY (room, ts)) WITHOUT ROWID;"
+        )
+        self.connection.commit()
+        for room_id, name in self.connection.execute("SELECT id, name FROM room_names"):
+            self.room_ids[name] = room_id
+
+    def get_room_id(self, name):
+        if name not in self.room_ids:
+            cursor = self.connection.execute("INSERT INTO room_names (name) VALUES (?)", (name,))
+            self.room_ids[name] = cursor.lastrowid
+        return self.room_ids[name]
+
+    def record_cycle(self, electric_price, gas_price, grid_power, using_grid, outside, rooms, timestamp=None):
+        # Writes one cycle row and one row per room in a single transaction
+        # rooms is a list of (name, temperature, target, decision, heating level)
+        timestamp = int(timestamp or time.time())
+        started = time.perf_counter()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cycles VALUES (?, ?, ?, ?, ?, ?)",
+                (timestamp, scale(electric_price), scale(gas_price), scale(grid_power), scale(1.0 if using_grid else 0.0), scale(outside)),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (self.get_room_id(name=name), timestamp, scale(temperature), scale(target), DECISIONS.index(decision) if decision in DECISIONS else None, scale(heating))
+                    for name, temperature, target, decision, heating in rooms
+                ],
+            )
+            self.connection.commit()
+        logger.debug(msg=f"Recorded cycle: {len(rooms)} rooms in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    def get_room_history(self, name, start, end):
+        # Returns [(ts, temperature, target, decision, heating)] with full resolution where it is still kept and hourly averages before that
+        room_id = self.room_ids.get(name)
+        if room_id is None:
+            return []
+        with self.lock:
+            hourly = self.connection.execute(
+                "SELECT ts, temperature, target, NULL, heating FROM rooms_hourly WHERE room = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (room_id, start, end),
+            ).fetchall()
+            raw = self.connection.execute(
+                "SELECT ts, temperature, target, decision, heating FROM rooms WHERE room = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (room_id, start, end),
+            ).fetchall()
+        return [
+            (ts, unscale(temperature), unscale(target), None if decision is None else DECISIONS[decision], unscale(heating))
+            for ts, temperature, target, decision, heating in hourly + raw
+        ]
+
+    def get_cycle_history(self, start, end):
+        # Returns [(ts, electric_price, gas_price, grid_power, share of time using grid, outside)], hourly averages before the raw retention
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT ts, electric_price, gas_price, grid_power, using_grid, outside FROM cycles_hourly WHERE ts >= ? AND ts < ? "
+                "UNION ALL "
+                "SELECT ts, electric_price, gas_price, grid_power, using_grid, outside FROM cycles WHERE ts >= ? AND ts < ? ORDER BY ts",
+                (start, end, start, end),
+            ).fetchall()
+        return [
+            (ts, unscale(electric_price), unscale(gas_price), unscale(grid_power), unscale(using_grid), unscale(outside))
+            for ts, electric_price, gas_price, grid_power, using_grid, outside in rows
+        ]
+
+    def get_room_summary(self, name, start, end):
+        # Average / min / max temperature and hours heated on gas & electricity over the range, combining both resolutions
+        room_id = self.room_ids.get(name)
+        if room_id is None:
+            return None
+        with self.lock:
+            hourly = self.connection.execute(
+                "SELECT SUM(temperature * samples), MIN(temperature_min), MAX(temperature_max), SUM(samples), SUM(gas), SUM(electric) "
+                "FROM rooms_hourly WHERE room = ? AND ts >= ? AND ts < ?",
+                (room_id, start, end),
+            ).fetchone()
+            raw = self.connection.execute(
+                "SELECT SUM(temperature), MIN(temperature), MAX(temperature), COUNT(*), "
+                "SUM(decision = 1), SUM(decision = 2) "
+                "FROM rooms WHERE room = ? AND ts >= ? AND ts < ?",
+                (room_id, start, end),
+            ).fetchone()
+
+        samples = (hourly[3] or 0) + raw[3]
+        if not samples:
+            return None
+        total = (hourly[0] or 0) + (raw[0] or 0)
+        minimums = [value for value in (hourly[1], raw[1]) if value is not None]
+        maximums = [value for value in (hourly[2], raw[2]) if value is not None]
+
+        # Each sample stands for one cycle
+        cycle_hours = self.cycle_minutes / 60
+        return {
+            "average_temperature": round(unscale(total / samples), 2),
+            "min_temperature": unscale(min(minimums)),
+            "max_temperature": unscale(max(maximums)),
+            "gas_hours": round(((hourly[4] or 0) + (raw[4] or 0)) * cycle_hours, 2),
+            "electric_hours": round(((hourly[5] or 0) + (raw[5] or 0)) * cycle_hours, 2),
+            "samples": samples,
+        }
+
+    def compact(self):
+        # Rolls raw rows older than the raw retention into hourly rows, then drops hourly rows past their retention
+        raw_cutoff = int(time.time() - self.raw_days * 24 * 3600)
+        raw_cutoff -= raw_cutoff % 3600
+        hourly_cutoff = int(time.time() - self.hourly_days * 24 * 3600)
+        started = time.perf_counter()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cycles_hourly "
+                "SELECT ts - ts % 3600, CAST(AVG(electric_price) AS INTEGER), CAST(AVG(gas_price) AS INTEGER), "
+                "CAST(AVG(grid_power) AS INTEGER), CAST(AVG(using_grid) AS INTEGER), CAST(AVG(outside) AS INTEGER), COUNT(*) "
+                "FROM cycles WHERE ts < ? GROUP BY ts - ts % 3600",
+                (raw_cutoff,),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO rooms_hourly "
+                "SELECT room, ts - ts % 3600, CAST(AVG(temperature) AS INTEGER), MIN(temperature), MAX(temperature), "
+                "CAST(AVG(target) AS INTEGER), SUM(decision = 1), SUM(decision = 2), CAST(AVG(heating) AS INTEGER), COUNT(*) "
+                "FROM rooms WHERE ts < ? GROUP BY room, ts - ts % 3600",
+                (raw_cutoff,),
+            )
+            rolled = self.connection.execute("DELETE FROM rooms WHERE ts < ?", (raw_cutoff,)).rowcount
+            self.connection.execute("DELETE FROM cycles WHERE ts < ?", (raw_cutoff,))
+            expired = self.connection.execute("DELETE FROM rooms_hourly WHERE ts < ?", (hourly_cutoff,)).rowcount
+            self.connection.execute("DELETE FROM cycles_hourly WHERE ts < ?", (hourly_cutoff,))
+            self.connection.commit()
+            self.connection.executescript("PRAGMA incremental_vacuum;")
+        logger.info(msg=f"Recorder compacted: {rolled} room rows rolled up to hourly, {expired} hourly rows expired in {(time.perf_counter() - started) * 1000:.0f} ms")
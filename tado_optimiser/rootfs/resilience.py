@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger("tado_optimiser")
+
+# How old each data source may get before the cycle warns it is running on stale data, in seconds
+STALENESS_BUDGETS = {
+    "weather": 3600 * 3,
+    "account": 3600 * 24 * 7,
+    "agile": 3600 * 24,
+    "gas": 3600 * 24 * 7,
+}
+
+# One breaker per upstream endpoint & one call budget per quota file, shared across the process
+breakers = {}
+breakers_lock = threading.Lock()
+budgets = {}
+
+
+class CircuitBreaker:
+    # Stops calling a failing upstream and retries it after an exponentially growing delay
+    def __init__(self, name, failure_threshold=2, base_delay=60, max_delay=3600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = "closed"
+        self.failures = 0
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        # True if a call may be made now, an open breaker lets one trial call through once its delay has passed
+        # Concurrent callers are turned away while the trial is out, another is let through if it never reports back
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if time.time() >= self.retry_at:
+                self.state = "half_open"
+                self.retry_at = time.time() + self.base_delay
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logger.info(msg=f"{self.name} recovered, circuit closed")
+            self.state = "closed"
+            self.failures = 0
+            self.retry_at = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                delay = min(self.base_delay * 2 ** max(self.failures - self.failure_threshold, 0), self.max_delay)
+                self.state = "open"
+                self.retry_at = time.time() + delay
+                logger.warning(msg=f"{self.name} failing ({self.failures} in a row), circuit open. Next attempt at {datetime.fromtimestamp(self.retry_at).strftime('%H:%M:%S')}")
+
+    def describe(self):
+        if self.state == "open":
+            return f"Open until {datetime.fromtimestamp(self.retry_at).strftime('%H:%M:%S')}"
+        return self.state.replace("_", " ").capitalize()
+
+
+def get_breaker(name, **kwargs):
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name=name, **kwargs)
+        return breakers[name]
+
+
+class CallBudget:
+    # Daily quota of a metered API, counted per UTC day like the provider does & saved so restarts don't reset it
+    def __init__(self, path, daily_limit=1000):
+        self.path = path
+        self.daily_limit = daily_limit
+        self.lock = threading.Lock()
+        self.day, self.calls = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+            return saved["day"], saved["calls"]
+        except FileNotFoundError:
+            return get_utc_day(), 0
+        except (OSError, ValueError, KeyError) as error:
+            logger.error(msg=f"Call budget {self.path} unreadable, starting from zero: {error}")
+            return get_utc_day(), 0
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump({"day": self.day, "calls": self.calls}, f)
+            os.replace(temp_path, self.path)
+        except OSError as error:
+            logger.error(msg=f"Error saving call budget {self.path}: {error}")
+
+    def roll_over(self):
+        # Called with the lock held
+        today = get_utc_day()
+        if self.day != today:
+            self.day = today
+            self.calls = 0
+
+    def get_remaining(self):
+        with self.lock:
+            self.roll_over()
+            return max(self.daily_limit - self.calls, 0)
+
+    def spend(self):
+        # Counts a call about to be made, False if it would go over the quota
+        with self.lock:
+            self.roll_over()
+            if self.calls >= self.daily_limit:
+                return False
+            self.calls += 1
+            self.save()
+            return True
+
+    def get_min_interval(self):
+        # Seconds between calls that spreads the remaining quota over the rest of the UTC day
+        now = datetime.now(timezone.utc)
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (midnight - now).total_seconds() / max(self.get_remaining(), 1)
+
+
+def get_utc_day():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def get_call_budget(path, daily_limit=1000):
+    with breakers_lock:
+        if path not in budgets:
+            budgets[path] = CallBudget(path=path, daily_limit=daily_limit)
+        return budgets[path]
+
+
+def age_seconds(last_updated):
+    # Age of a "%Y-%m-%d %H:%M:%S" timestamp or epoch seconds, None if never updated
+    if not last_updated:
+        return None
+    if isinstance(last_updated, str):
+        last_updated = datetime.strptime(last_updated, "%Y-%m-%d %H:%M:%S").timestamp()
+    return max(time.time() - last_updated, 0)
+
+
+def check_staleness(ages):
+    # Logs every source older than its budget and returns their names
+    stale = []
+    for source, age in ages.items():
+        budget = STALENESS_BUDGETS.get(source)
+        if age is None or (budget is not None and age > budget):
+            stale.append(source)
+            age_text = "never updated" if age is None else f"{age / 60:.0f} minutes old"
+            logger.warning(msg=f"Running on stale {source} data: {age_text}")
+    return stale
@@ -0,0 +1,96 @@
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+logger = logging.getLogger("tado_optimiser")
+
+MODES = ("off", "gas", "electric")
+
+# How far below target an idle room may drift before heating restarts, the share electricity must beat gas by to
+# switch over (and lose by to switch back), and the minimum minutes a room stays heating or off
+ControlLimits = namedtuple("ControlLimits", ["temperature_deadband", "price_hysteresis", "min_on_minutes", "min_off_minutes"])
+DEFAULT_LIMITS = ControlLimits(temperature_deadband=0.1, price_hysteresis=0.05, min_on_minutes=15, min_off_minutes=0)
+
+
+class RoomControl:
+    # One room's heating mode, when it entered it & how often it has switched or been held
+    def __init__(self, limits, mode="off", since=0.0, switches=0, switches_today=0, held=0, day=""):
+        self.limits = limits
+        self.mode = mode if mode in MODES else "off"
+        self.since = since
+        self.switches = switches
+        self.switches_today = switches_today
+        self.held = held
+        self.day = day
+        self.changed = False
+
+    def get_minimum(self):
+        return self.limits.min_off_minutes if self.mode == "off" else self.limits.min_on_minutes
+
+    def get_minutes_held(self, moment):
+        return (moment.timestamp() - self.since) / 60
+
+    def choose(self, mode, moment, modes=MODES):
+        # The mode to use this cycle, the current one until it has been held for its minimum time
+        # A mode the room can no longer use, e.g. electric after its override was removed, isn't held
+        if mode == self.mode or self.mode not in modes:
+            return mode
+        minimum = self.get_minimum()
+        minutes_held = self.get_minutes_held(moment=moment)
+        if minutes_held < minimum:
+            logger.info(msg=f"Staying {self.mode.upper()} for another {minimum - minutes_held:.0f} minutes rather than switching to {mode.upper()}")
+            self.held += 1
+            self.changed = True
+            return self.mode
+        return mode
+
+    def record(self, mode, moment):
+        # Counts a switch when the mode actually used changes, the daily count resets at midnight
+        day = moment.strftime("%Y-%m-%d")
+        if day != self.day:
+            self.day = day
+            self.switches_today = 0
+            self.changed = True
+        if mode == self.mode:
+            return False
+        self.mode = mode
+        self.since = moment.timestamp()
+        self.switches += 1
+        self.switches_today += 1
+        self.changed = True
+        return True
+
+    def to_dict(self):
+        return {"mode": self.mode, "since": self.since, "switches": self.switches, "switches_today": self.switches_today, "held": self.held, "day": self.day}
+
+
+class RoomControls:
+    # Every room's control state, persisted in the snapshot store so a restart doesn't reset dwell times or counts
+    def __init__(self, snapshot_store, limits=DEFAULT_LIMITS):
+        self.snapshot_store = snapshot_store
+        self.limits = limits
+        self.controls = {}
+        self.lock = threading.Lock()
+
+        data, last_updated = snapshot_store.load(name="room_control")
+        for name, control in (data or {}).items():
+            self.controls[name] = RoomControl(limits=limits, **control)
+        if self.controls:
+            logger.info(msg=f"Room control state loaded for {len(self.controls)} rooms, last updated: {last_updated}")
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.controls:
+                self.controls[name] = RoomControl(limits=self.limits)
+            return self.controls[name]
+
+    def save(self):
+        # Only written when a room switched or was held this cycle
+        with self.lock:
+            if not any(control.changed for control in self.controls.values()):
+                return
+            data = {name: control.to_dict() for name, control in self.controls.items()}
+            for control in self.controls.values():
+                control.changed = False
+        self.snapshot_store.save(name="room_control", data=data, last_updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
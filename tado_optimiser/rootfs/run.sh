@@ -1,4 +1,4 @@
 echo "Running Tado Optimiser"
 echo "Your API key is: $SUPERVISOR_TOKEN"
 
-python3 /main.py "$SUPERVISOR_TOKEN"
\ No newline at end of file
+exec python3 /main.py "$SUPERVISOR_TOKEN"
\ No newline at end of file
@@ -0,0 +1,128 @@
+import logging
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+
+import tracing
+
+logger = logging.getLogger("tado_optimiser")
+
+# What to do when a cycle is still running at its next deadline
+#   skip      drop the missed cycles and wait for the next slot
+#   coalesce  run one cycle straight away for all the missed ones, then carry on from the original slots
+#   immediate run the next cycle straight away and move the slots to start from it
+OVERRUN_POLICIES = ("skip", "coalesce", "immediate")
+
+
+class DailyJob:
+    def __init__(self, at, function, kwargs):
+        self.hour, self.minute = (int(part) for part in at.split(":"))
+        self.function = function
+        self.kwargs = kwargs
+        self.next_run = self.get_next_run()
+
+    def get_next_run(self):
+        # Wall-clock time of the next occurrence, worked out from the date so it follows clock changes
+        now = datetime.now()
+        run_at = now.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+        return run_at.timestamp()
+
+
+class CycleScheduler:
+    # Runs the cycle every interval on slots aligned to the clock, sleeping on the monotonic clock until each one is due
+    def __init__(self, interval_minutes=5, overrun_policy="skip"):
+        if overrun_policy not in OVERRUN_POLICIES:
+            logger.error(msg=f"Unknown overrun policy '{overrun_policy}', using skip")
+            overrun_policy = "skip"
+        self.interval = interval_minutes * 60
+        self.overrun_policy = overrun_policy
+        self.daily_jobs = []
+        self.stop_event = threading.Event()
+        self.overruns = 0
+        self.skipped = 0
+
+    def add_daily(self, at, function, **kwargs):
+        self.daily_jobs.append(DailyJob(at=at, function=function, kwargs=kwargs))
+
+    def install_signal_handlers(self):
+        # s6 sends SIGTERM on stop, the cycle in progress finishes before the loop exits
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, self.handle_signal)
+
+    def handle_signal(self, signal_number, frame):
+        logger.info(msg=f"Received {signal.Signals(signal_number).name}, stopping after the current cycle")
+        self.stop_event.set()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_first_slot(self):
+        # Monotonic time of the next slot on the wall clock, e.g. :00, :05, :10 for a 5 minute interval
+        now = time.time()
+        return time.monotonic() + self.interval - now % self.interval
+
+    def run_safely(self, name, function, **kwargs):
+        # A failing cycle or job is logged and the schedule carries on
+        try:
+            function(**kwargs)
+        except Exception as error:
+            logger.exception(msg=f"{name} failed: {error}")
+
+    def run(self, cycle):
+        # slot is the clock-aligned slot the next cycle stands for, run_at when it actually runs
+        slot = self.get_first_slot()
+        run_at = slot
+        logger.info(msg=f"Scheduler started. Interval: {self.interval // 60} minutes | Overrun policy: {self.overrun_policy} | Next cycle in {run_at - time.monotonic():.0f}s")
+
+        while not self.stop_event.is_set():
+            # Sleeps until the next cycle or daily job, whichever is first, waking early on stop
+            wait = run_at - time.monotonic()
+            for job in self.daily_jobs:
+                wait = min(wait, job.next_run - time.time())
+            if wait > 0 and self.stop_event.wait(timeout=wait):
+                break
+
+            for job in self.daily_jobs:
+                if time.time() >= job.next_run:
+                    self.run_safely(name=job.function.__name__, function=job.function, **job.kwargs)
+                    job.next_run = job.get_next_run()
+
+            if time.monotonic() < run_at:
+                continue
+
+            started = time.monotonic()
+            if started - run_at > 1:
+                logger.debug(msg=f"Cycle started {started - run_at:.1f}s late")
+            self.run_safely(name="Update cycle", function=cycle)
+            slot, run_at = self.get_next_slot(slot=slot, started=started)
+
+        logger.info(msg="Scheduler stopped")
+
+    def get_next_slot(self, slot, started):
+        # Returns (slot, run_at) for the next cycle, applying the overrun policy if the cycle ran past one or more slots
+        now = time.monotonic()
+        next_slot = slot + self.interval
+        if now < next_slot:
+            return next_slot, next_slot
+
+        missed = int((now - next_slot) // self.interval) + 1
+        self.overruns += 1
+        tracing.count(name="cycle_overruns")
+        logger.warning(msg=f"Cycle took {now - started:.0f}s, overrunning {missed} slot(s) of {self.interval}s. Policy: {self.overrun_policy}")
+
+        if self.overrun_policy == "immediate":
+            # The slots restart from now
+            return now, now
+        if self.overrun_policy == "coalesce":
+            # One run now stands in for every missed slot, the one after is back on the original slots
+            self.skipped += missed - 1
+            tracing.count(name="cycles_skipped", amount=missed - 1)
+            return next_slot + (missed - 1) * self.interval, now
+
+        self.skipped += missed
+        tracing.count(name="cycles_skipped", amount=missed)
+        next_slot += missed * self.interval
+        return next_slot, next_slot
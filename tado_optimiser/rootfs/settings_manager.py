@@ -0,0 +1,142 @@
+import logging
+import os
+from collections import namedtuple
+
+import yaml
+
+logger = logging.getLogger("tado_optimiser")
+
+# Immutable room settings with the Home Assistant entity ids worked out once per load
+RoomSpec = namedtuple("RoomSpec", [
+    "name",
+    "display_name",
+    "is_tado",
+    "gas_climate_entity",
+    "day",
+    "evening",
+    "night",
+    "electric_override",
+    "gas_radiator_power",
+    "electric_radiator_power",
+    "electric_climate_entity",
+    "tado_entities",
+    "target_sensor",
+])
+
+# Tado attribute name & entity id pattern read for every Tado room
+TADO_ENTITIES = (
+    ("connectivity", "binary_sensor.{name}_connectivity"),
+    ("early_start", "binary_sensor.{name}_early_start"),
+    ("heating", "sensor.{name}_heating"),
+    ("humidity", "sensor.{name}_humidity"),
+    ("overlay", "binary_sensor.{name}_overlay"),
+    ("power", "binary_sensor.{name}_power"),
+    ("tado_mode", "sensor.{name}_tado_mode"),
+    ("window", "binary_sensor.{name}_window"),
+)
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def get_number(name, room, key):
+    value = room.get(key)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise SettingsError(f"Room '{name}': '{key}' must be a number, got {value!r}")
+    return value
+
+
+def build_room_spec(name, room):
+    # Validates one room from settings.yaml and returns its RoomSpec
+    if not isinstance(room, dict):
+        raise SettingsError(f"Room '{name}' must be a mapping of settings")
+
+    gas_climate_entity = room.get("gas_climate_entity")
+    if not isinstance(gas_climate_entity, str) or not gas_climate_entity.startswith("climate."):
+        raise SettingsError(f"Room '{name}': 'gas_climate_entity' must be a climate entity, got {gas_climate_entity!r}")
+
+    electric_override = bool(room.get("electric_override"))
+    gas_radiator_power = room.get("gas_radiator_power")
+    electric_radiator_power = room.get("electric_radiator_power")
+    electric_climate_entity = room.get("electric_climate_entity")
+
+    if electric_override:
+        gas_radiator_power = get_number(name=name, room=room, key="gas_radiator_power")
+        electric_radiator_power = get_number(name=name, room=room, key="electric_radiator_power")
+        if gas_radiator_power <= 0 or electric_radiator_power <= 0:
+            raise SettingsError(f"Room '{name}': radiator powers must be above 0 when electric_override is set")
+        if not isinstance(electric_climate_entity, str) or not electric_climate_entity.startswith("climate."):
+            raise SettingsError(f"Room '{name}': 'electric_climate_entity' must be a climate entity when electric_override is set")
+
+    is_tado = bool(room.get("is_tado"))
+    tado_entities = tuple((attribute, pattern.format(name=name)) for attribute, pattern in TADO_ENTITIES) if is_tado else ()
+
+    return RoomSpec(
+        name=name,
+        display_name=name.upper().replace("_", " "),
+        is_tado=is_tado,
+        gas_climate_entity=gas_climate_entity,
+        day=get_number(name=name, room=room, key="day"),
+        evening=get_number(name=name, room=room, key="evening"),
+        night=get_number(name=name, room=room, key="night"),
+        electric_override=electric_override,
+        gas_radiator_power=gas_radiator_power,
+        electric_radiator_power=electric_radiator_power,
+        electric_climate_entity=electric_climate_entity,
+        tado_entities=tado_entities,
+        target_sensor=f"sensor.{name}_target_temperature",
+    )
+
+
+def parse_settings(text):
+    # Parses & validates the whole settings file, returns the room specs in file order
+    settings = yaml.safe_load(text)
+    if not isinstance(settings, dict) or not isinstance(settings.get("rooms"), dict) or not settings["rooms"]:
+        raise SettingsError("Settings file must contain a 'rooms' mapping with at least one room")
+
+    return {str(name): build_room_spec(name=str(name), room=room) for name, room in settings["rooms"].items()}
+
+
+class SettingsManager:
+    # Reloads settings.yaml only when the file changes, keeping the last good settings if a new file is invalid
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.rooms = {}
+
+    def get_rooms(self):
+        self.reload_if_changed()
+        return self.rooms
+
+    def reload_if_changed(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as error:
+            if not self.rooms:
+                raise
+            logger.error(msg=f"Settings file not readable, using last good settings: {error}")
+            return False
+
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return False
+        self.signature = signature
+
+        try:
+            with open(self.path, "r") as file:
+                rooms = parse_settings(text=file.read())
+        except (yaml.YAMLError, SettingsError) as error:
+            if not self.rooms:
+                raise
+            logger.error(msg=f"Settings file invalid, using last good settings: {error}")
+            return False
+
+        if self.rooms:
+            added = [name for name in rooms if name not in self.rooms]
+            removed = [name for name in self.rooms if name not in rooms]
+            logger.info(msg=f"Settings reloaded: {len(rooms)} rooms | Added: {added or 'None'} | Removed: {removed or 'None'}")
+        else:
+            logger.info(msg=f"Settings loaded: {len(rooms)} rooms")
+        self.rooms = rooms
+        return True
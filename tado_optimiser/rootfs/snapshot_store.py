@@ -0,0 +1,126 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("tado_optimiser")
+
+# Paired backup files written by earlier versions, migrated on first load then removed
+LEGACY_FILES = {
+    "weather": ("weather_data.json", "weather_data_last_updated.txt"),
+    "account": ("account_data.json", "account_data_last_updated.txt"),
+    "agile": ("agile_rates.json", "agile_rates_last_updated.txt"),
+    "gas": ("gas_rates.json", "gas_rates_last_updated.txt"),
+}
+
+
+class SnapshotStore:
+    # Keeps each data set and its timestamp together in one gzipped compact JSON file, written atomically
+    def __init__(self, directory="/config/snapshots", legacy_directory="/config", retention_days=30):
+        self.directory = directory
+        self.legacy_directory = legacy_directory
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, name):
+        return os.path.join(self.directory, f"{name}.json.gz")
+
+    def load(self, name):
+        # Returns (data, last_updated) for a data set, or (None, "") if nothing has been saved yet
+        path = self.get_path(name=name)
+        if not os.path.exists(path):
+            return self.migrate_legacy(name=name)
+
+        try:
+            with gzip.open(path, "rt") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as error:
+            logger.error(msg=f"Snapshot {name} unreadable, ignoring it: {error}")
+            return None, ""
+
+        logger.debug(msg=f"Snapshot {name} loaded, last updated: {snapshot['last_updated']}")
+        return snapshot["data"], snapshot["last_updated"]
+
+    def save(self, name, data, last_updated):
+        # Writes to a temporary file, flushes it to disk and renames it over the old snapshot so a crash leaves one or the other
+        path = self.get_path(name=name)
+        temp_path = f"{path}.tmp"
+        encoded = json.dumps({"last_updated": last_updated, "data": data}, separators=(",", ":"))
+
+        with self.lock:
+            with open(temp_path, "wb") as f:
+                with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6, mtime=0) as gz:
+                    gz.write(encoded.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            self.sync_directory()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg=f"Snapshot {name} saved: {os.path.getsize(path)} bytes")
+
+    def sync_directory(self):
+        # Makes the rename itself durable
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def migrate_legacy(self, name):
+        # Moves an old .json / _last_updated.txt pair into a snapshot
+        if name not in LEGACY_FILES:
+            return None, ""
+        data_file, timestamp_file = (os.path.join(self.legacy_directory, file) for file in LEGACY_FILES[name])
+        if not os.path.exists(data_file) or not os.path.exists(timestamp_file):
+            return None, ""
+
+        try:
+            with open(data_file, "r") as f:
+                data = json.load(f)
+            with open(timestamp_file, "r") as f:
+                last_updated = f.read().strip()
+        except (OSError, ValueError) as error:
+            logger.error(msg=f"Legacy {name} backup files unreadable, ignoring them: {error}")
+            return None, ""
+
+        self.save(name=name, data=data, last_updated=last_updated)
+        self.remove_legacy(name=name)
+        logger.info(msg=f"Legacy {name} backup files migrated to snapshot")
+        return data, last_updated
+
+    def remove_legacy(self, name):
+        for file in LEGACY_FILES[name]:
+            try:
+                os.remove(os.path.join(self.legacy_directory, file))
+            except FileNotFoundError:
+                pass
+
+    def compact(self, keep=()):
+        # Removes interrupted writes, snapshots not written within the retention period and legacy files of data sets stored elsewhere
+        cutoff = time.time() - self.retention_days * 24 * 3600
+        removed = []
+        with self.lock:
+            for file in os.listdir(self.directory):
+                path = os.path.join(self.directory, file)
+                name = file.split(".")[0]
+                if file.endswith(".tmp") or (name not in keep and os.path.getmtime(path) < cutoff):
+                    os.remove(path)
+                    removed.append(file)
+
+        for name in LEGACY_FILES:
+            if name not in keep and any(os.path.exists(os.path.join(self.legacy_directory, file)) for file in LEGACY_FILES[name]):
+                self.remove_legacy(name=name)
+                removed.append(f"legacy {name}")
+
+        if removed:
+            logger.info(msg=f"Snapshot store compacted, removed: {', '.join(removed)}")
+        return removed
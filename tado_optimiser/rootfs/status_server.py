@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("tado_optimiser")
+
+# The supervisor's ingress proxy, matching ingress.conf, plus local requests from inside the container
+INGRESS_CLIENTS = ("172.30.32.2", "127.0.0.1")
+
+# Bodies under this size are sent uncompressed
+GZIP_MIN_SIZE = 512
+
+# A response encoded once when published: plain & gzipped body, ETag & content type
+Document = namedtuple("Document", ["body", "gzipped", "etag", "content_type"])
+
+
+def make_document(body, content_type):
+    gzipped = gzip.compress(body, compresslevel=6, mtime=0) if len(body) >= GZIP_MIN_SIZE else None
+    etag = f"\"{hashlib.sha1(body).hexdigest()[:20]}\""
+    return Document(body, gzipped, etag, content_type)
+
+
+class StatusServer:
+    # Read-only status API on the ingress port, every response is precomputed by the cycle so requests never do any work
+    def __init__(self, port=5052, host="0.0.0.0", allowed_clients=INGRESS_CLIENTS):
+        self.port = port
+        self.host = host
+        self.allowed_clients = set(allowed_clients)
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), self.make_handler())
+        except OSError as error:
+            logger.error(msg=f"Status server could not listen on port {self.port}: {error}")
+            return False
+
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="status_server", daemon=True)
+        self.thread.start()
+        logger.info(msg=f"Status server listening on port {self.port}")
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def publish(self, path, body, content_type):
+        # Replaces the document served at path, readers see either the old or the new one
+        document = make_document(body=body if isinstance(body, bytes) else body.encode("utf-8"), content_type=content_type)
+        with self.lock:
+            added = path not in self.documents
+            self.documents[path] = document
+        if added:
+            self.publish_index()
+
+    def publish_json(self, path, data):
+        self.publish(path=path, body=json.dumps(data, separators=(",", ":"), default=str), content_type="application/json")
+
+    def publish_index(self):
+        with self.lock:
+            paths = sorted(path for path in self.documents if path != "/")
+            self.documents["/"] = make_document(body=json.dumps({"endpoints": paths}).encode("utf-8"), content_type="application/json")
+
+    def get_document(self, path):
+        with self.lock:
+            return self.documents.get(path)
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            server_version = "TadoOptimiser"
+
+            def log_message(self, format, *args):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(msg=f"Status server: {self.address_string()} {format % args}")
+
+            def send_empty(self, status, headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def not_modified(self, document):
+                tags = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+                return "*" in tags or document.etag in tags or f"W/{document.etag}" in tags
+
+            def respond(self, send_body):
+                if self.client_address[0] not in server.allowed_clients:
+                    return self.send_empty(status=403)
+
+                document = server.get_document(path=self.path.split("?", 1)[0].rstrip("/") or "/")
+                if document is None:
+                    return self.send_empty(status=404)
+
+                headers = [("ETag", document.etag), ("Cache-Control", "no-cache"), ("Vary", "Accept-Encoding")]
+                if self.not_modified(document=document):
+                    return self.send_empty(status=304, headers=headers)
+
+                body = document.body
+                if document.gzipped is not None and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = document.gzipped
+                    headers.append(("Content-Encoding", "gzip"))
+
+                self.send_response(200)
+                self.send_header("Content-Type", document.content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(send_body=True)
+
+            def do_HEAD(self):
+                self.respond(send_body=False)
+
+        return Handler
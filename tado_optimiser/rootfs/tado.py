@@ -1,24 +1,25 @@
 import logging
-import yaml
 from datetime import datetime
-from home_assistant_api import HomeAssistantAPI
-
-def load_config(url):
-    system_file = url
-    with open(system_file, "r") as file:
-        return yaml.safe_load(file)
 
 logger = logging.getLogger("tado_optimiser")
 
-home_assistant = HomeAssistantAPI()
+# Share of the target taken off in Away mode: (hours away up to, share), after the last step the long reduction applies
+AWAY_REDUCTIONS = ((12, 0.1), (24, 0.2))
+AWAY_LONG_REDUCTION = 10
+
 
 # noinspection DuplicatedCode
 class Tado:
-    def __init__(self, name):
+    def __init__(self, name, reconciler, home_assistant, clock=datetime.now):
         self.name = name
+        self.reconciler = reconciler
+        self.home_assistant = home_assistant
+
+        # Wall clock by default, the backtest replays history on its own clock
+        self.clock = clock
 
         # Settings file
-        self.settings = None
+        self.spec = None
         self.is_tado = None
         self.gas_climate_entity = None
         self.day = None
@@ -48,38 +49,57 @@ class Tado:
         
         # Away data
         self.away_time = ""
+        self.away_reductions = AWAY_REDUCTIONS
+        self.away_long_reduction = AWAY_LONG_REDUCTION
+
+        # Mode, dwell time & switch counts kept across cycles, None decides afresh every cycle
+        self.control = None
+
+        # Last decision & heating plan, kept for the recorder & status API
+        self.decision = None
+        self.target_temperature = None
+        self.plan = None
         
-    def update_tado_data(self):
-        # Reloads the settings file then refreshes data
-        self.settings = load_config(url="/config/settings.yaml")
-        self.is_tado = self.settings["rooms"][self.name]["is_tado"]
-        self.gas_climate_entity = self.settings["rooms"][self.name]["gas_climate_entity"]
-        self.day = self.settings["rooms"][self.name]["day"]
-        self.evening = self.settings["rooms"][self.name]["evening"]
-        self.night = self.settings["rooms"][self.name]["night"]   
-        self.electric_override = self.settings["rooms"][self.name]["electric_override"]
-        self.gas_radiator_power = self.settings["rooms"][self.name]["gas_radiator_power"]
-        self.electric_radiator_power = self.settings["rooms"][self.name]["electric_radiator_power"]
-        self.electric_climate_entity = self.settings["rooms"][self.name]["electric_climate_entity"]
+    def apply_settings(self, spec):
+        # Takes the room's validated settings, called whenever the settings file is (re)loaded
+        self.spec = spec
+        self.is_tado = spec.is_tado
+        self.gas_climate_entity = spec.gas_climate_entity
+        self.day = spec.day
+        self.evening = spec.evening
+        self.night = spec.night
+        self.electric_override = spec.electric_override
+        self.gas_radiator_power = spec.gas_radiator_power
+        self.electric_radiator_power = spec.electric_radiator_power
+        self.electric_climate_entity = spec.electric_climate_entity
 
+    def update_tado_data(self):
         # Gets generic data
-        self.climate_gas = home_assistant.get_entity_state(sensor=self.gas_climate_entity)
-        self.current_temperature = float(home_assistant.get_climate_current_temperature(sensor=self.gas_climate_entity))
+        self.climate_gas = self.home_assistant.get_entity_state(sensor=self.gas_climate_entity)
+        self.current_temperature = float(self.home_assistant.get_climate_current_temperature(sensor=self.gas_climate_entity))
 
         # Gets these values from Tado direct
-        if self.is_tado:
-            self.connectivity = home_assistant.get_entity_state(sensor=f"binary_sensor.{self.name}_connectivity")
-            self.early_start = home_assistant.get_entity_state(sensor=f"binary_sensor.{self.name}_early_start")
-            self.heating = home_assistant.get_entity_state(sensor=f"sensor.{self.name}_heating")
-            self.humidity = home_assistant.get_entity_state(sensor=f"sensor.{self.name}_humidity")
-            self.overlay = home_assistant.get_entity_state(sensor=f"binary_sensor.{self.name}_overlay")
-            self.power = home_assistant.get_entity_state(sensor=f"binary_sensor.{self.name}_power")
-            self.tado_mode = home_assistant.get_entity_state(sensor=f"sensor.{self.name}_tado_mode")
-            self.window = home_assistant.get_entity_state(sensor=f"binary_sensor.{self.name}_window")
+        for attribute, entity_id in self.spec.tado_entities:
+            setattr(self, attribute, self.home_assistant.get_entity_state(sensor=entity_id))
 
         # Gets these values from electric alternative
         if self.electric_override:
-            self.climate_electric = home_assistant.get_entity_state(sensor=self.electric_climate_entity)
+            self.climate_electric = self.home_assistant.get_entity_state(sensor=self.electric_climate_entity)
+
+    def get_heating_level(self):
+        # How hard the room is being heated, 0 to 1 for gas plus the electric radiator relative to the gas one
+        if self.is_tado:
+            try:
+                level = float(self.heating) / 100
+            except (TypeError, ValueError):
+                level = 0.0
+        else:
+            entity = self.home_assistant.get_entity(sensor=self.gas_climate_entity)
+            level = 1.0 if entity is not None and entity["attributes"].get("hvac_action") == "heating" else 0.0
+
+        if self.electric_override and self.climate_electric == "heat":
+            level += self.electric_radiator_power / self.gas_radiator_power
+        return level
 
     def calculate_break_even_price(self, gas_price):
         # Calculates the break-even price for electricity to be cheaper than gas
@@ -104,94 +124,138 @@ class Tado:
             electric_cost_per_hour = kwh_electric * electric_price
             logger.info(msg=f"Cost per hour: Electric: {electric_cost_per_hour:.2f} | Gas: {gas_cost_per_hour:.2f}")
             self.calculate_break_even_price(gas_price)
-            return electric_cost_per_hour < gas_cost_per_hour
 
-    def set_hvac_mode(self, target_temperature, temp_hour_0, temp_hour_1, electric_price, gas_price, using_grid):
-        # If the outside temperature in the next 2 hours will meet the target temperature turn off heating
-        if temp_hour_0 >= target_temperature or temp_hour_1 >= target_temperature:
-            logger.info(msg=f"Temp Hour 0: {temp_hour_0:.2f} or Temp Hour 1: {temp_hour_1:.2f} is the same or higher than the Target Temperature {target_temperature:.2f}")
+            # Electricity has to beat gas by the hysteresis to switch over and lose by it to switch back
+            if self.control is None:
+                return electric_cost_per_hour < gas_cost_per_hour
+            hysteresis = self.control.limits.price_hysteresis
+            if self.control.mode == "electric":
+                return electric_cost_per_hour < gas_cost_per_hour * (1 + hysteresis)
+            return electric_cost_per_hour < gas_cost_per_hour * (1 - hysteresis)
 
-            if self.climate_gas != "off":
-                home_assistant.set_hvac_mode(entity_id=self.gas_climate_entity, hvac_mode="off")
-            if self.electric_override:
-                if self.climate_electric != "off":
-                    home_assistant.set_hvac_mode(entity_id=self.electric_climate_entity, hvac_mode="off")
+    def set_hvac_mode(self, target_temperature, outside_max, electric_price, gas_price, using_grid, predicted_temperature=None):
+        self.target_temperature = target_temperature
 
-            logger.info(msg=f"{self.name.upper().replace('_', ' ')} set to OFF")
+        # A room that is off stays off until it is the deadband below target, so it doesn't restart for every 0.1 °C
+        off_temperature = target_temperature
+        if self.control is not None and self.control.mode == "off":
+            off_temperature -= self.control.limits.temperature_deadband
+
+        # If the room model predicts the target will be met without heating in the next 2 hours turn off heating
+        if predicted_temperature is not None and predicted_temperature >= off_temperature:
+            logger.info(msg=f"Predicted Temperature in 2 hours without heating: {predicted_temperature:.2f} is the same or higher than the Target Temperature {target_temperature:.2f}")
+            decision = "off"
+
+        # Without a trained model, if the outside temperature in the next 2 hours will meet the target temperature turn off heating
+        elif predicted_temperature is None and outside_max >= off_temperature:
+            logger.info(msg=f"Highest outside temperature in the next 2 hours: {outside_max:.2f} is the same or higher than the Target Temperature {target_temperature:.2f}")
+            decision = "off"
 
         # If the room temperature has met the target temperature turn off heating
-        elif self.current_temperature >= target_temperature:
+        elif self.current_temperature >= off_temperature:
             if self.current_temperature == target_temperature:
                 logger.info(msg=f"The Actual Temperature {self.current_temperature:.2f} is the same as the Target Temperature {target_temperature:.2f}")
-            else:
+            elif self.current_temperature > target_temperature:
                 logger.info(msg=f"The Actual Temperature {self.current_temperature:.2f} is higher than the Target Temperature {target_temperature:.2f}")
+            else:
+                logger.info(msg=f"The Actual Temperature {self.current_temperature:.2f} is within the deadband below the Target Temperature {target_temperature:.2f}")
+            decision = "off"
 
-            if self.climate_gas != "off":
-                home_assistant.set_hvac_mode(entity_id=self.gas_climate_entity, hvac_mode="off")
-            if self.electric_override:
-                if self.climate_electric != "off":
-                    home_assistant.set_hvac_mode(entity_id=self.electric_climate_entity, hvac_mode="off")
+        # If the above fail then it must mean heating is required, electricity if it's possible & cheaper than gas
+        else:
+            logger.info(msg=f"The Actual Temperature {self.current_temperature:.2f} is lower than the Target Temperature {target_temperature:.2f}")
+            if self.should_use_electric_override(electric_price=electric_price, gas_price=gas_price, using_grid=using_grid):
+                decision = "electric"
+            else:
+                decision = "gas"
+
+        # A room keeps its mode for a minimum time so prices or grid power hovering at a threshold don't flip it every cycle
+        if self.control is not None:
+            moment = self.clock()
+            modes = ("off", "gas", "electric") if self.electric_override else ("off", "gas")
+            decision = self.control.choose(mode=decision, moment=moment, modes=modes)
+            self.control.record(mode=decision, moment=moment)
 
+        self.apply_decision(decision=decision, target_temperature=target_temperature)
+
+    def apply_decision(self, decision, target_temperature):
+        self.decision = decision
+        if decision == "off":
+            self.reconciler.set_desired(entity_id=self.gas_climate_entity, hvac_mode="off")
+            if self.electric_override:
+                self.reconciler.set_desired(entity_id=self.electric_climate_entity, hvac_mode="off")
             logger.info(msg=f"{self.name.upper().replace('_', ' ')} set to OFF")
 
-        # If the above 2 fail then it must mean heating is required
-        else:
-            logger.info(msg=f"The Actual Temperature {self.current_temperature:.2f} is lower than the Target Temperature {target_temperature:.2f}")
+        # Turns on electricity
+        elif decision == "electric":
+            self.reconciler.set_desired(entity_id=self.gas_climate_entity, hvac_mode="off")
+            self.reconciler.set_desired(entity_id=self.electric_climate_entity, hvac_mode="heat", temperature=target_temperature)
+            logger.info(msg=f"{self.name.upper().replace('_', ' ')} using Electricity set to {target_temperature:.2f}")
 
-            # Checks if you should use electricity and then turns on electricity
-            if self.should_use_electric_override(electric_price=electric_price, gas_price=gas_price, using_grid=using_grid):
-                if self.climate_gas != "off":
-                    home_assistant.set_hvac_mode(entity_id=self.gas_climate_entity, hvac_mode="off")
+        # If electric override not possible or electricity not cheaper turn on gas
+        else:
+            if self.electric_override:
+                self.reconciler.set_desired(entity_id=self.electric_climate_entity, hvac_mode="off")
 
-                home_assistant.set_hvac_mode(entity_id=self.electric_climate_entity, hvac_mode="heat")
-                home_assistant.set_temperature(entity_id=self.electric_climate_entity, temperature=target_temperature)
-                logger.info(msg=f"{self.name.upper().replace('_', ' ')} using Electricity set to {target_temperature:.2f}")
+            # Tado switches to heat when a temperature is set so only other devices need the mode
+            hvac_mode = None if self.is_tado else "heat"
+            self.reconciler.set_desired(entity_id=self.gas_climate_entity, hvac_mode=hvac_mode, temperature=target_temperature)
+            logger.info(msg=f"{self.name.upper().replace('_', ' ')} using Gas set to {target_temperature:.2f}")
 
-            # If electric override not possible or electricity not cheaper turn on gas
-            else:
-                if self.electric_override:
-                    if self.climate_electric != "off":
-                        home_assistant.set_hvac_mode(entity_id=self.electric_climate_entity, hvac_mode="off")
+    def follow_plan(self, plan):
+        # Applies the first slot of the room's heating plan
+        slot = plan.slots[0]
+        self.decision = slot.action
+        self.target_temperature = plan.setpoint
+        if self.control is not None:
+            self.control.record(mode=slot.action, moment=self.clock())
+        if slot.action == "off":
+            self.reconciler.set_desired(entity_id=self.gas_climate_entity, hvac_mode="off")
+            if self.electric_override:
+                self.reconciler.set_desired(entity_id=self.electric_climate_entity, hvac_mode="off")
+            logger.info(msg=f"{self.spec.display_name} set to OFF by plan, predicted {slot.temperature:.2f} at {datetime.fromtimestamp(slot.end).strftime('%H:%M')}")
 
-                if not self.is_tado:
-                    home_assistant.set_hvac_mode(entity_id=self.gas_climate_entity, hvac_mode="heat")
+        elif slot.action == "electric":
+            self.reconciler.set_desired(entity_id=self.gas_climate_entity, hvac_mode="off")
+            self.reconciler.set_desired(entity_id=self.electric_climate_entity, hvac_mode="heat", temperature=plan.setpoint)
+            logger.info(msg=f"{self.spec.display_name} using Electricity set to {plan.setpoint:.2f} by plan")
 
-                home_assistant.set_temperature(entity_id=self.gas_climate_entity, temperature=target_temperature)
-                logger.info(msg=f"{self.name.upper().replace('_', ' ')} using Gas set to {target_temperature:.2f}")
+        else:
+            if self.electric_override:
+                self.reconciler.set_desired(entity_id=self.electric_climate_entity, hvac_mode="off")
+            hvac_mode = None if self.is_tado else "heat"
+            self.reconciler.set_desired(entity_id=self.gas_climate_entity, hvac_mode=hvac_mode, temperature=plan.setpoint)
+            logger.info(msg=f"{self.spec.display_name} using Gas set to {plan.setpoint:.2f} by plan")
 
     def away_adjust(self, target_temperature):
-        now = datetime.now()
+        now = self.clock()
 
         # If in HOME mode return no reduction
         if self.tado_mode != "AWAY":
             self.away_time = ""
             return 0
 
-        else:
-            # If first cycle in AWAY mode reduce by 10%
-            if self.away_time == "":
-                self.away_time = now
-                logger.info(msg="First cycle in Away mode")
-                adjusted_temperature = target_temperature * 0.1
-                logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode Temperature reduced by 10 % to {target_temperature - adjusted_temperature:.2f}")
+        # If first cycle in AWAY mode reduce by the first step
+        if self.away_time == "":
+            self.away_time = now
+            logger.info(msg="First cycle in Away mode")
+            share = self.away_reductions[0][1]
+            adjusted_temperature = target_temperature * share
+            logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode Temperature reduced by {share * 100:.0f} % to {target_temperature - adjusted_temperature:.2f}")
+            return adjusted_temperature
+
+        # Sets different reductions depending on time in AWAY mode
+        time_difference = (now - self.away_time).total_seconds() / 3600
+        logger.info(msg=f"Time Now: {now.strftime('%Y-%m-%d %H:%M')} Away Time: {self.away_time.strftime('%Y-%m-%d %H:%M')} = {time_difference:.2f} hours")
+        hours_from = 0
+        for hours, share in self.away_reductions:
+            if time_difference < hours:
+                logger.info(msg=f"{hours_from} to {hours} hours")
+                adjusted_temperature = target_temperature * share
+                logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode for {time_difference:.2f} hours. Target Temperature reduced by {share * 100:.0f} % to {target_temperature - adjusted_temperature:.2f}")
                 return adjusted_temperature
+            hours_from = hours
 
-            # Sets different reductions depending on time in AWAY mode
-            else:
-                time_difference = (now - self.away_time).total_seconds() / 3600
-                logger.info(
-                    msg=f"Time Now: {now.strftime('%Y-%m-%d %H:%M')} Away Time: {self.away_time.strftime('%Y-%m-%d %H:%M')} = {time_difference:.2f} hours")
-                if time_difference < 12:
-                    logger.info(msg="0 to 12 hour")
-                    adjusted_temperature = target_temperature * 0.1
-                    logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode for {time_difference:.2f} hours. Target Temperature reduced by 10 % to {target_temperature - adjusted_temperature:.2f}")
-                    return adjusted_temperature
-                elif 12 <= time_difference < 24:
-                    logger.info(msg="12 to 24 hours")
-                    adjusted_temperature = target_temperature * 0.2
-                    logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode for {time_difference:.2f} hours. Target Temperature reduced by 20 % to {target_temperature - adjusted_temperature:.2f}")
-                    return adjusted_temperature
-                else:
-                    logger.info(msg="24 hours & over")
-                    logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode over {time_difference:.2f} hours. Target Temperature set to FROST PROTECTION at 10 C")
-                    return 10
+        logger.info(msg=f"{hours_from} hours & over")
+        logger.info(msg=f"{self.name.upper().replace('_', ' ')} in AWAY mode over {time_difference:.2f} hours. Target Temperature set to FROST PROTECTION at {self.away_long_reduction} C")
+        return self.away_long_reduction
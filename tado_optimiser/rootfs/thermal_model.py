@@ -0,0 +1,223 @@
+import bisect
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger("tado_optimiser")
+
+# Observations closer together than this are too noisy at Tado's 0.1 °C resolution
+MIN_INTERVAL = 60 * 15
+MAX_INTERVAL = 60 * 60
+
+# Updates needed before a room's model is trusted over the defaults
+MIN_UPDATES = 24
+
+FORGETTING_FACTOR = 0.995
+
+# Limits that keep a badly conditioned fit from producing silly predictions
+LOSS_RATE_LIMITS = (0.01, 1.0)
+HEAT_RATE_LIMITS = (0.2, 10.0)
+
+
+class RoomModel:
+    # First order RC model dT/dt = loss_rate * (outside - inside) + heat_rate * heating, fitted by recursive least squares
+    def __init__(self, loss_rate, heat_rate, covariance=None, updates=0):
+        self.theta = [loss_rate, heat_rate]
+        self.covariance = covariance or [[1.0, 0.0], [0.0, 10.0]]
+        self.updates = updates
+
+        # Start of the interval being observed: (time, inside, outside, heating total, heating samples)
+        self.anchor = None
+
+    @property
+    def loss_rate(self):
+        return min(max(self.theta[0], LOSS_RATE_LIMITS[0]), LOSS_RATE_LIMITS[1])
+
+    @property
+    def heat_rate(self):
+        return min(max(self.theta[1], HEAT_RATE_LIMITS[0]), HEAT_RATE_LIMITS[1])
+
+    @property
+    def trained(self):
+        return self.updates >= MIN_UPDATES
+
+    def observe(self, timestamp, inside, outside, heating):
+        # Feeds one reading, the model is updated once the interval since the anchor is long enough
+        if self.anchor is None or timestamp - self.anchor[0] > MAX_INTERVAL or timestamp <= self.anchor[0]:
+            self.anchor = (timestamp, inside, outside, heating, 1)
+            return False
+
+        start, start_inside, start_outside, heating_total, samples = self.anchor
+        if timestamp - start < MIN_INTERVAL:
+            self.anchor = (start, start_inside, start_outside, heating_total + heating, samples + 1)
+            return False
+
+        hours = (timestamp - start) / 3600
+        self.update(
+            x=((start_outside + outside) / 2 - start_inside, heating_total / samples),
+            y=(inside - start_inside) / hours,
+        )
+        self.anchor = (timestamp, inside, outside, heating, 1)
+        return True
+
+    def update(self, x, y):
+        # Standard RLS step with exponential forgetting, two parameters so written out by hand
+        p = self.covariance
+        px = [p[0][0] * x[0] + p[0][1] * x[1], p[1][0] * x[0] + p[1][1] * x[1]]
+        denominator = FORGETTING_FACTOR + x[0] * px[0] + x[1] * px[1]
+        gain = [px[0] / denominator, px[1] / denominator]
+        error = y - (self.theta[0] * x[0] + self.theta[1] * x[1])
+        self.theta = [self.theta[0] + gain[0] * error, self.theta[1] + gain[1] * error]
+        self.covariance = [
+            [(p[i][j] - gain[i] * px[j]) / FORGETTING_FACTOR for j in range(2)]
+            for i in range(2)
+        ]
+        self.updates += 1
+
+    def equilibrium(self, outside, heating):
+        return outside + self.heat_rate * heating / self.loss_rate
+
+    def predict(self, inside, outside, minutes, heating=0.0):
+        # Room temperature after the given minutes with the heating held at the given level
+        equilibrium = self.equilibrium(outside=outside, heating=heating)
+        return equilibrium + (inside - equilibrium) * math.exp(-self.loss_rate * minutes / 60)
+
+    def minutes_to_target(self, inside, target, outside, heating=1.0):
+        # Minutes until the room reaches the target, 0 if it already has and None if it never will
+        if inside >= target:
+            return 0
+        equilibrium = self.equilibrium(outside=outside, heating=heating)
+        if equilibrium <= target:
+            return None
+        return math.log((equilibrium - inside) / (equilibrium - target)) / self.loss_rate * 60
+
+    def to_dict(self):
+        return {"theta": self.theta, "covariance": self.covariance, "updates": self.updates}
+
+
+class ThermalModels:
+    # Every room's thermal model, persisted in the snapshot store
+    def __init__(self, snapshot_store, default_loss_rate, default_heat_rate):
+        self.snapshot_store = snapshot_store
+        self.default_loss_rate = default_loss_rate
+        self.default_heat_rate = default_heat_rate
+        self.models = {}
+        self.lock = threading.Lock()
+        self.changed = False
+
+        data, last_updated = snapshot_store.load(name="thermal_models")
+        for name, model in (data or {}).items():
+            self.models[name] = RoomModel(
+                loss_rate=model["theta"][0],
+                heat_rate=model["theta"][1],
+                covariance=model["covariance"],
+                updates=model["updates"],
+            )
+        if self.models:
+            logger.info(msg=f"Thermal models loaded for {len(self.models)} rooms, last updated: {last_updated}")
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.models:
+                self.models[name] = RoomModel(loss_rate=self.default_loss_rate, heat_rate=self.default_heat_rate)
+            return self.models[name]
+
+    def get_rates(self, name):
+        # (heat_rate, loss_rate) for the planner, the defaults until the room's model is trained
+        model = self.get(name=name)
+        if model.trained:
+            return model.heat_rate, model.loss_rate
+        return self.default_heat_rate, self.default_loss_rate
+
+    def observe(self, name, inside, outside, heating, timestamp=None):
+        model = self.get(name=name)
+        if model.observe(timestamp=timestamp or time.time(), inside=inside, outside=outside, heating=heating):
+            self.changed = True
+            logger.debug("%s thermal model: loss rate %.3f /h | heat rate %.2f °C/h | %s updates", name, model.loss_rate, model.heat_rate, model.updates)
+
+    def save(self):
+        # Only written when a model has actually been updated
+        if not self.changed:
+            return
+        with self.lock:
+            data = {name: model.to_dict() for name, model in self.models.items() if model.updates}
+            self.changed = False
+        self.snapshot_store.save(name="thermal_models", data=data, last_updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    def bootstrap(self, home_assistant, rooms, outside_sensor, days=3):
+        # Fits rooms that have no model yet from Home Assistant's recorded history in one request
+        rooms = [spec for spec in rooms.values() if spec.name not in self.models or not self.models[spec.name].updates]
+        if not rooms:
+            return
+
+        heating_entities = {spec.name: f"sensor.{spec.name}_heating" if spec.is_tado else spec.gas_climate_entity for spec in rooms}
+        entity_ids = {outside_sensor} | {spec.gas_climate_entity for spec in rooms} | set(heating_entities.values())
+        end = datetime.now(timezone.utc)
+        history = home_assistant.get_history(entity_ids=sorted(entity_ids), start=end - timedelta(days=days), end=end)
+        if not history:
+            logger.warning(msg="No history available, thermal models will learn from live readings")
+            return
+
+        outside = to_series(states=history.get(outside_sensor, []), value=get_number_state)
+        for spec in rooms:
+            inside = to_series(states=history.get(spec.gas_climate_entity, []), value=get_current_temperature)
+            heating_value = get_heating_percentage if spec.is_tado else get_hvac_action
+            heating = to_series(states=history.get(heating_entities[spec.name], []), value=heating_value)
+            if not inside[0] or not outside[0] or not heating[0]:
+                continue
+
+            # Resamples the readings onto a regular grid, carrying the last value forward
+            model = self.get(name=spec.name)
+            step = MIN_INTERVAL / 3
+            timestamp = max(inside[0][0], outside[0][0], heating[0][0])
+            while timestamp <= end.timestamp():
+                model.observe(
+                    timestamp=timestamp,
+                    inside=value_at(series=inside, timestamp=timestamp),
+                    outside=value_at(series=outside, timestamp=timestamp),
+                    heating=value_at(series=heating, timestamp=timestamp),
+                )
+                timestamp += step
+            model.anchor = None
+            self.changed = True
+            logger.info(msg=f"{spec.display_name} thermal model bootstrapped from history: {model.updates} updates | loss rate {model.loss_rate:.3f} /h | heat rate {model.heat_rate:.2f} °C/h")
+
+        self.save()
+
+
+def get_number_state(state):
+    return float(state["state"])
+
+
+def get_current_temperature(state):
+    return float(state["attributes"]["current_temperature"])
+
+
+def get_heating_percentage(state):
+    return float(state["state"]) / 100
+
+
+def get_hvac_action(state):
+    return 1.0 if state["attributes"].get("hvac_action") == "heating" else 0.0
+
+
+def to_series(states, value):
+    # Converts history states into sorted ([times], [values]) skipping unavailable readings
+    times = []
+    values = []
+    for state in states:
+        try:
+            reading = value(state)
+        except (KeyError, TypeError, ValueError):
+            continue
+        times.append(datetime.fromisoformat(state["last_updated"]).timestamp())
+        values.append(reading)
+    return times, values
+
+
+def value_at(series, timestamp):
+    times, values = series
+    index = max(bisect.bisect_right(times, timestamp) - 1, 0)
+    return values[index]
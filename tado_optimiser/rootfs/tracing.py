@@ -0,0 +1,290 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+
+logger = logging.getLogger("tado_optimiser")
+
+# One outbound HTTP call, milliseconds include any retries made by the session
+Span = namedtuple("Span", ["service", "method", "endpoint", "status", "milliseconds", "bytes_sent", "bytes_received"])
+
+# Path segments holding entity ids, timestamps, tariff or account codes are collapsed so calls group by endpoint
+ENTITY_ID = re.compile(r"^[a-z_]+\.[a-z0-9_]+$")
+VERSION = re.compile(r"^[\d.]+$")
+
+# Trace of the cycle in progress & the last finished one, plus cycles completed since start
+current = None
+last = None
+cycles_total = 0
+
+# Running totals since start, exported as tado_optimiser_<name>_total
+counters = {}
+counters_lock = threading.Lock()
+
+# Seconds from the process starting to each start-up milestone, exported as tado_optimiser_startup_seconds
+startup = {}
+IMPORTED = time.monotonic()
+
+
+class CycleTrace:
+    def __init__(self):
+        self.started = time.time()
+        self.start_counter = time.perf_counter()
+        self.duration = None
+        self.phases = {}
+        self.rooms = {}
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        # A phase entered more than once in a cycle adds up
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_room(self, name, seconds):
+        with self.lock:
+            self.rooms[name] = seconds
+
+    def add_span(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def get_endpoints(self):
+        # Calls grouped by service, method & endpoint, slowest total first
+        endpoints = {}
+        for span in self.spans:
+            key = (span.service, span.method, span.endpoint)
+            summary = endpoints.setdefault(key, {"service": span.service, "method": span.method, "endpoint": span.endpoint, "count": 0, "errors": 0, "milliseconds": 0.0, "max_milliseconds": 0.0, "bytes": 0})
+            summary["count"] += 1
+            summary["errors"] += int(span.status is None or span.status >= 400)
+            summary["milliseconds"] += span.milliseconds
+            summary["max_milliseconds"] = max(summary["max_milliseconds"], span.milliseconds)
+            summary["bytes"] += span.bytes_sent + span.bytes_received
+        return sorted(endpoints.values(), key=lambda summary: summary["milliseconds"], reverse=True)
+
+    def get_summary(self):
+        endpoints = self.get_endpoints()
+        slowest_call = max(self.spans, key=lambda span: span.milliseconds, default=None)
+        return {
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "duration": round(self.duration or 0.0, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "rooms": {name: round(seconds, 3) for name, seconds in self.rooms.items()},
+            "http_requests": len(self.spans),
+            "http_errors": sum(endpoint["errors"] for endpoint in endpoints),
+            "http_milliseconds": round(sum(span.milliseconds for span in self.spans), 1),
+            "http_bytes_sent": sum(span.bytes_sent for span in self.spans),
+            "http_bytes_received": sum(span.bytes_received for span in self.spans),
+            "slowest_call": None if slowest_call is None else f"{slowest_call.method} {slowest_call.endpoint} {slowest_call.milliseconds:.0f} ms",
+            "endpoints": endpoints,
+        }
+
+
+def start_cycle():
+    global current
+    current = CycleTrace()
+    return current
+
+
+def finish_cycle():
+    # Closes the cycle in progress and keeps it as the last one, returns None if no cycle was started
+    global current, last, cycles_total
+    trace = current
+    if trace is None:
+        return None
+    trace.duration = time.perf_counter() - trace.start_counter
+    current = None
+    last = trace
+    cycles_total += 1
+    return trace
+
+
+def count(name, amount=1):
+    with counters_lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def get_process_age():
+    # Seconds since the process started, from /proc so the interpreter's own start-up counts, else since tracing was imported
+    try:
+        with open("/proc/self/stat", "r") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - IMPORTED
+
+
+def record_startup(stage):
+    # Only the first time each stage is reached counts
+    with counters_lock:
+        if stage in startup:
+            return
+        startup[stage] = round(get_process_age(), 3)
+    logger.info(msg=f"Start-up: {stage.replace('_', ' ')} after {startup[stage]:.2f}s")
+
+
+@contextmanager
+def phase(name):
+    # Times a phase of the cycle, safe to use from worker threads
+    trace = current
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add_phase(name=name, seconds=time.perf_counter() - started)
+
+
+@contextmanager
+def room(name):
+    trace = current
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add_room(name=name, seconds=time.perf_counter() - started)
+
+
+def get_endpoint(url):
+    segments = []
+    for segment in urlparse(url).path.split("/"):
+        if ENTITY_ID.match(segment):
+            segments.append("{entity_id}")
+        elif re.search(r"\d", segment) and not VERSION.match(segment):
+            segments.append("{id}")
+        else:
+            segments.append(segment)
+    return "/".join(segments)
+
+
+def record_http(service, method, url, response, seconds):
+    # Called by http_client for every request, calls made outside a cycle (start-up) are not traced
+    trace = current
+    if trace is None:
+        return
+    if response is None:
+        status, bytes_sent, bytes_received = None, 0, 0
+    else:
+        body = response.request.body if response.request is not None else None
+        status = response.status_code
+        bytes_sent = len(body or b"")
+        bytes_received = len(response.content or b"")
+    trace.add_span(span=Span(service, method, get_endpoint(url=url), status, seconds * 1000, bytes_sent, bytes_received))
+
+
+# ****************************************************************************************************************
+# Prometheus text format
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metric(lines, name, help_text, metric_type, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in samples:
+        label_text = ",".join(f"{key}=\"{escape_label(label)}\"" for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+
+def prometheus_text(trace=None):
+    # Metrics for the last finished cycle in the Prometheus text exposition format
+    trace = trace or last
+    lines = []
+    format_metric(lines, "tado_optimiser_cycles_total", "Update cycles completed since the add-on started", "counter", [({}, cycles_total)])
+    with counters_lock:
+        totals = sorted(counters.items())
+    for name, value in totals:
+        format_metric(lines, f"tado_optimiser_{name}_total", f"Total {name.replace('_', ' ')} since the add-on started", "counter", [({}, value)])
+    if startup:
+        format_metric(lines, "tado_optimiser_startup_seconds", "Seconds from the process starting to each start-up stage", "gauge",
+                      [({"stage": stage}, seconds) for stage, seconds in startup.items()])
+    if trace is None:
+        return "\n".join(lines) + "\n"
+
+    endpoints = trace.get_endpoints()
+    services = {}
+    for span in trace.spans:
+        totals = services.setdefault(span.service, [0, 0])
+        totals[0] += span.bytes_sent
+        totals[1] += span.bytes_received
+
+    format_metric(lines, "tado_optimiser_cycle_timestamp_seconds", "Start time of the last update cycle", "gauge", [({}, round(trace.started, 3))])
+    format_metric(lines, "tado_optimiser_cycle_duration_seconds", "Wall time of the last update cycle", "gauge", [({}, round(trace.duration or 0.0, 6))])
+    format_metric(lines, "tado_optimiser_phase_duration_seconds", "Wall time of each phase of the last update cycle", "gauge",
+                  [({"phase": name}, round(seconds, 6)) for name, seconds in trace.phases.items()])
+    format_metric(lines, "tado_optimiser_room_duration_seconds", "Wall time spent controlling each room in the last update cycle", "gauge",
+                  [({"room": name}, round(seconds, 6)) for name, seconds in trace.rooms.items()])
+    format_metric(lines, "tado_optimiser_http_requests", "HTTP requests made in the last update cycle", "gauge",
+                  [({"service": e["service"], "method": e["method"], "endpoint": e["endpoint"]}, e["count"]) for e in endpoints])
+    format_metric(lines, "tado_optimiser_http_errors", "Failed HTTP requests in the last update cycle", "gauge",
+                  [({"service": e["service"], "method": e["method"], "endpoint": e["endpoint"]}, e["errors"]) for e in endpoints])
+    format_metric(lines, "tado_optimiser_http_duration_seconds", "Total HTTP time per endpoint in the last update cycle", "gauge",
+                  [({"service": e["service"], "method": e["method"], "endpoint": e["endpoint"]}, round(e["milliseconds"] / 1000, 6)) for e in endpoints])
+    format_metric(lines, "tado_optimiser_http_bytes_sent", "Request body bytes sent per service in the last update cycle", "gauge",
+                  [({"service": service}, totals[0]) for service, totals in services.items()])
+    format_metric(lines, "tado_optimiser_http_bytes_received", "Response body bytes received per service in the last update cycle", "gauge",
+                  [({"service": service}, totals[1]) for service, totals in services.items()])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, text=None):
+    # Written atomically so a textfile collector never reads half a file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(prometheus_text() if text is None else text)
+    os.replace(temp_path, path)
+
+
+# ****************************************************************************************************************
+# Opt-in profiling
+
+
+class CycleProfiler:
+    # Dumps a cProfile & a tracemalloc snapshot for each of the next number of cycles, cProfile only sees the calling thread
+    def __init__(self, directory, cycles=0):
+        self.directory = directory
+        self.remaining = cycles
+        self.profile = None
+
+    def start(self):
+        if self.remaining <= 0:
+            return
+        # Imported here as profiling is rarely switched on
+        import cProfile
+        import tracemalloc
+        os.makedirs(self.directory, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        import tracemalloc
+        self.profile.disable()
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        profile_path = os.path.join(self.directory, f"cycle_{stamp}.prof")
+        memory_path = os.path.join(self.directory, f"cycle_{stamp}.tracemalloc")
+        try:
+            self.profile.dump_stats(profile_path)
+            tracemalloc.take_snapshot().dump(memory_path)
+            logger.info(msg=f"Cycle profile written: {profile_path} | {memory_path}")
+        except OSError as error:
+            logger.error(msg=f"Error writing cycle profile: {error}")
+
+        self.profile = None
+        self.remaining -= 1
+        if self.remaining <= 0:
+            tracemalloc.stop()
+            logger.info(msg="Cycle profiling finished")
@@ -1,16 +1,30 @@
-import json
+import hashlib
 import logging
-import time
 import os
+import time
 from datetime import datetime
 
-import requests
-
-from home_assistant_api import HomeAssistantAPI
+import http_client
+from forecast_store import load_forecast
+from resilience import age_seconds, get_breaker
+from snapshot_store import SnapshotStore
 
 logger = logging.getLogger("tado_optimiser")
 
-home_assistant = HomeAssistantAPI()
+# Minutes between forecast refreshes, faster when the forecast is moving or close to a room's target, slower when settled
+REFRESH_MINUTES = 15
+FAST_REFRESH_MINUTES = 5
+SLOW_REFRESH_MINUTES = 30
+
+# °C change per hour over the next 3 hours & °C from a room target that count as volatile, or settled
+VOLATILE_CHANGE = 1.5
+VOLATILE_MARGIN = 1.0
+SETTLED_CHANGE = 0.5
+SETTLED_MARGIN = 3.0
+
+# One Call blocks the add-on never reads
+EXCLUDE = "minutely,alerts"
+
 
 def day_suffix(day):
         return "th" if 11 <= day <= 13 else {1: "st", 2: "nd", 3: "rd"}.get(day % 10, "th")
@@ -26,232 +40,266 @@ def convert_time_date_only(unix_time):
     return formatted_time
 
 class WeatherAPI:
-    def __init__(self, open_weather_api_key, latitude, longitude):
-        self.base_url = "https://api.openweathermap.org/data/3.0/onecall?"
+    def __init__(self, open_weather_api_key, latitude, longitude, home_assistant, snapshot_store=None, fetch_cache=None, budget=None):
+        self.base_url = os.getenv("OPEN_WEATHER_URL", "https://api.openweathermap.org/data/3.0/onecall?")
+        self.home_assistant = home_assistant
+        self.fetch_cache = fetch_cache
+        self.budget = budget
         self.api_key = open_weather_api_key
         self.latitude = latitude
         self.longitude = longitude
-        self.weather_data = {}
+        self.forecast = None
         self.weather_data_last_updated = ""
+        # One breaker per API key so one home's bad key doesn't stop the others, named by a hash so the key isn't logged
+        key_id = hashlib.sha1(str(open_weather_api_key).encode("utf-8")).hexdigest()[:8]
+        self.breaker = get_breaker(name=f"OpenWeather {key_id}", base_delay=60 * 5)
+        self.snapshot_store = snapshot_store or SnapshotStore()
 
-    def update_weather_data(self):
-        now = datetime.now()
+        # Room targets for the current time sector, set by the cycle, an outside temperature near one of them is worth refreshing for
+        self.thresholds = ()
 
-        # Checks to see if weather data files are present and if not runs plan to make new ones
-        if not os.path.exists("/config/weather_data.json") or not os.path.exists("/config/weather_data_last_updated.txt"):
-            logger.info(msg="Weather data backup files not present running plan to make new ones")
-            self.get_weather_data()
+    def get_data_age(self):
+        return age_seconds(last_updated=self.weather_data_last_updated)
 
-        # If data files are present but no data in system load them
-        elif self.weather_data_last_updated == "" or self.weather_data == {}:
-            with open("/config/weather_data.json", "r") as f:
-                self.weather_data = json.load(f)
-            with open("/config/weather_data_last_updated.txt", "r") as f:
-                self.weather_data_last_updated = f.read()
+    def get_refresh_interval(self):
+        # Seconds the forecast is good for, never shorter than the daily call budget allows
+        minutes = REFRESH_MINUTES
+        if self.forecast is not None and len(self.forecast.hourly):
+            now = time.time()
+            temperatures = [self.forecast.temperature_at(moment=now + hour * 3600) for hour in range(3)]
+            change = max(abs(later - earlier) for earlier, later in zip(temperatures, temperatures[1:]))
+            margin = min((abs(temperature - threshold) for temperature in temperatures for threshold in self.thresholds), default=SETTLED_MARGIN)
+            if change >= VOLATILE_CHANGE or margin <= VOLATILE_MARGIN:
+                minutes = FAST_REFRESH_MINUTES
+            elif change <= SETTLED_CHANGE and margin >= SETTLED_MARGIN:
+                minutes = SLOW_REFRESH_MINUTES
 
-            logger.info(msg="Weather data loaded from backup files")
+        interval = minutes * 60
+        if self.budget is not None:
+            interval = max(interval, self.budget.get_min_interval())
+        return interval
 
-            # Checks if backup weather data is older than 15 minutes and updates weather data
-            if (now - datetime.strptime(self.weather_data_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 60 * 15:
-                logger.info(msg="Backup weather data older than 15 minutes updating")
+    def load_cached(self):
+        # Loads the weather snapshot if nothing is in memory yet, False if there isn't a usable one
+        if self.forecast is not None:
+            return True
+        weather_data, last_updated = self.snapshot_store.load(name="weather")
+        forecast = load_forecast(data=weather_data)
+        if forecast is None:
+            return False
+        self.forecast = forecast
+        self.weather_data_last_updated = last_updated
+        logger.info(msg="Weather data loaded from snapshot")
+        return True
+
+    def update_weather_data(self):
+        # If no data in system load the snapshot, or get new data if there isn't one
+        fetched = False
+        if self.weather_data_last_updated == "" or self.forecast is None:
+            if not self.load_cached():
+                logger.info(msg="Weather data snapshot not present getting new data")
                 self.get_weather_data()
-    
-        # Checks if minute is either 0, 15, 30 or 45 and updates weather data
-        if now.minute % 15 == 0 and (now - datetime.strptime(self.weather_data_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 30:
+                fetched = True
+
+            # Checks if snapshot weather data is older than the refresh interval and updates weather data
+            elif self.get_data_age() >= self.get_refresh_interval():
+                logger.info(msg="Snapshot weather data out of date updating")
                 self.get_weather_data()
-        else:
-            if (now - datetime.strptime(self.weather_data_last_updated, "%Y-%m-%d %H:%M:%S")).total_seconds() > 30:
-                logger.info(msg=f"Weather data not updated. Last updated: {self.weather_data_last_updated}")
-                self.current_weather()
-                self.hourly_entities()
-                self.daily_entities()
-            
+                fetched = True
+
+        # Nothing fetched or loaded yet, the cycle will try again next time
+        if self.forecast is None:
+            logger.error(msg="No weather data available")
+            return
+
+        # Already fetched this cycle, a failed fetch isn't retried until the next one
+        if fetched:
+            return
+
+        # Refreshes once the data is older than the refresh interval, a minute early as cycles start on the clock
+        age = self.get_data_age()
+        interval = self.get_refresh_interval()
+        if age >= interval - 60:
+            self.get_weather_data()
+        elif age > 30:
+            logger.info(msg=f"Weather data not updated. Last updated: {self.weather_data_last_updated} | Next refresh in {(interval - age) / 60:.0f} minutes", extra={"rate_limit": True})
+            self.current_weather()
+            self.hourly_entities()
+            self.daily_entities()
+
     def get_weather_data(self):
-        # Updates weather data if it fails will stay in loop
-        fullUrl = f"{self.base_url}lat={self.latitude}&lon={self.longitude}&appid={self.api_key}&units=metric"
-        logger.debug(msg=f"Get weather data fullUrl: {fullUrl}")
-        response = requests.get(fullUrl)
-        status = response.status_code
+        # Updates weather data, if it fails the cached data is kept and the circuit breaker decides when to retry
+        if not self.breaker.allow():
+            logger.info(msg=f"Weather data not requested, OpenWeather circuit {self.breaker.describe().lower()}. Using data from: {self.weather_data_last_updated or 'None'}", extra={"rate_limit": True})
+            return
 
-        if status == 200:
-            # Records weather data & timestamp
-            self.weather_data = response.json()
+        # Out of calls for today the cached forecast is used until the quota resets
+        if self.budget is not None and self.budget.get_remaining() == 0:
+            logger.warning(msg=f"Weather data not requested, OpenWeather daily call budget of {self.budget.daily_limit} used. Using data from: {self.weather_data_last_updated or 'None'}", extra={"rate_limit": True})
+            return
+
+        if self.fetch_cache is not None:
+            # Homes in the same grid cell share one request & its converted forecast
+            forecast = self.fetch_cache.get_or_fetch(key=("weather", self.get_cell()), fetch=self.fetch_forecast)
+        else:
+            forecast = self.fetch_forecast()
+
+        if forecast is not None:
+            self.breaker.record_success()
+
+            # Records the forecast & timestamp
+            self.forecast = forecast
             self.weather_data_last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Write formatted json to file & records timestamp
-            with open("/config/weather_data.json", "w") as f:
-                json.dump(self.weather_data, f, indent=4)
-            with open("/config/weather_data_last_updated.txt", "w") as f:
-                f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-                
+
+            # Saves data & timestamp together
+            self.snapshot_store.save(name="weather", data=self.forecast.to_snapshot(), last_updated=self.weather_data_last_updated)
+
             logger.info(msg=f"Weather data updated: {self.weather_data_last_updated}")
             self.current_weather()
             self.hourly_entities()
             self.daily_entities()
-            
+
         else:
-            logger.error(msg=f"Error getting weather data. Status code: {status} Will try again in 30 minute")
-            time.sleep(60 * 30)
-            self.update_weather_data()
+            logger.error(msg=f"Error getting weather data. Using data from: {self.weather_data_last_updated or 'None'}")
+            self.breaker.record_failure()
+
+    def get_cell(self):
+        # Locations within about 1 km share a forecast
+        return round(float(self.latitude), 2), round(float(self.longitude), 2)
+
+    def fetch_forecast(self):
+        # The response is converted straight away and not kept
+        return load_forecast(data=self.fetch_weather_data())
+
+    def fetch_weather_data(self):
+        # Returns the One Call response, or None if the request failed or the daily budget is used up
+        if self.budget is not None and not self.budget.spend():
+            logger.warning(msg="OpenWeather daily call budget used, request not made")
+            return None
+
+        fullUrl = f"{self.base_url}lat={self.latitude}&lon={self.longitude}&exclude={EXCLUDE}&appid={self.api_key}&units=metric"
+        logger.debug(msg=f"Get weather data fullUrl: {fullUrl}")
+        response = http_client.request("open_weather", "GET", fullUrl)
+        status = response.status_code if response is not None else None
+
+        if status == 200:
+            return response.json()
+        logger.error(msg=f"Error getting weather data. Status code: {status}")
+        return None
 
     def current_weather(self):
         # Creates / updates entities
-        current_data = self.weather_data["current"]
+        current = self.forecast.get_current
         sensor = "sensor.tado_optimiser_current"
-        try:
-            payload = {
-                "state": current_data["temp"],
-                "attributes": {
-                    "unit_of_measurement": "°C",
-                    "friendly_name": convert_time(current_data["dt"]),
-                    "icon": "mdi:thermometer",
-                    "Time": convert_time(current_data["dt"]),
-                    "Sunrise": convert_time(current_data["sunrise"]),
-                    "Sunset": convert_time(current_data["sunset"]),
-                    "Temp": current_data["temp"],
-                    "Feels like": current_data["feels_like"],
-                    "Pressure": current_data["pressure"],
-                    "Humidity": current_data["humidity"],
-                    "Dew point": current_data["dew_point"],
-                    "Clouds": current_data["clouds"],
-                    "UVI": current_data["uvi"],
-                    "Visibility": current_data.get("visibility", "No Data"),
-                    "Wind speed": current_data["wind_speed"],
-                    "Wind gust": current_data.get("wind_gust", "No Data"),
-                    "Wind degrees": current_data["wind_deg"],
-                    "Rain": current_data.get("rain", {}).get("1h", 0),
-                    "Snow": current_data.get("snow", {}).get("1h", 0),
-                    "Weather - ID": current_data["weather"][0]["id"],
-                    "Weather - Main": current_data["weather"][0]["main"],
-                    "Weather - Description": current_data["weather"][0]["description"].capitalize()
-                }
+        payload = {
+            "state": current(name="temp"),
+            "attributes": {
+                "unit_of_measurement": "°C",
+                "friendly_name": convert_time(current(name="dt")),
+                "icon": "mdi:thermometer",
+                "Time": convert_time(current(name="dt")),
+                "Sunrise": convert_time(current(name="sunrise")),
+                "Sunset": convert_time(current(name="sunset")),
+                "Temp": current(name="temp"),
+                "Feels like": current(name="feels_like"),
+                "Pressure": current(name="pressure"),
+                "Humidity": current(name="humidity"),
+                "Dew point": current(name="dew_point"),
+                "Clouds": current(name="clouds"),
+                "UVI": current(name="uvi"),
+                "Visibility": current(name="visibility", default="No Data"),
+                "Wind speed": current(name="wind_speed"),
+                "Wind gust": current(name="wind_gust", default="No Data"),
+                "Wind degrees": current(name="wind_deg"),
+                "Rain": current(name="rain_1h", default=0),
+                "Snow": current(name="snow_1h", default=0),
+                "Weather - ID": current(name="weather_id"),
+                "Weather - Main": current(name="weather_main"),
+                "Weather - Description": current(name="weather_description", default="").capitalize()
             }
+        }
+        self.home_assistant.update_entity(sensor=sensor, payload=payload)
+        logger.info(msg="Current weather entity created / updated")
 
-        except KeyError as error:
-            logger.error(msg=f"Error creating current weather entity. Key not found: {error}")
-            sensor = "sensor.tado_optimiser_current"
+    def hourly_entities(self):
+        # Creates / updates entities, a value missing from the forecast is sent as None
+        hourly = self.forecast.hourly
+        for hour in range(0, min(12, len(hourly))):
+            sensor = f"sensor.tado_optimiser_hour_{hour}"
             payload = {
-                "state": current_data["temp"],
+                "state": hourly.get(name="temp", index=hour),
                 "attributes": {
                     "unit_of_measurement": "°C",
-                    "friendly_name": convert_time(current_data["dt"]),
+                    "friendly_name": convert_time(hourly.get(name="dt", index=hour)),
                     "icon": "mdi:thermometer",
+                    "Time": convert_time(hourly.get(name="dt", index=hour)),
+                    "Temp": hourly.get(name="temp", index=hour),
+                    "Feels like": hourly.get(name="feels_like", index=hour),
+                    "Pressure": hourly.get(name="pressure", index=hour),
+                    "Humidity": hourly.get(name="humidity", index=hour),
+                    "Dew point": hourly.get(name="dew_point", index=hour),
+                    "UVI": hourly.get(name="uvi", index=hour),
+                    "Clouds": hourly.get(name="clouds", index=hour),
+                    "Visibility": hourly.get(name="visibility", index=hour, default="No Data"),
+                    "Wind speed": hourly.get(name="wind_speed", index=hour),
+                    "Wind gust": hourly.get(name="wind_gust", index=hour, default="No Data"),
+                    "Wind degrees": hourly.get(name="wind_deg", index=hour),
+                    "POP": hourly.get(name="pop", index=hour),
+                    "Rain": hourly.get(name="rain_1h", index=hour, default=0),
+                    "Snow": hourly.get(name="snow_1h", index=hour, default=0),
+                    "Hourly Weather - ID": hourly.get(name="weather_id", index=hour),
+                    "Hourly Weather - Main": hourly.get(name="weather_main", index=hour),
+                    "Hourly Weather - Description": hourly.get(name="weather_description", index=hour, default="").capitalize(),
                 }
             }
-            home_assistant.update_entity(sensor=sensor, payload=payload)
-
-        home_assistant.update_entity(sensor, payload)
-        logger.info(msg="Current weather entity created / updated")
-
-    def hourly_entities(self):
-        # Creates / updates entities
-        hourly_data = self.weather_data["hourly"]
-        for hour in range(0, 12):
-            sensor = f"sensor.tado_optimiser_hour_{hour}"
-            try:
-                payload = {
-                    "state": hourly_data[hour]["temp"],
-                    "attributes": {
-                        "unit_of_measurement": "°C",
-                        "friendly_name": convert_time(hourly_data[hour]["dt"]),
-                        "icon": "mdi:thermometer",
-                        "Time": convert_time(hourly_data[hour]["dt"]),
-                        "Temp": hourly_data[hour]["temp"],
-                        "Feels like": hourly_data[hour]["feels_like"],
-                        "Pressure": hourly_data[hour]["pressure"],
-                        "Humidity": hourly_data[hour]["humidity"],
-                        "Dew point": hourly_data[hour]["dew_point"],
-                        "UVI": hourly_data[hour]["uvi"],
-                        "Clouds": hourly_data[hour]["clouds"],
-                        "Visibility": hourly_data[hour].get("visibility", "No Data"),
-                        "Wind speed": hourly_data[hour]["wind_speed"],
-                        "Wind gust": hourly_data[hour].get("wind_gust", "No Data"),
-                        "Wind degrees": hourly_data[hour]["wind_deg"],
-                        "POP": hourly_data[hour]["pop"],
-                        "Rain": hourly_data[hour].get("rain", {}).get("1h", 0),
-                        "Snow": hourly_data[hour].get("snow", {}).get("1h", 0),
-                        "Hourly Weather - ID": hourly_data[hour]["weather"][0]["id"],
-                        "Hourly Weather - Main": hourly_data[hour]["weather"][0]["main"],
-                        "Hourly Weather - Description": hourly_data[hour]["weather"][0]["description"].capitalize(),
-                    }
-                }
-
-            except KeyError as error:
-                logger.error(msg=f"Error creating hourly weather entity. Key not found: {error}")
-                sensor = f"sensor.tado_optimiser_hour_{hour}"
-                payload = {
-                    "state": hourly_data[hour]["temp"],
-                    "attributes": {
-                        "unit_of_measurement": "°C",
-                        "friendly_name": convert_time(hourly_data[hour]["dt"]),
-                        "icon": "mdi:thermometer",
-                    }
-                }
-                home_assistant.update_entity(sensor=sensor, payload=payload)
-
-            home_assistant.update_entity(sensor=sensor, payload=payload)
+            self.home_assistant.update_entity(sensor=sensor, payload=payload)
 
         logger.info(msg="Hourly entities created / updated")
 
     def daily_entities(self):
-        # Creates / updates entities
-        daily_data = self.weather_data["daily"]
-        for day in range(0, 8):
+        # Creates / updates entities, a value missing from the forecast is sent as None
+        daily = self.forecast.daily
+        for day in range(0, min(8, len(daily))):
             sensor = f"sensor.tado_optimiser_day_{day}"
-            try:
-                payload = {
-                    "state": daily_data[day]["temp"]["day"],
-                    "attributes": {
-                        "unit_of_measurement": "°C",
-                        "friendly_name": convert_time_date_only(daily_data[day]["dt"]),
-                        "icon": "mdi:thermometer",
-                        "Date": convert_time_date_only(daily_data[day]["dt"]),
-                        "Sunrise": convert_time(daily_data[day]["sunrise"]),
-                        "Sunset": convert_time(daily_data[day]["sunset"]),
-                        "Moonrise": convert_time(daily_data[day]["moonrise"]),
-                        "Moonset": convert_time(daily_data[day]["moonset"]),
-                        "Moon phase": daily_data[day]["moon_phase"],
-                        "Summary": daily_data[day]["summary"],
-                        "Temp - Day": daily_data[day]["temp"]["day"],
-                        "Temp - Min": daily_data[day]["temp"]["min"],
-                        "Temp - Max": daily_data[day]["temp"]["max"],
-                        "Temp - Night": daily_data[day]["temp"]["night"],
-                        "Temp - Eve": daily_data[day]["temp"]["eve"],
-                        "Temp - Morn": daily_data[day]["temp"]["morn"],
-                        "Feels like - Day": daily_data[day]["feels_like"]["day"],
-                        "Feels like - Night": daily_data[day]["feels_like"]["night"],
-                        "Feels like - Eve": daily_data[day]["feels_like"]["eve"],
-                        "Feels like - Morn": daily_data[day]["feels_like"]["morn"],
-                        "Pressure": daily_data[day]["pressure"],
-                        "Humidity": daily_data[day]["humidity"],
-                        "Dew point": daily_data[day]["dew_point"],
-                        "Wind speed": daily_data[day]["wind_speed"],
-                        "Wind gust": daily_data[day].get("wind_gust", "No Data"),
-                        "Wind degrees": daily_data[day]["wind_deg"],
-                        "Clouds": daily_data[day]["clouds"],
-                        "UVI": daily_data[day]["uvi"],
-                        "POP": daily_data[day]["pop"],
-                        "Rain": daily_data[day].get("rain", 0),
-                        "Snow": daily_data[day].get("snow", 0),
-                        "Daily Weather - ID": daily_data[day]["weather"][0]["id"],
-                        "Daily Weather - Main": daily_data[day]["weather"][0]["main"],
-                        "Daily Weather - Description": daily_data[day]["weather"][0]["description"].capitalize(),
-                    }
-                }
-            except KeyError as error:
-                logger.error(msg=f"Error creating daily weather entity. Key not found: {error}")
-                sensor = f"sensor.tado_optimiser_day_{day}"
-                payload = {
-                    "state": daily_data[day]["temp"]["day"],
-                    "attributes": {
-                        "unit_of_measurement": "°C",
-                        "friendly_name": convert_time_date_only(daily_data[day]["dt"]),
-                        "icon": "mdi:thermometer",
-                    }
+            payload = {
+                "state": daily.get(name="temp_day", index=day),
+                "attributes": {
+                    "unit_of_measurement": "°C",
+                    "friendly_name": convert_time_date_only(daily.get(name="dt", index=day)),
+                    "icon": "mdi:thermometer",
+                    "Date": convert_time_date_only(daily.get(name="dt", index=day)),
+                    "Sunrise": convert_time(daily.get(name="sunrise", index=day)),
+                    "Sunset": convert_time(daily.get(name="sunset", index=day)),
+                    "Moonrise": convert_time(daily.get(name="moonrise", index=day)),
+                    "Moonset": convert_time(daily.get(name="moonset", index=day)),
+                    "Moon phase": daily.get(name="moon_phase", index=day),
+                    "Summary": daily.get(name="summary", index=day),
+                    "Temp - Day": daily.get(name="temp_day", index=day),
+                    "Temp - Min": daily.get(name="temp_min", index=day),
+                    "Temp - Max": daily.get(name="temp_max", index=day),
+                    "Temp - Night": daily.get(name="temp_night", index=day),
+                    "Temp - Eve": daily.get(name="temp_eve", index=day),
+                    "Temp - Morn": daily.get(name="temp_morn", index=day),
+                    "Feels like - Day": daily.get(name="feels_like_day", index=day),
+                    "Feels like - Night": daily.get(name="feels_like_night", index=day),
+                    "Feels like - Eve": daily.get(name="feels_like_eve", index=day),
+                    "Feels like - Morn": daily.get(name="feels_like_morn", index=day),
+                    "Pressure": daily.get(name="pressure", index=day),
+                    "Humidity": daily.get(name="humidity", index=day),
+                    "Dew point": daily.get(name="dew_point", index=day),
+                    "Wind speed": daily.get(name="wind_speed", index=day),
+                    "Wind gust": daily.get(name="wind_gust", index=day, default="No Data"),
+                    "Wind degrees": daily.get(name="wind_deg", index=day),
+                    "Clouds": daily.get(name="clouds", index=day),
+                    "UVI": daily.get(name="uvi", index=day),
+                    "POP": daily.get(name="pop", index=day),
+                    "Rain": daily.get(name="rain", index=day, default=0),
+                    "Snow": daily.get(name="snow", index=day, default=0),
+                    "Daily Weather - ID": daily.get(name="weather_id", index=day),
+                    "Daily Weather - Main": daily.get(name="weather_main", index=day),
+                    "Daily Weather - Description": daily.get(name="weather_description", index=day, default="").capitalize(),
                 }
-
-                home_assistant.update_entity(sensor=sensor, payload=payload)
-
-            home_assistant.update_entity(sensor=sensor, payload=payload)
+            }
+            self.home_assistant.update_entity(sensor=sensor, payload=payload)
 
         logger.info(msg="Daily entities created / updated")